@@ -0,0 +1,104 @@
+"""Fetches files from GridFS, such as the models Sacred saves as artifacts, into memory or a local cache.
+
+Sacred stores each artifact in GridFS: a document in fs.files with its length and chunk size, and numbered chunks of
+its data in fs.chunks. The chunks are streamed in order with a single query, and checked to be complete, so a partial
+download is never used. A cached file is named by the GridFS file id, which never refers to different contents, so a
+file which is in the cache is returned without connecting to the database.
+"""
+import io
+import os
+import time
+
+
+def read_gridfs_file(db, file_id, log=print) -> bytes:
+    """Returns the contents of the file, downloaded into memory.
+
+    :param db The pymongo database that Sacred saves to.
+    """
+    buffer = io.BytesIO()
+    _stream_chunks(db, file_id, buffer, log)
+    return buffer.getvalue()
+
+
+def fetch_gridfs_file(db, file_id, cache_dir: str, log=print) -> str:
+    """Returns the path of the file in cache_dir, first downloading it if it is not already there."""
+    path = os.path.join(cache_dir, str(file_id))
+    if os.path.exists(path):
+        log(f'Using cached {path}')
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temporary file then renamed, so that only complete files are in the cache.
+    try:
+        with open(path + '.tmp', 'wb') as file:
+            _stream_chunks(db, file_id, file, log)
+    except BaseException:
+        os.remove(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _stream_chunks(db, file_id, file, log):
+    """Writes the chunks of the file to the file object, and checks that none are missing."""
+    metadata = db['fs.files'].find_one({'_id': file_id})
+    assert metadata is not None, f'No file {file_id} in GridFS'
+    length, chunk_size = metadata['length'], metadata['chunkSize']
+    num_chunks = -(-length // chunk_size)
+
+    start = time.perf_counter()
+    received = 0
+    cursor = db['fs.chunks'].find({'files_id': file_id}, sort=[('n', 1)])
+    for i, chunk in enumerate(cursor):
+        assert chunk['n'] == i, f'Chunk {i} of {file_id} is missing'
+        data = chunk['data']
+        # Every chunk except the last is full.
+        assert len(data) == (chunk_size if i < num_chunks - 1 else length - chunk_size * (num_chunks - 1)), \
+            f'Chunk {i} of {file_id} has {len(data)} bytes'
+        file.write(data)
+        received += len(data)
+    assert received == length, f'Received {received} bytes of {file_id}, but it has {length}'
+
+    seconds = time.perf_counter() - start
+    log(f'Downloaded {file_id} in {num_chunks} chunks, {length / 2 ** 20:.1f} MiB in {seconds:.1f}s, '
+        f'{length / 2 ** 20 / max(seconds, 1e-9):.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    # ### Test against an in-memory stand-in for MongoDB: pip install mongomock
+    import tempfile
+
+    import mongomock
+    from bson import ObjectId
+
+    def _put_test_file(contents: bytes, chunk_size: int) -> ObjectId:
+        """Saves the file in the same layout as GridFS."""
+        file_id = ObjectId()
+        test_db['fs.files'].insert_one({'_id': file_id, 'length': len(contents), 'chunkSize': chunk_size})
+        test_db['fs.chunks'].insert_many(
+            [{'files_id': file_id, 'n': n, 'data': contents[start:start + chunk_size]}
+             for n, start in enumerate(range(0, len(contents), chunk_size))][::-1])
+        return file_id
+
+    test_db = mongomock.MongoClient().db
+    test_contents = os.urandom(1000)
+    test_file_id = _put_test_file(test_contents, 256)
+    assert read_gridfs_file(test_db, test_file_id) == test_contents
+    with tempfile.TemporaryDirectory() as test_cache_dir:
+        test_path = fetch_gridfs_file(test_db, test_file_id, test_cache_dir)
+        with open(test_path, 'rb') as test_file:
+            assert test_file.read() == test_contents
+
+        # A cache hit doesn't read the database.
+        test_db['fs.chunks'].delete_many({})
+        assert fetch_gridfs_file(test_db, test_file_id, test_cache_dir) == test_path
+
+        # A missing chunk fails, rather than returning or caching a partial file.
+        test_file_id = _put_test_file(test_contents, 256)
+        test_db['fs.chunks'].delete_one({'files_id': test_file_id, 'n': 2})
+        try:
+            fetch_gridfs_file(test_db, test_file_id, test_cache_dir)
+            raise RuntimeError('A missing chunk was not detected')
+        except AssertionError as e:
+            assert 'missing' in str(e)
+        assert os.listdir(test_cache_dir) == [os.path.basename(test_path)]
@@ -0,0 +1,118 @@
+"""Runs validation in a separate process on snapshots of the model, so that training does not stop to validate."""
+import multiprocessing
+import queue
+import traceback
+
+import torch
+
+# Sent to the worker to make it exit.
+_STOP = None
+
+
+def _to_plain(value):
+    """Converts Sacred's read only config containers to dicts and lists, so the config can be sent to the worker."""
+    if isinstance(value, dict):
+        return {key: _to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(item) for item in value]
+    return value
+
+
+def _worker(config, snapshots, results):
+    """Validates each (epoch, state dict) from snapshots, and puts (epoch, metrics, error) on results."""
+    # Imported here, as train imports this module.
+    from cityscapestask import cityscapes, train
+
+    try:
+        device = train.get_device(config)
+        learner = train.create_learner(config, pre_train_encoder=False)
+        learner.to(device)
+        criterion = train.create_criterion(config, learner)
+        # This process was spawned, so its loader workers would be too by default, but the dataset can't be pickled.
+        validation_loader = cityscapes.get_loader_from_dir(config['root_dir_validation'], config,
+                                                           multiprocessing_context='fork')
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is _STOP:
+            return
+
+        epoch, state_dict = snapshot
+        try:
+            learner.load_state_dict(state_dict)
+            metrics = train.compute_validation_metrics(config, device, validation_loader, learner, criterion, epoch)
+            results.put((epoch, metrics, None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class AsyncValidator(object):
+    """Validates snapshots of the learner in a worker process, which has its own model and validation data loader.
+
+    At most one snapshot waits for the worker, so if validation is slower than training then submit blocks until the
+    worker is ready, rather than snapshots accumulating in memory.
+    """
+
+    def __init__(self, config):
+        # Spawn rather than fork, as CUDA can not be used in a forked process.
+        context = multiprocessing.get_context('spawn')
+        self._snapshots = context.Queue(maxsize=1)
+        self._results = context.Queue()
+        self._pending = 0
+        # Not a daemon, as daemons can't start the worker processes of the validation data loader. So close must be
+        # called, and the worker is terminated if it fails.
+        self._process = context.Process(target=_worker, args=(_to_plain(config), self._snapshots, self._results))
+        self._process.start()
+
+    def submit(self, epoch: int, learner: torch.nn.Module):
+        """Queues a copy of the learner's current weights for validation, labelled with the given epoch."""
+        state_dict = {key: value.detach().cpu().clone() for key, value in learner.state_dict().items()}
+        while True:
+            try:
+                self._snapshots.put((epoch, state_dict), timeout=10)
+                break
+            except queue.Full:
+                self._check_alive()
+        self._pending += 1
+
+    def poll(self, block=False) -> [(int, {str: float})]:
+        """Returns (epoch, metrics) for each snapshot validated since the last call, in the order submitted.
+
+        :param block If True, waits for all submitted snapshots to be validated.
+        """
+        completed = []
+        while self._pending > 0:
+            try:
+                # Time out periodically, so that we notice if the worker has died.
+                epoch, metrics, error = self._results.get(block=block, timeout=10 if block else None)
+            except queue.Empty:
+                self._check_alive()
+                if block:
+                    continue
+                break
+
+            if error is not None:
+                self._process.terminate()
+                self._process.join()
+                raise RuntimeError('Validation failed at epoch {}:\n{}'.format(epoch, error))
+            self._pending -= 1
+            completed.append((epoch, metrics))
+        return completed
+
+    def close(self):
+        """Stops the worker, after it has validated the snapshots already submitted."""
+        if self._process.is_alive():
+            self._snapshots.put(_STOP)
+            self._process.join()
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            # The worker puts its error on the results queue before exiting, if it can.
+            try:
+                _, _, error = self._results.get_nowait()
+            except queue.Empty:
+                error = 'exit code {}'.format(self._process.exitcode)
+            raise RuntimeError('Validation worker exited:\n{}'.format(error))
@@ -1,53 +1,226 @@
-"""Provides methods to save and load the state from Sacred."""
+"""Provides methods to save and load the state, from Sacred or a local directory."""
+import glob
+import io
+import json
+import os
+import queue
+import re
 import tempfile
+import threading
 from typing import Dict, Tuple
 
 import pymongo
 import torch
+from torch import nn
 from torch.optim import Optimizer
 
 import sacred_creds
+from cityscapestask import artifacts, weights_file
 from cityscapestask.model import MultitaskLearner
 
 
-def save_model(_run, model: MultitaskLearner, optimizer: Optimizer, epoch: int, iterations: int):
-    """Saves the state of the model and optimizer to Sacred, suitable for visualisation or resuming training."""
+def save_model(_run, model: MultitaskLearner, optimizer: Optimizer, epoch: int, iterations: int,
+               distillation_criterion: nn.Module = None):
+    """Saves the state of the model and optimizer to Sacred, suitable for visualisation or resuming training.
+
+    :param distillation_criterion When distilling, its loss weights are trained by the optimizer but aren't part of the
+    model, so are saved alongside it.
+    """
     with tempfile.NamedTemporaryFile() as file:
         state = {'version': 1, 'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(),
                  'epoch': epoch, 'iterations': iterations}
+        if distillation_criterion is not None:
+            state['distillation_state_dict'] = distillation_criterion.state_dict()
 
         torch.save(state, file.name)
         _run.add_artifact(file.name, 'model_epoch_{}'.format(epoch))
         _run.run_logger.info('Saved model to sacred at epoch {}.'.format(epoch))
 
 
-def load_state(_run, run_id: int) -> Tuple[int, Dict, Dict]:
+def load_state(_run, run_id: int) -> Tuple[int, Dict, Dict, Dict]:
     """Loads the state of the latest save from the given run.
 
-    :returns: (epoch: int, state_dict)
+    It is downloaded into memory, or if config['artifact_cache_dir'] is set, into that directory, unless it is already
+    there.
+
+    :returns: (epoch: int, model state_dict, optimizer state_dict, distillation criterion state_dict or None)
     """
     db = pymongo.MongoClient(sacred_creds.url, 27017)[sacred_creds.database_name]
     experiment = db['runs'].find_one({'_id': run_id})
 
-    artifacts = experiment['artifacts']
-    _run.run_logger.debug('Found {} saves'.format(len(artifacts)))
-    artifact = artifacts[len(artifacts) - 1]
+    saves = experiment['artifacts']
+    _run.run_logger.debug('Found {} saves'.format(len(saves)))
+    artifact = saves[len(saves) - 1]
 
     # Parse the name above: model_epoch_{epoch}
     epoch = int(artifact['name'].split('_')[2])
+    _run.run_logger.info('Loading the save at epoch {} of run {}'.format(epoch, run_id))
 
-    cursor = db['fs.chunks'].find({'files_id': artifact['file_id']})
-    with tempfile.NamedTemporaryFile() as file:
-        _run.run_logger.info('Found {} chunks for epoch {}, downloading...'.format(cursor.count(), epoch))
-        i = 0
-        for chunk in cursor:
-            assert chunk['n'] == i
-            i += 1
-            file.write(chunk['data'])
-        _run.run_logger.debug('Download complete')
-        state = torch.load(file.name)
+    cache_dir = _run.config['artifact_cache_dir']
+    if cache_dir is not None:
+        return load_state_from_file(artifacts.fetch_gridfs_file(db, artifact['file_id'], cache_dir,
+                                                                log=_run.run_logger.info))
+    contents = artifacts.read_gridfs_file(db, artifact['file_id'], log=_run.run_logger.info)
+    return _unpack_state(torch.load(io.BytesIO(contents), map_location='cpu'))
+
+
+def load_state_from_file(path: str) -> Tuple[int, Dict, Dict, Dict]:
+    """Loads the state from a file saved by save_model, e.g. downloaded from the Sacred artifacts, or by
+    weights_file.save_weights.
+
+    :returns: (epoch: int, model state_dict, optimizer state_dict, distillation criterion state_dict), the last two
+    None for a weights file
+    """
+    if weights_file.is_weights_file(path):
+        model_state_dict, metadata = weights_file.load_weights(path)
+        return metadata['epoch'], model_state_dict, None, None
+
+    return _unpack_state(torch.load(path, map_location='cpu'))
 
+
+def _unpack_state(state: dict) -> Tuple[int, Dict, Dict, Dict]:
     # We don't know how to handle anything except version 1.
     assert state['version'] == 1
 
-    return state['epoch'], state['model_state_dict'], state['optimizer_state_dict']
+    # Saves from before distillation, or without it, have no distillation state.
+    return (state['epoch'], state['model_state_dict'], state['optimizer_state_dict'],
+            state.get('distillation_state_dict'))
+
+
+class CheckpointStore(object):
+    """Saves checkpoints to a local directory on a background thread, so that training does not wait for them.
+
+    Each checkpoint is a file in the same format as save_model, named model_epoch_{epoch}.pt, which is written to a
+    temporary file then renamed, so the files in the directory are always complete. The last keep_last checkpoints are
+    kept, as well as the checkpoint with the lowest validation loss, and the others are deleted. The validation losses
+    are saved in the directory, so the best checkpoint is still kept after resuming.
+
+    The state is copied to the CPU in save, and at most one copy waits for the background thread, so if saving is slower
+    than training then save blocks rather than copies accumulating in memory.
+    """
+
+    _MANIFEST = 'checkpoints.json'
+
+    def __init__(self, directory: str, keep_last: int, _run=None):
+        """Creates a new instance, and starts its background thread.
+
+        :param _run If not None, each checkpoint is also added to the artifacts of this Sacred run, from the background
+        thread.
+        """
+        assert keep_last > 0, f'keep_last must be positive, was {keep_last}'
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._keep_last = keep_last
+        self._run = _run
+        self._validation_losses = self._read_manifest()
+        self._jobs = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._work, name='CheckpointStore', daemon=True)
+        self._thread.start()
+
+    def save(self, model: MultitaskLearner, optimizer: Optimizer, epoch: int, iterations: int,
+             distillation_criterion: nn.Module = None):
+        """Copies the state of the model and optimizer, and the distillation criterion if given, to be saved on the
+        background thread."""
+        self._check_error()
+        state = {'version': 1, 'model_state_dict': _copy_to_cpu(model.state_dict()),
+                 'optimizer_state_dict': _copy_to_cpu(optimizer.state_dict()), 'epoch': epoch,
+                 'iterations': iterations}
+        if distillation_criterion is not None:
+            state['distillation_state_dict'] = _copy_to_cpu(distillation_criterion.state_dict())
+        self._jobs.put((self._write, (state,)))
+
+    def record_validation(self, epoch: int, loss: float):
+        """Records the validation loss of the model at the end of the given epoch, to keep its checkpoint if it is the
+        best. It may be recorded before or after the checkpoint is saved."""
+        self._check_error()
+        self._jobs.put((self._record_validation, (epoch, float(loss))))
+
+    def close(self):
+        """Waits for the checkpoints to be saved, and raises any error from the background thread."""
+        self._jobs.put(None)
+        self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Saving a checkpoint failed') from self._error
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if self._error is not None:
+                # Keep taking jobs, so that the training thread is not blocked before it sees the error.
+                continue
+            function, args = job
+            try:
+                function(*args)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, state: dict):
+        epoch = state['epoch']
+        path = os.path.join(self._directory, 'model_epoch_{}.pt'.format(epoch))
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if self._run is not None:
+            self._run.add_artifact(path, 'model_epoch_{}'.format(epoch))
+        self._delete_old_checkpoints()
+
+    def _record_validation(self, epoch: int, loss: float):
+        self._validation_losses[epoch] = loss
+        manifest_path = os.path.join(self._directory, self._MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump({'validation_losses': self._validation_losses}, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self._delete_old_checkpoints()
+
+    def _read_manifest(self) -> Dict[int, float]:
+        manifest_path = os.path.join(self._directory, self._MANIFEST)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as file:
+            return {int(epoch): loss for epoch, loss in json.load(file)['validation_losses'].items()}
+
+    def _delete_old_checkpoints(self):
+        checkpoints = list_checkpoints(self._directory)
+        keep = set(epoch for epoch, _ in checkpoints[-self._keep_last:])
+        validated = [epoch for epoch, _ in checkpoints if epoch in self._validation_losses]
+        if validated:
+            keep.add(min(validated, key=lambda epoch: self._validation_losses[epoch]))
+        for epoch, path in checkpoints:
+            if epoch not in keep:
+                os.remove(path)
+
+
+def _copy_to_cpu(value):
+    """Returns a copy of a state dict with every tensor copied to the CPU, so it does not change as training continues."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: _copy_to_cpu(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_to_cpu(item) for item in value)
+    return value
+
+
+def list_checkpoints(directory: str) -> [Tuple[int, str]]:
+    """Returns (epoch, path) of each checkpoint saved by CheckpointStore in the directory, in order of epoch."""
+    checkpoints = []
+    for path in glob.glob(os.path.join(directory, 'model_epoch_*.pt')):
+        match = re.fullmatch(r'model_epoch_(\d+)\.pt', os.path.basename(path))
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def get_checkpoint_path(path: str) -> str:
+    """Returns the path of the checkpoint file, given either the file or a CheckpointStore directory, for its latest
+    checkpoint."""
+    if not os.path.isdir(path):
+        return path
+    checkpoints = list_checkpoints(path)
+    assert checkpoints, f'No checkpoints in {path}'
+    return checkpoints[-1][1]
@@ -2,6 +2,7 @@
 
 import glob
 import os
+import re
 from functools import lru_cache
 
 import numpy as np
@@ -11,6 +12,55 @@ from PIL import Image
 from torch.utils.data import Dataset
 
 
+# We pre-train the network on ImageNet, so we normalize the dataset to match that.
+# See: https://pytorch.org/docs/master/torchvision/models.html
+IMAGENET_MEAN = np.reshape([0.485, 0.456, 0.406], (3, 1, 1))
+IMAGENET_STD = np.reshape([0.229, 0.224, 0.225], (3, 1, 1))
+
+
+def normalize_image(image: np.ndarray) -> np.ndarray:
+    """Converts an 8-bit RGB image, H x W x channel, to the normalized channel x H x W float32 input of the model."""
+    assert image.ndim == 3 and image.shape[2] == 3, f'Expected an H x W x 3 image, got shape {image.shape}'
+    # We load the images as H x W x channel, but we need channel x H x W.
+    image_array = np.transpose(np.asarray(image, dtype=np.float32), (2, 0, 1))
+
+    # Rescale the image using imagenet stats
+    image_array /= 255.0
+    image_array -= IMAGENET_MEAN
+    image_array /= IMAGENET_STD
+    return image_array
+
+
+# The Cityscapes labelId of each trainId, see cityscapesscripts/helpers/labels.py. Other trainIds, including the ignored
+# 255, are mapped to 0, unlabeled.
+TRAIN_ID_TO_LABEL_ID = np.zeros(256, dtype=np.uint8)
+TRAIN_ID_TO_LABEL_ID[:19] = [7, 8, 11, 12, 13, 17, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 31, 32, 33]
+
+
+def encode_disparity(depth: np.ndarray) -> np.ndarray:
+    """Returns the uint16 Cityscapes disparity PNG encoding of depth, the inverse of CityscapesDataset._get_depth.
+
+    Values which are not positive are encoded as 0, which is invalid.
+    """
+    disparity = np.round(np.asarray(depth, dtype=np.float64) * 8 * 256 + 1)
+    return np.where(depth > 0, np.clip(disparity, 1, np.iinfo(np.uint16).max), 0).astype(np.uint16)
+
+
+def find_image_files(root_dir: str) -> [str]:
+    """Returns the paths of the {city}_{seq}_{frame}_leftImg8bit.png images under root_dir, sorted by city, sequence
+    and frame."""
+    paths = glob.glob(os.path.join(root_dir, '**', '*_leftImg8bit.png'), recursive=True)
+
+    def _key(path):
+        # Anchored at the end, as city names may contain underscores.
+        match = re.match(r'(.+)_(\d+)_(\d+)_leftImg8bit\.png$', os.path.basename(path))
+        assert match is not None, f'{path} is not named {{city}}_{{seq}}_{{frame}}_leftImg8bit.png'
+        city, sequence, frame = match.groups()
+        return city, int(sequence), int(frame)
+
+    return sorted(paths, key=_key)
+
+
 class NoopTransform(object):
     """A transform that returns the original image unmodified."""
 
@@ -142,7 +192,8 @@ class CityscapesDataset(Dataset):
                 if ext == '.png':
                     file_prefixes.add(CityscapesDataset._get_file_prefix(path, file))
 
-        return list(file_prefixes)
+        # Sort, so the index of each file is the same every time, e.g. for cached features.
+        return sorted(file_prefixes)
 
     @staticmethod
     def _get_file_prefix(directory: str, file_name: str) -> str:
@@ -155,17 +206,32 @@ class CityscapesDataset(Dataset):
     def __getitem__(self, index: int):
         self._check_available_memory()
 
+        image_array = self.get_image(index)
+        targets = self.get_targets(index)
+
+        if index == 0:
+            self._print_cache_info()
+
+        return self._transform([image_array] + targets)
+
+    def get_image(self, index: int):
+        """Returns the image of the sample at the given index, without applying the transform."""
         index, crop_left = self._convert_index(index)
+        return self._cached_get_image(index, crop_left)
 
-        image_array = self._cached_get_image(index, crop_left)
+    def get_targets(self, index: int) -> list:
+        """Returns [labels, instance_vecs, instance_mask, depth, depth_mask] of the sample at the given index, without
+        applying the transform."""
+        index, crop_left = self._convert_index(index)
         label_array = self._cached_get_labels(index, crop_left)
         instance_vecs, instance_mask = self._cached_get_instances(index, crop_left)
         depth_array, depth_mask = self._cached_get_depth(index, crop_left)
+        return [label_array, instance_vecs, instance_mask, depth_array, depth_mask]
 
-        if index == 0:
-            self._print_cache_info()
-
-        return self._transform([image_array, label_array, instance_vecs, instance_mask, depth_array, depth_mask])
+    def get_index_key(self) -> str:
+        """Returns a string which identifies the images at each index, so changes to the dataset can be detected."""
+        file_prefixes = [os.path.relpath(prefix, self._root_dir) for prefix in self._file_prefixes]
+        return 'minute={};{}'.format(self._minute, ','.join(file_prefixes))
 
     def _check_available_memory(self):
         if self._min_available_memory_gb == 0:
@@ -202,22 +268,9 @@ class CityscapesDataset(Dataset):
         return _wrapper
 
     def _get_image(self, index: int, crop_left: bool):
-        # We pre-train the network on ImageNet, so we normalize the dataset to match that.
-        # See: https://pytorch.org/docs/master/torchvision/models.html
-        imagenet_mean = np.reshape([0.485, 0.456, 0.406], (3, 1, 1))
-        imagenet_std = np.reshape([0.229, 0.224, 0.225], (3, 1, 1))
-
         image_file = self._get_file_path_for_index(index, 'leftImg8bit')
         image = self._convert_to_minute_if_enabled(Image.open(image_file), crop_left)
-        image_array = np.asarray(image, dtype=np.float32)
-
-        # We load the images as H x W x channel, but we need channel x H x W.
-        image_array = np.transpose(image_array, (2, 0, 1))
-
-        # Rescale the image using imagenet stats
-        image_array /= 255.0
-        image_array -= imagenet_mean
-        image_array /= imagenet_std
+        image_array = normalize_image(np.asarray(image))
 
         assert len(image_array.shape) == 3, 'image_array should have 3 dimensions' + image_file
         return image_array
@@ -376,10 +429,12 @@ def compute_centroid_vectors(instance_image: np.ndarray):
     return vecs, mask
 
 
-def get_loader_from_dir(root_dir: str, config, transform=NoopTransform()):
+def get_loader_from_dir(root_dir: str, config, transform=NoopTransform(), multiprocessing_context=None):
     """Creates a DataLoader for Cityscapes from the given root directory.
 
     Will load any data file in any sub directory under the root directory.
+
+    :param multiprocessing_context How to start the config['dataloader_workers'] worker processes, see DataLoader.
     """
     num_workers = config['dataloader_workers']
     enable_cache = config['dataloader_cache']
@@ -387,7 +442,8 @@ def get_loader_from_dir(root_dir: str, config, transform=NoopTransform()):
 
     dataset = CityscapesDataset(root_dir, transform=transform, enable_cache=enable_cache,
                                 min_available_memory_gb=config['min_available_memory_gb'], minute=config['minute'])
-    return torch.utils.data.DataLoader(dataset, batch_size=config['batch_size'], num_workers=num_workers, shuffle=True)
+    return torch.utils.data.DataLoader(dataset, batch_size=config['batch_size'], num_workers=num_workers, shuffle=True,
+                                       multiprocessing_context=multiprocessing_context if num_workers > 0 else None)
 
 
 if __name__ == '__main__':
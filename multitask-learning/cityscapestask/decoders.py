@@ -2,64 +2,127 @@
 
 import torch
 import torch.nn.functional as F
-from torch import nn
+from torch import Tensor, nn
 
+from cityscapestask.upsampling import interpolate_region, row_tiles
 
-def _build_base_decoder():
+
+# The name of each task, in the order of the outputs.
+TASKS = ('semantic', 'instance', 'depth')
+
+
+def _build_base_decoder(in_channels: int, channels: int):
     """Builds the base decoder shared by all three decoder types."""
-    return nn.Sequential(nn.Conv2d(in_channels=1280, out_channels=256, kernel_size=(3, 3), stride=1, padding=1),
-                         nn.BatchNorm2d(num_features=256), nn.ReLU())
+    return nn.Sequential(nn.Conv2d(in_channels=in_channels, out_channels=channels, kernel_size=(3, 3), stride=1,
+                                   padding=1),
+                         nn.BatchNorm2d(num_features=channels), nn.ReLU())
 
 
 class Decoders(nn.Module):
     """Module which contains all three decoders."""
 
-    def __init__(self, num_classes: int, enabled_tasks: (bool, bool, bool), output_size=(128, 256)):
+    def __init__(self, num_classes: int, enabled_tasks: (bool, bool, bool), output_size=(128, 256), in_channels=1280,
+                 channels=256):
+        """Creates a new instance.
+
+        :param in_channels The number of channels output by the encoder.
+        :param channels The number of channels in the base of each decoder.
+        """
         super().__init__()
         self._output_size = output_size
         self._num_classes = num_classes
         self._enabled_tasks = enabled_tasks
 
-        self._base_semseg = _build_base_decoder()
-        self._base_insseg = _build_base_decoder()
-        self._base_depth = _build_base_decoder()
+        self._base_semseg = _build_base_decoder(in_channels, channels)
+        self._base_insseg = _build_base_decoder(in_channels, channels)
+        self._base_depth = _build_base_decoder(in_channels, channels)
 
         kernel_size = (1, 1)
-        self._semsegcls = nn.Conv2d(256, self._num_classes, kernel_size)
-        self._inssegcls = nn.Conv2d(256, 2, kernel_size)
-        self._depthcls = nn.Conv2d(256, 1, kernel_size)
+        self._semsegcls = nn.Conv2d(channels, self._num_classes, kernel_size)
+        self._inssegcls = nn.Conv2d(channels, 2, kernel_size)
+        self._depthcls = nn.Conv2d(channels, 1, kernel_size)
 
     def set_output_size(self, size):
+        """Sets the size to upsample the outputs to. If None, the outputs are returned without upsampling."""
         self._output_size = size
 
+    def _upsample(self, x):
+        if self._output_size is None:
+            return x
+        return F.interpolate(x, size=self._output_size, mode='bilinear', align_corners=True)
+
     def forward(self, x):
         """Returns (sem seg, instance seg, depth)."""
-        # x: [batch x 1280 x H/8 x W/8]
-
-        sem_seg_enabled, inst_seg_enabled, depth_enabled = self._enabled_tasks
-
-        if sem_seg_enabled:
-            x1 = self._base_semseg(x)
-            x1 = self._semsegcls(x1)
-            x1 = F.interpolate(x1, size=self._output_size, mode='bilinear', align_corners=True)
-        else:
-            x1 = None
-
-        if inst_seg_enabled:
-            x2 = self._base_insseg(x)
-            x2 = self._inssegcls(x2)
-            x2 = F.interpolate(x2, size=self._output_size, mode='bilinear', align_corners=True)
+        # x: [batch x in_channels x H/output stride x W/output stride]
+        return tuple(self.forward_task(x, task) if enabled else None
+                     for task, enabled in zip(TASKS, self._enabled_tasks))
+
+    def forward_task(self, x, task: str):
+        """Returns the output of the decoder for the given task, one of TASKS, whether or not it is enabled."""
+        return self._upsample(self._forward_task_at_stride(x, task))
+
+    def forward_lazy(self, x, tasks: [str] = None) -> 'LazyOutputs':
+        """Returns the outputs of the given tasks, or of the enabled tasks if None, at the output stride, to be upsampled
+        to the output size only as needed. For inference."""
+        if tasks is None:
+            tasks = [task for task, enabled in zip(TASKS, self._enabled_tasks) if enabled]
+        outputs = {task: self._forward_task_at_stride(x, task) for task in tasks}
+        # Without an output size, the outputs are used as they are.
+        return LazyOutputs(outputs, self._output_size or x.shape[-2:])
+
+    def _forward_task_at_stride(self, x, task: str):
+        if task == 'semantic':
+            base, classifier = self._base_semseg, self._semsegcls
+        elif task == 'instance':
+            base, classifier = self._base_insseg, self._inssegcls
+        elif task == 'depth':
+            base, classifier = self._base_depth, self._depthcls
         else:
-            x2 = None
-
-        if depth_enabled:
-            x3 = self._base_depth(x)
-            x3 = self._depthcls(x3)
-            x3 = F.interpolate(x3, size=self._output_size, mode='bilinear', align_corners=True)
-        else:
-            x3 = None
-
-        return x1, x2, x3
+            raise ValueError(f'Unknown task {task}, expected one of {TASKS}')
+        return classifier(base(x))
+
+
+class LazyOutputs:
+    """Outputs of Decoders at the output stride, which are bilinearly upsampled to the output size only on demand.
+
+    Upsampling all of the outputs to full resolution takes much more time and memory than the decoders themselves, so
+    this avoids it when only some heads, a region, a smaller preview, or the semantic class map are needed.
+    """
+
+    def __init__(self, outputs: {str: Tensor}, output_size: (int, int)):
+        self._outputs = outputs
+        self.output_size = tuple(output_size)
+
+    @property
+    def tasks(self) -> [str]:
+        return list(self._outputs)
+
+    def at_stride(self, task: str) -> Tensor:
+        """Returns the output of the task without upsampling."""
+        return self._outputs[task]
+
+    def upsample(self, task: str, rows: (int, int) = None, cols: (int, int) = None, size: (int, int) = None) -> Tensor:
+        """Returns the output of the task upsampled to size, or to the output size if None, as Decoders.forward would.
+
+        :param rows (start, end) of the rows of the upsampled output to compute, or None for all rows.
+        :param cols (start, end) of the columns of the upsampled output to compute, or None for all columns.
+        """
+        size = self.output_size if size is None else tuple(size)
+        return interpolate_region(self._outputs[task], size, rows or (0, size[0]), cols)
+
+    def class_map(self, rows: (int, int) = None, cols: (int, int) = None, size: (int, int) = None,
+                  tile_rows=64) -> Tensor:
+        """Returns the argmax of the upsampled semantic output as uint8 [batch x rows x cols], see upsample.
+
+        The logits are upsampled tile_rows rows at a time, so the full resolution logits never exist at once.
+        """
+        logits = self._outputs['semantic']
+        assert logits.shape[1] <= 256, f'{logits.shape[1]} classes do not fit in uint8'
+        size = self.output_size if size is None else tuple(size)
+        rows = rows or (0, size[0])
+        tiles = [(rows[0] + start, rows[0] + end) for start, end in row_tiles(rows[1] - rows[0], tile_rows)]
+        return torch.cat([interpolate_region(logits, size, tile, cols).argmax(dim=1).to(torch.uint8)
+                          for tile in tiles], dim=1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+"""Distils the outputs of a larger teacher MultitaskLearner into a student, in addition to the usual task losses.
+
+The student is trained on the soft labels of the teacher's semantic logits with a KL divergence, and to match the
+teacher's instance and depth outputs with L1. These distillation losses are weighted by their own learned uncertainty,
+or fixed weights, in the same way as the task losses.
+
+The teacher's outputs are used at the output stride, and upsampled in the loss. This is what the teacher does itself,
+so caching the low resolution outputs, see feature_cache, loses nothing but fp16 precision.
+"""
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+from cityscapestask.losses import MultiTaskLoss
+from cityscapestask.model import MultitaskLearner
+
+
+def compute_teacher_outputs(teacher: MultitaskLearner, images: Tensor) -> Tensor:
+    """Returns the outputs of the teacher at the output stride, concatenated: [batch x num classes + 3 x h x w]."""
+    teacher.set_output_size(None)
+    with torch.no_grad():
+        return torch.cat(teacher(images), dim=1)
+
+
+def split_teacher_outputs(teacher_outputs: Tensor, num_classes: int) -> (Tensor, Tensor, Tensor):
+    """Splits the result of compute_teacher_outputs into (sem seg, instance seg, depth)."""
+    return torch.split(teacher_outputs, [num_classes, 2, 1], dim=1)
+
+
+class DistillationLoss(nn.Module):
+    """Adds the weighted distillation losses to the total of the given MultiTaskLoss."""
+
+    def __init__(self, criterion: MultiTaskLoss, distillation_criterion: MultiTaskLoss, temperature=1.0):
+        """Creates a new instance.
+
+        :param criterion The loss against the ground truth.
+        :param distillation_criterion Weights the distillation losses, using calculate_total_loss. Its enabled tasks
+        should match criterion.
+        :param temperature The temperature of the softmax of both the student and teacher semantic logits.
+        """
+        super().__init__()
+        self.criterion = criterion
+        self.distillation_criterion = distillation_criterion
+        self.temperature = temperature
+
+    def forward(self, predicted, teacher_outputs: Tensor, *target) -> (Tensor, (float, float, float),
+                                                                          (float, float, float)):
+        """Returns (total loss, the task losses, the distillation losses).
+
+        :param predicted The outputs of the student, upsampled to the target size.
+        :param teacher_outputs From compute_teacher_outputs.
+        :param target As for MultiTaskLoss.
+        """
+        total_loss, task_losses = self.criterion(predicted, *target)
+
+        sem_seg_pred, instance_pred, depth_pred = predicted
+        _, _, instance_mask, _, depth_mask = target
+        teacher_outputs = F.interpolate(teacher_outputs.float(), size=target[0].shape[-2:], mode='bilinear',
+                                        align_corners=True)
+        sem_seg_teacher, instance_teacher, depth_teacher = split_teacher_outputs(teacher_outputs,
+                                                                                 teacher_outputs.shape[1] - 3)
+
+        sem_enabled, inst_enabled, depth_enabled = self.criterion.enabled_tasks
+        sem_seg_loss = self._soft_label_loss(sem_seg_pred, sem_seg_teacher) if sem_enabled else None
+        inst_seg_loss = self.criterion.inst_seg_loss(instance_pred, instance_teacher,
+                                                     instance_mask) if inst_enabled else None
+        depth_loss = self.criterion.depth_loss(depth_pred, depth_teacher.squeeze(1),
+                                               depth_mask) if depth_enabled else None
+
+        distillation_loss = self.distillation_criterion.calculate_total_loss(sem_seg_loss, inst_seg_loss, depth_loss)
+        distillation_losses = tuple(loss.item() if loss is not None else 0
+                                    for loss in (sem_seg_loss, inst_seg_loss, depth_loss))
+        return total_loss + distillation_loss, task_losses, distillation_losses
+
+    def _soft_label_loss(self, sem_seg_pred: Tensor, sem_seg_teacher: Tensor) -> Tensor:
+        """Returns the mean over pixels of KL(teacher || student), scaled by temperature^2 as in Hinton et al."""
+        student_log_probs = F.log_softmax(sem_seg_pred / self.temperature, dim=1)
+        teacher_log_probs = F.log_softmax(sem_seg_teacher / self.temperature, dim=1)
+        kl = F.kl_div(student_log_probs, teacher_log_probs, reduction='none', log_target=True).sum(dim=1)
+        return kl.mean() * self.temperature ** 2
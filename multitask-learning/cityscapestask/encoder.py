@@ -3,17 +3,24 @@
 This is based of the PyTorch torchvision implementation of ResNet101:
 https://github.com/pytorch/vision/blob/master/torchvision/models/resnet.py
 with an additional ASPP module rather than the final pooling and fully connected layers.
+Lighter backbones are also available: ResNet-18/34 and MobileNetV2, based on
+https://github.com/pytorch/vision/blob/master/torchvision/models/mobilenet.py
+Each backbone keeps the parameter names of the torchvision implementation, so the ImageNet weights can be loaded.
 
 See PYTORCH_LICENSE for the license for the PyTorch code partially reproduced below.
 """
+from abc import ABC, abstractmethod
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
-_LAYER_BLOCKS = {
-    'resnet101': [3, 4, 23, 3],
-    'resnet50': [3, 4, 6, 3],
+# For each output stride: ((layer3 stride, layer3 dilation), (layer4 stride, layer4 dilation)).
+# The ASPP dilations are given for output stride 8, and are scaled down by the same factor as the stride increases.
+_OUTPUT_STRIDE_LAYERS = {
+    8: ((1, 2), (1, 4)),
+    16: ((2, 1), (1, 2)),
 }
 
 
@@ -26,6 +33,42 @@ def conv1x1(in_planes, out_planes, stride=1):
     return nn.Conv2d(in_planes, out_planes, kernel_size=1, stride=stride, bias=False)
 
 
+class AtrousBasicBlock(nn.Module):
+    """Basic ResNet Module, as used by ResNet-18 and ResNet-34, with the added option to use atrous (dilated)
+    convolution for both 3x3 convolutions, given by the dilation parameter.
+    """
+    expansion = 1
+
+    def __init__(self, inplanes, planes, stride=1, downsample=None, dilation=1):
+        super(AtrousBasicBlock, self).__init__()
+        self.dilation = dilation
+        self.conv1 = conv3x3(inplanes, planes, stride, dilation)
+        self.bn1 = nn.BatchNorm2d(planes)
+        self.conv2 = conv3x3(planes, planes, dilation=dilation)
+        self.bn2 = nn.BatchNorm2d(planes)
+        self.relu = nn.ReLU(inplace=True)
+        self.downsample = downsample
+        self.stride = stride
+
+    def forward(self, x):
+        identity = x
+
+        out = self.conv1(x)
+        out = self.bn1(out)
+        out = self.relu(out)
+
+        out = self.conv2(out)
+        out = self.bn2(out)
+
+        if self.downsample is not None:
+            identity = self.downsample(x)
+
+        out += identity
+        out = self.relu(out)
+
+        return out
+
+
 class AtrousBottleneck(nn.Module):
     """Bottleneck ResNet Module, with the added option to use atrous (dilated) convolution
     for the 3x3 convolution, given by the dilation parameter.
@@ -69,31 +112,38 @@ class AtrousBottleneck(nn.Module):
 
 
 class ASPP(nn.Module):
-    """Atrous Spatial Pyramid Pooling module as described for DeeplabV3 with output_stride = 8
+    """Atrous Spatial Pyramid Pooling module as described for DeeplabV3
 
-    It applies, in parallel: one 1x1 convolution, three 3x3 convolutions with dilation = 12,24,36. All have
+    It applies, in parallel: one 1x1 convolution, three 3x3 convolutions with dilation = 12,24,36 at output_stride = 8
+    or 6,12,18 at output_stride = 16. All have
     out_channels=256. These are concatenated with the feature map convolved down to 256 channels by a 1x1 convolution.
+    Lighter backbones use fewer channels.
     """
 
-    def __init__(self, dilations: (int, int, int)):
+    def __init__(self, dilations: (int, int, int), in_channels=2048, channels=256):
+        """Creates a new instance.
+
+        :param in_channels The number of channels output by the backbone.
+        :param channels The number of channels output by each of the five branches.
+        """
         super().__init__()
 
         assert len(dilations) == 3
         assert all([dilation > 0 for dilation in dilations])
 
-        self.conv1 = conv1x1(2048, 256)
-        self.conv2 = conv3x3(2048, 256, dilation=dilations[0])
-        self.conv3 = conv3x3(2048, 256, dilation=dilations[1])
-        self.conv4 = conv3x3(2048, 256, dilation=dilations[2])
+        self.conv1 = conv1x1(in_channels, channels)
+        self.conv2 = self._atrous_conv(in_channels, channels, dilation=dilations[0])
+        self.conv3 = self._atrous_conv(in_channels, channels, dilation=dilations[1])
+        self.conv4 = self._atrous_conv(in_channels, channels, dilation=dilations[2])
 
         # Operations for last feature map
         self.gap = nn.AdaptiveAvgPool2d((1, 1))
-        self.conv = conv1x1(2048, 256)
-        self.bn1 = nn.BatchNorm2d(256)
-        self.bn2 = nn.BatchNorm2d(256)
-        self.bn3 = nn.BatchNorm2d(256)
-        self.bn4 = nn.BatchNorm2d(256)
-        self.bn5 = nn.BatchNorm2d(256)
+        self.conv = conv1x1(in_channels, channels)
+        self.bn1 = nn.BatchNorm2d(channels)
+        self.bn2 = nn.BatchNorm2d(channels)
+        self.bn3 = nn.BatchNorm2d(channels)
+        self.bn4 = nn.BatchNorm2d(channels)
+        self.bn5 = nn.BatchNorm2d(channels)
 
     def forward(self, x):
         # x is feature map
@@ -108,8 +158,74 @@ class ASPP(nn.Module):
         out = torch.cat((out1, out2, out3, out4, out5), dim=1)
         return out
 
+    @staticmethod
+    def _atrous_conv(in_channels, out_channels, dilation):
+        return conv3x3(in_channels, out_channels, dilation=dilation)
+
+
+class SeparableASPP(ASPP):
+    """ASPP where each atrous 3x3 convolution is depthwise separable, as in DeeplabV3+.
+
+    Each atrous branch applies a depthwise dilated 3x3 convolution, batch norm and ReLU, then a pointwise 1x1
+    convolution. This is a drop in replacement for ASPP, with far fewer multiply-adds on the wide backbone output.
+    """
+
+    @staticmethod
+    def _atrous_conv(in_channels, out_channels, dilation):
+        depthwise = nn.Conv2d(in_channels, in_channels, kernel_size=3, dilation=dilation, padding=dilation,
+                              groups=in_channels, bias=False)
+        return nn.Sequential(depthwise, nn.BatchNorm2d(in_channels), nn.ReLU(inplace=True),
+                             conv1x1(in_channels, out_channels))
 
-class Encoder(nn.Module):
+
+_ASPP_TYPES = {
+    'standard': ASPP,
+    'separable': SeparableASPP,
+}
+
+
+class _ASPPEncoder(nn.Module, ABC):
+    """Base class for the encoders, which apply a backbone, then ASPP, with optional dropout.
+
+    Subclasses must create the aspp and dropout modules, and set out_channels to the number of channels output by ASPP.
+    """
+
+    def __init__(self, dropout: str):
+        super().__init__()
+        self.dropout_type = dropout
+
+    @abstractmethod
+    def forward_backbone(self, x):
+        """Returns the output of the last layer of the backbone, which is the input to ASPP."""
+
+    @abstractmethod
+    def get_stages(self) -> [(str, nn.Module)]:
+        """Returns (name, module) for each stage of the encoder, in order: stem, layer1 to layer4, then aspp.
+
+        The layers are the same for every backbone, so that they can be frozen by name, see freezing.FreezingSchedule.
+        """
+
+    def forward(self, x):
+        x = self.forward_to_dropout(x)
+        if self.dropout_type in ('after_layer_4', 'after_aspp'):
+            x = self.dropout(x)
+        return self.forward_from_dropout(x)
+
+    def forward_to_dropout(self, x):
+        """Returns the features which dropout is applied to, see dropout_type. Without dropout, the output of ASPP."""
+        x = self.forward_backbone(x)
+        if self.dropout_type != 'after_layer_4':
+            x = self.aspp(x)
+        return x
+
+    def forward_from_dropout(self, x):
+        """Returns the output of the encoder, given the output of forward_to_dropout with dropout applied."""
+        if self.dropout_type == 'after_layer_4':
+            x = self.aspp(x)
+        return x
+
+
+class Encoder(_ASPPEncoder):
     """
         https://pytorch.org/docs/stable/_modules/torchvision/models/resnet.html
         https://mc.ai/resnet-torchvision-bottlenecks-and-layers-not-as-they-seem/
@@ -117,25 +233,36 @@ class Encoder(nn.Module):
 
     """
 
-    def __init__(self, aspp_dilations: (int, int, int), resnet_type: str, dropout: str):
-        super().__init__()
-        self.dropout_type = dropout
+    def __init__(self, aspp_dilations: (int, int, int), resnet_type: str, dropout: str, output_stride=8,
+                 aspp_type='standard'):
+        """Creates a new instance.
+
+        :param aspp_dilations The dilations of the ASPP module at output stride 8. They are scaled for other strides.
+        :param output_stride The ratio of the input size to the output size, either 8 or 16.
+        :param aspp_type Either 'standard' or 'separable', see SeparableASPP.
+        """
+        super().__init__(dropout)
+        assert output_stride in _OUTPUT_STRIDE_LAYERS, f'Unsupported output stride {output_stride}'
         self.inplanes = 64
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
 
-        layer_blocks = _LAYER_BLOCKS[resnet_type]
+        block, layer_blocks, aspp_channels = _RESNET_LAYERS[resnet_type]
         assert len(layer_blocks) == 4
-        self.layer1 = self._make_layer(AtrousBottleneck, 64, layer_blocks[0])
-        self.layer2 = self._make_layer(AtrousBottleneck, 128, layer_blocks[1], stride=2)
-        # Dilation choices of 2 and 4
-        self.layer3 = self._make_layer(AtrousBottleneck, 256, layer_blocks[2], stride=1, dilation=2)
-        self.layer4 = self._make_layer(AtrousBottleneck, 512, layer_blocks[3], stride=1, dilation=4)
-
-        self.aspp = ASPP(aspp_dilations)
+        self.layer1 = self._make_layer(block, 64, layer_blocks[0])
+        self.layer2 = self._make_layer(block, 128, layer_blocks[1], stride=2)
+        # At output stride 8, dilation choices of 2 and 4. At 16, layer3 is strided and layer4 has dilation 2.
+        (layer3_stride, layer3_dilation), (layer4_stride, layer4_dilation) = _OUTPUT_STRIDE_LAYERS[output_stride]
+        self.layer3 = self._make_layer(block, 256, layer_blocks[2], stride=layer3_stride, dilation=layer3_dilation)
+        self.layer4 = self._make_layer(block, 512, layer_blocks[3], stride=layer4_stride, dilation=layer4_dilation)
+
+        self.aspp = _ASPP_TYPES[aspp_type]([dilation * 8 // output_stride for dilation in aspp_dilations],
+                                           in_channels=self.inplanes, channels=aspp_channels)
+        self.out_channels = aspp_channels * 5
         self.dropout = torch.nn.Dropout2d(p=0.5, inplace=False)
+
     # from torchvision.models.resnet.ResNet
     def _make_layer(self, block, planes, blocks, stride=1, dilation=1):
         downsample = None
@@ -155,7 +282,11 @@ class Encoder(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def get_stages(self) -> [(str, nn.Module)]:
+        return [('stem', nn.ModuleList([self.conv1, self.bn1])), ('layer1', self.layer1), ('layer2', self.layer2),
+                ('layer3', self.layer3), ('layer4', self.layer4), ('aspp', self.aspp)]
+
+    def forward_backbone(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -165,14 +296,122 @@ class Encoder(nn.Module):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
-        if self.dropout_type == 'after_layer_4':
-            x = self.dropout(x)
-        x = self.aspp(x)
-        if self.dropout_type == 'after_aspp':
-            x = self.dropout(x)
         return x
 
 
+class _ConvBNReLU(nn.Sequential):
+    def __init__(self, in_planes, out_planes, kernel_size=3, stride=1, groups=1, dilation=1):
+        padding = (kernel_size - 1) // 2 * dilation
+        super().__init__(
+            nn.Conv2d(in_planes, out_planes, kernel_size, stride, padding, dilation=dilation, groups=groups,
+                      bias=False),
+            nn.BatchNorm2d(out_planes), nn.ReLU6(inplace=True))
+
+
+class InvertedResidual(nn.Module):
+    """MobileNetV2 block: a pointwise expansion, a depthwise separable 3x3 convolution, and a linear pointwise
+    projection, with the added option to use atrous (dilated) convolution for the depthwise convolution.
+    """
+
+    def __init__(self, inplanes, planes, stride, expand_ratio, dilation=1):
+        super().__init__()
+        hidden_planes = int(round(inplanes * expand_ratio))
+        self.use_res_connect = stride == 1 and inplanes == planes
+
+        layers = []
+        if expand_ratio != 1:
+            layers.append(_ConvBNReLU(inplanes, hidden_planes, kernel_size=1))
+        layers.extend([
+            _ConvBNReLU(hidden_planes, hidden_planes, stride=stride, groups=hidden_planes, dilation=dilation),
+            nn.Conv2d(hidden_planes, planes, 1, bias=False),
+            nn.BatchNorm2d(planes)])
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, x):
+        if self.use_res_connect:
+            return x + self.conv(x)
+        else:
+            return self.conv(x)
+
+
+class MobileNetEncoder(_ASPPEncoder):
+    """MobileNetV2 backbone, without the final 1x1 convolution and classifier, followed by ASPP.
+
+    Once the output stride is reached, later strided blocks instead use dilated depthwise convolutions, as in DeeplabV3.
+    """
+
+    # (expand_ratio, planes, blocks, stride) for each group of blocks, from torchvision.models.MobileNetV2
+    _SETTINGS = [(1, 16, 1, 1), (6, 24, 2, 2), (6, 32, 3, 2), (6, 64, 4, 2), (6, 96, 3, 1), (6, 160, 3, 2),
+                 (6, 320, 1, 1)]
+    # The index in features of the first block of layer1 to layer4, which end at the same strides as the ResNet layers
+    # (4, 8, 16 and 32 without dilation).
+    _LAYER_STARTS = (1, 4, 7, 14)
+
+    def __init__(self, aspp_dilations: (int, int, int), backbone: str, dropout: str, output_stride=8,
+                 aspp_type='standard'):
+        super().__init__(dropout)
+        assert backbone == 'mobilenet_v2', f'Unknown MobileNet type {backbone}'
+        assert output_stride in _OUTPUT_STRIDE_LAYERS, f'Unsupported output stride {output_stride}'
+
+        inplanes = 32
+        features = [_ConvBNReLU(3, inplanes, stride=2)]
+        current_stride = 2
+        dilation = 1
+        for expand_ratio, planes, blocks, stride in self._SETTINGS:
+            if current_stride == output_stride:
+                dilation *= stride
+                stride = 1
+            current_stride *= stride
+
+            for i in range(blocks):
+                features.append(InvertedResidual(inplanes, planes, stride if i == 0 else 1, expand_ratio, dilation))
+                inplanes = planes
+        self.features = nn.Sequential(*features)
+
+        aspp_channels = 128
+        self.aspp = _ASPP_TYPES[aspp_type]([dilation * 8 // output_stride for dilation in aspp_dilations],
+                                           in_channels=inplanes, channels=aspp_channels)
+        self.out_channels = aspp_channels * 5
+        self.dropout = torch.nn.Dropout2d(p=0.5, inplace=False)
+
+    def get_stages(self) -> [(str, nn.Module)]:
+        bounds = (0,) + self._LAYER_STARTS + (len(self.features),)
+        names = ('stem', 'layer1', 'layer2', 'layer3', 'layer4')
+        return [(name, self.features[start:end]) for name, start, end in zip(names, bounds, bounds[1:])] + [
+            ('aspp', self.aspp)]
+
+    def forward_backbone(self, x):
+        return self.features(x)
+
+
+# For each ResNet: (block type, number of blocks in each layer, channels of each ASPP branch).
+_RESNET_LAYERS = {
+    'resnet101': (AtrousBottleneck, [3, 4, 23, 3], 256),
+    'resnet50': (AtrousBottleneck, [3, 4, 6, 3], 256),
+    'resnet34': (AtrousBasicBlock, [3, 4, 6, 3], 128),
+    'resnet18': (AtrousBasicBlock, [2, 2, 2, 2], 128),
+}
+
+# The encoder class for each backbone. All take (aspp_dilations, backbone, dropout, output_stride, aspp_type).
+_ENCODERS = {
+    'resnet101': Encoder,
+    'resnet50': Encoder,
+    'resnet34': Encoder,
+    'resnet18': Encoder,
+    'mobilenet_v2': MobileNetEncoder,
+}
+
+BACKBONES = tuple(_ENCODERS)
+
+
+def build_encoder(aspp_dilations: (int, int, int), backbone: str, dropout: str, output_stride=8,
+                  aspp_type='standard') -> _ASPPEncoder:
+    """Builds the encoder for the given backbone, which must be one of BACKBONES."""
+    assert backbone in _ENCODERS, f'Unknown backbone {backbone}, expected one of {BACKBONES}'
+    assert aspp_type in _ASPP_TYPES, f'Unknown ASPP type {aspp_type}'
+    return _ENCODERS[backbone](aspp_dilations, backbone, dropout, output_stride, aspp_type)
+
+
 if __name__ == '__main__':
     # ### Shape test
     model = Encoder()
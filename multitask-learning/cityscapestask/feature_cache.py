@@ -0,0 +1,209 @@
+"""Caches per-sample model outputs on disk, so that a frozen part of the model is only run once per sample.
+
+For example, when the encoder is frozen, its ASPP features are computed once for each sample and stored in a memory
+mapped fp16 array. The decoders can then be trained from the store without running the encoder again.
+
+Each store is a directory named by a key, containing:
+- features.npy: an fp16 array of shape [num samples x sample shape], memory mapped when read
+- metadata.json: describes the store, and is only written once the features are complete
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
+
+from cityscapestask.cityscapes import CityscapesDataset
+
+_FEATURES_FILE = 'features.npy'
+_METADATA_FILE = 'metadata.json'
+
+
+def hash_state_dict(state_dict) -> str:
+    """Returns a hash of the names and values of all the tensors in the given state dict."""
+    sha = hashlib.sha1()
+    for name in sorted(state_dict.keys()):
+        sha.update(name.encode())
+        sha.update(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def compute_key(*parts: str) -> str:
+    """Combines the given strings, e.g. hashes of the weights and the dataset index, into the key of a store."""
+    return hashlib.sha1('/'.join(parts).encode()).hexdigest()[:20]
+
+
+class FeatureStore(object):
+    """A complete store of features on disk, one per sample, read through a memory map.
+
+    The memory map is opened lazily, so that the store can be passed to DataLoader worker processes without copying
+    the features.
+    """
+
+    def __init__(self, path: str):
+        assert FeatureStore.exists(path), f'No complete feature store at {path}'
+        self._path = path
+        with open(os.path.join(path, _METADATA_FILE)) as file:
+            self.metadata = json.load(file)
+        self._features = None
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, _METADATA_FILE))
+
+    @staticmethod
+    def create(path: str, batches, num_samples: int, metadata: dict) -> 'FeatureStore':
+        """Creates a store at the given path from the given batches of features, and returns it.
+
+        The store is written to a temporary directory and renamed once complete, so an interrupted run never leaves
+        behind a store which looks complete.
+
+        :param batches Iterable of (sample indices, features) where features is [batch x sample shape].
+        """
+        parent_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.incomplete_')
+        try:
+            features = None
+            written = np.zeros(num_samples, dtype=np.bool_)
+            for indices, batch_features in batches:
+                batch_features = batch_features.detach().cpu().numpy().astype(np.float16)
+                if features is None:
+                    features = np.lib.format.open_memmap(os.path.join(temp_dir, _FEATURES_FILE), mode='w+',
+                                                         dtype=np.float16,
+                                                         shape=(num_samples,) + batch_features.shape[1:])
+                features[indices] = batch_features
+                written[indices] = True
+
+            assert features is not None and written.all(), 'Features were not computed for every sample'
+            features.flush()
+            del features
+
+            metadata = dict(metadata, num_samples=num_samples)
+            with open(os.path.join(temp_dir, _METADATA_FILE), 'w') as file:
+                json.dump(metadata, file)
+            os.rename(temp_dir, path)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        return FeatureStore(path)
+
+    def __len__(self):
+        return self.metadata['num_samples']
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        if self._features is None:
+            self._features = np.load(os.path.join(self._path, _FEATURES_FILE), mmap_mode='r')
+        return torch.from_numpy(self._features[index].astype(np.float32))
+
+    def __getstate__(self):
+        # Never pickle the memory map, which would copy all the features.
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+
+class _IndexedDataset(Dataset):
+    """Returns (index, image) for each sample of a CityscapesDataset, so stores can be computed in any order."""
+
+    def __init__(self, dataset: CityscapesDataset):
+        self._dataset = dataset
+
+    def __getitem__(self, index: int):
+        return index, self._dataset.get_image(index)
+
+    def __len__(self):
+        return len(self._dataset)
+
+
+class CachedFeatureDataset(Dataset):
+    """Returns the same samples as a CityscapesDataset without a transform, but with the image replaced by its
+    features from a FeatureStore."""
+
+    def __init__(self, store: FeatureStore, dataset: CityscapesDataset):
+        assert len(store) == len(dataset), f'Store has {len(store)} samples, dataset has {len(dataset)}'
+        self._store = store
+        self._dataset = dataset
+
+    def __getitem__(self, index: int):
+        return [self._store[index]] + self._dataset.get_targets(index)
+
+    def __len__(self):
+        return len(self._dataset)
+
+
+class AppendedFeatureDataset(Dataset):
+    """Returns the samples of the given dataset, with the features of each sample from a FeatureStore appended.
+
+    The dataset must return its samples in the order the store was computed in, so it must not be augmented.
+    """
+
+    def __init__(self, dataset: Dataset, store: FeatureStore):
+        assert len(store) == len(dataset), f'Store has {len(store)} samples, dataset has {len(dataset)}'
+        self._dataset = dataset
+        self._store = store
+
+    def __getitem__(self, index: int):
+        return list(self._dataset[index]) + [self._store[index]]
+
+    def __len__(self):
+        return len(self._dataset)
+
+
+def get_feature_store(cache_dir: str, compute_features, weights_key: str, dataset: CityscapesDataset,
+                      device, batch_size: int, log=print) -> FeatureStore:
+    """Returns the store of the features of every sample in the dataset, computing it if needed.
+
+    The store is keyed by weights_key and a hash of the dataset index, so a store is never reused after either changes.
+
+    :param compute_features Function from a batch of images on the device to their features, called without gradients.
+    :param weights_key Identifies the weights used by compute_features, e.g. from hash_state_dict.
+    """
+    key = compute_key(weights_key, dataset.get_index_key())
+    path = os.path.join(cache_dir, key)
+    if FeatureStore.exists(path):
+        log(f'Using cached features from {path}')
+        return FeatureStore(path)
+
+    log(f'Computing features for {len(dataset)} samples into {path}')
+
+    def _batches():
+        loader = DataLoader(_IndexedDataset(dataset), batch_size=batch_size, shuffle=False)
+        with torch.no_grad():
+            for indices, images in loader:
+                yield indices.numpy(), compute_features(images.to(device))
+
+    return FeatureStore.create(path, _batches(), len(dataset), metadata={'key': key})
+
+
+def get_encoder_feature_store(cache_dir: str, encoder: nn.Module, dataset: CityscapesDataset, device,
+                              batch_size: int, log=print) -> FeatureStore:
+    """Returns the store of the encoder's features for every sample in the dataset, computing it if needed.
+
+    The encoder is run in eval mode, so batch norm uses its running statistics and dropout is off.
+    """
+    was_training = encoder.training
+    encoder.eval()
+    try:
+        return get_feature_store(cache_dir, encoder, 'encoder/' + hash_state_dict(encoder.state_dict()), dataset,
+                                 device, batch_size, log=log)
+    finally:
+        encoder.train(was_training)
+
+
+def get_cached_loader(config, encoder: nn.Module, device, log=print) -> DataLoader:
+    """Creates a training DataLoader which returns the encoder's cached features in place of the images."""
+    assert not config['crop'] and not config['flip'], 'Cached encoder features can not be used with augmentation'
+
+    dataset = CityscapesDataset(config['root_dir_train'], enable_cache=config['dataloader_cache'],
+                                min_available_memory_gb=config['min_available_memory_gb'], minute=config['minute'])
+    store = get_encoder_feature_store(config['feature_cache_dir'], encoder, dataset, device, config['batch_size'],
+                                      log=log)
+    return DataLoader(CachedFeatureDataset(store, dataset), batch_size=config['batch_size'],
+                      num_workers=config['dataloader_workers'], shuffle=True)
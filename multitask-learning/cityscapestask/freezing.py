@@ -0,0 +1,85 @@
+"""Freezes stages of the encoder for part or all of training, e.g. the ImageNet pre-trained stem and early layers."""
+import torch
+from torch import nn
+
+STAGES = ('stem', 'layer1', 'layer2', 'layer3', 'layer4', 'aspp')
+
+
+class FreezingSchedule(object):
+    """Freezes the given stages of the learner's encoder until the given iteration.
+
+    Frozen parameters have requires_grad=False, so no gradient is computed for them, and as their grad stays None the
+    optimizer neither updates them nor creates state for them. MultitaskLearner.train keeps the batch norm layers of
+    frozen stages in eval mode, so their statistics do not change either.
+
+    Also records the time of each iteration, to report the time saved by freezing.
+    """
+
+    def __init__(self, learner: nn.Module, frozen_stages: [str], freeze_iterations: int):
+        """Creates a new instance.
+
+        :param frozen_stages Names of the stages to freeze, from STAGES.
+        :param freeze_iterations The iteration at which to unfreeze the stages, or -1 to freeze them throughout.
+        """
+        unknown = set(frozen_stages) - set(STAGES)
+        assert len(unknown) == 0, f'Unknown stages {unknown}, expected some of {STAGES}'
+
+        stages = dict(learner.encoder.get_stages())
+        self._frozen_modules = [stages[name] for name in frozen_stages]
+        self._freeze_iterations = freeze_iterations
+        self._learner = learner
+        self.frozen = False
+
+        self._iteration_seconds = {True: [], False: []}
+
+    def update(self, iteration: int) -> bool:
+        """Freezes or unfreezes the stages for the given iteration. Call before each iteration.
+
+        :return True if the stages were frozen or unfrozen.
+        """
+        frozen = len(self._frozen_modules) > 0 and (self._freeze_iterations == -1 or
+                                                    iteration < self._freeze_iterations)
+        if frozen == self.frozen:
+            return False
+
+        self.frozen = frozen
+        for module in self._frozen_modules:
+            for parameter in module.parameters():
+                parameter.requires_grad = not frozen
+        # Update which batch norm layers are in eval mode.
+        self._learner.train(self._learner.training)
+        return True
+
+    def record_iteration(self, seconds: float):
+        self._iteration_seconds[self.frozen].append(seconds)
+
+    def get_timing_summary(self) -> str:
+        """Returns the mean iteration time with and without the stages frozen, and the proportion saved."""
+        means = {frozen: sum(times) / len(times) for frozen, times in self._iteration_seconds.items() if times}
+        parts = [f'{"frozen" if frozen else "unfrozen"} {mean * 1000:.1f}ms over '
+                 f'{len(self._iteration_seconds[frozen])} iterations' for frozen, mean in means.items()]
+        if len(means) == 2:
+            parts.append(f'{(1 - means[True] / means[False]) * 100:.1f}% saved while frozen')
+        return 'Mean iteration time: ' + ', '.join(parts)
+
+
+def get_frozen_parameter_count(model: nn.Module) -> int:
+    return sum(parameter.numel() for parameter in model.parameters() if not parameter.requires_grad)
+
+
+if __name__ == '__main__':
+    # ### Freezing test
+    from cityscapestask.model import MultitaskLearner
+
+    test_learner = MultitaskLearner(num_classes=20, enabled_tasks=(True, True, True), loss_uncertainties=(1, 1, 1),
+                                    pre_train_encoder=False, aspp_dilations=(12, 24, 36), resnet_type='resnet18')
+    encoder = test_learner.encoder
+    schedule = FreezingSchedule(test_learner, ['stem', 'layer1'], freeze_iterations=2)
+    test_learner.train()
+    schedule.update(0)
+    assert not encoder.conv1.weight.requires_grad and not encoder.layer1[0].bn1.training
+    assert encoder.layer2[0].bn1.training
+    sum(output.sum() for output in test_learner(torch.zeros(2, 3, 64, 64))).backward()
+    assert encoder.conv1.weight.grad is None and encoder.layer2[0].conv1.weight.grad is not None
+    schedule.update(2)
+    assert encoder.conv1.weight.requires_grad and encoder.layer1[0].bn1.training
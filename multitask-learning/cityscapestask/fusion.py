@@ -0,0 +1,57 @@
+"""Folds batch norm into the preceding convolutions, for faster inference.
+
+In eval mode, batch norm is an affine transform per channel, so it can be merged into the weights and bias of the
+convolution before it. Each folded batch norm is replaced by nn.Identity, so the modules' forward methods are unchanged.
+"""
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from cityscapestask.encoder import ASPP, AtrousBasicBlock, AtrousBottleneck, Encoder
+
+# For modules which apply convolutions and batch norm layers held as attributes: the (conv, batch norm) attribute
+# name pairs. Convolutions and batch norm layers which follow each other in an nn.Sequential are found automatically.
+_CONV_BN_ATTRIBUTES = {
+    Encoder: [('conv1', 'bn1')],
+    AtrousBasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+    AtrousBottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    ASPP: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('conv4', 'bn4'), ('conv', 'bn5')],
+}
+
+
+def _fuse(conv: nn.Module, bn: nn.Module):
+    """Returns conv with bn folded into it. For an nn.Sequential, bn is folded into its last module."""
+    if isinstance(conv, nn.Sequential):
+        conv[-1] = _fuse(conv[-1], bn)
+        return conv
+    assert isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d), f'Can not fold {bn} into {conv}'
+    return fuse_conv_bn_eval(conv, bn)
+
+
+def fold_batch_norm(model: nn.Module) -> int:
+    """Folds every batch norm layer of the model which follows a convolution into it, in place.
+
+    The model must be in eval mode. Also makes ReLUs which follow a folded convolution in place, as there is no longer
+    a batch norm layer which needs their input for backward.
+
+    :return The number of batch norm layers folded.
+    """
+    assert not model.training, 'Batch norm can only be folded in eval mode'
+    folded = 0
+    for module in list(model.modules()):
+        for module_type, pairs in _CONV_BN_ATTRIBUTES.items():
+            if isinstance(module, module_type):
+                for conv_name, bn_name in pairs:
+                    setattr(module, conv_name, _fuse(getattr(module, conv_name), getattr(module, bn_name)))
+                    setattr(module, bn_name, nn.Identity())
+                    folded += 1
+
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+                    folded += 1
+                    if i + 2 < len(module) and isinstance(module[i + 2], (nn.ReLU, nn.ReLU6)):
+                        module[i + 2].inplace = True
+
+    return folded
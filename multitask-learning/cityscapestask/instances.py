@@ -0,0 +1,100 @@
+"""Extracts instances from the outputs of the semantic and instance heads, with tensor operations only.
+
+Each pixel of a thing class votes for the centroid it points to, by adding its predicted vector to its coordinates, in
+a coarse accumulator grid. The local maxima of the votes are the instance centres, and each thing pixel is assigned to
+the centre closest to the centroid it votes for. This replaces clustering every pixel with DBSCAN, and runs on the same
+device as the outputs, so can be used in validation as well as for inference.
+"""
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+# Train ids of the Cityscapes classes with instances: person, rider, car, truck, bus, train, motorcycle, bicycle.
+THING_CLASSES = tuple(range(11, 19))
+
+
+def find_centres(centroids: Tensor, size: (int, int), vote_stride=4, min_votes=16, nms_kernel=7,
+                 max_instances=100) -> Tensor:
+    """Returns [instances x 2] (row, column) of the centres voted for by the given centroids, most votes first.
+
+    :param centroids [pixels x 2] (row, column) that each pixel votes for.
+    :param size (height, width) of the image.
+    :param vote_stride The size in pixels of each cell of the accumulator grid.
+    :param min_votes The number of votes a centre needs.
+    :param nms_kernel A centre must have the most votes within this many cells.
+    """
+    grid_height, grid_width = -(-size[0] // vote_stride), -(-size[1] // vote_stride)
+    cells = torch.div(centroids, vote_stride, rounding_mode='floor').long()
+    inside = ((cells[:, 0] >= 0) & (cells[:, 0] < grid_height) & (cells[:, 1] >= 0) & (cells[:, 1] < grid_width))
+    cells = cells[inside]
+    votes = torch.bincount(cells[:, 0] * grid_width + cells[:, 1], minlength=grid_height * grid_width)
+    votes = votes.view(1, 1, grid_height, grid_width).float()
+
+    # Spread each vote over its neighbours, so that centres on the border between cells are not split in two.
+    smoothed = F.avg_pool2d(votes, 3, stride=1, padding=1, count_include_pad=False) * 9
+    is_peak = (smoothed == F.max_pool2d(smoothed, nms_kernel, stride=1, padding=nms_kernel // 2)) & (
+            smoothed >= min_votes)
+    peak_votes = smoothed[is_peak]
+    peak_cells = is_peak[0, 0].nonzero()
+    order = peak_votes.argsort(descending=True)[:max_instances]
+    return (peak_cells[order].float() + 0.5) * vote_stride
+
+
+def extract_instances(class_map: Tensor, instance_vectors: Tensor, thing_classes=THING_CLASSES, vote_stride=4,
+                      min_votes=16, nms_kernel=7, max_instances=100, max_distance=None,
+                      chunk_pixels=1 << 18) -> Tensor:
+    """Returns the instance id of each pixel, int64 [batch x H x W], from 1 in each image, or 0 for no instance.
+
+    :param class_map [batch x H x W] class of each pixel, e.g. the argmax of the semantic output, or
+    LazyOutputs.class_map.
+    :param instance_vectors [batch x 2 x H x W] output of the instance head, at the same size as class_map.
+    :param thing_classes The classes which have instances.
+    :param max_distance If not None, pixels whose centroid is further than this from every centre have no instance.
+    :param chunk_pixels The number of pixels to compare with the centres at once, to limit memory.
+    See find_centres for the other parameters.
+    """
+    batch_size, height, width = class_map.shape
+    rows, cols = torch.meshgrid(torch.arange(height, device=class_map.device),
+                                torch.arange(width, device=class_map.device), indexing='ij')
+    coordinates = torch.stack((rows, cols)).float()
+    things = torch.isin(class_map, torch.as_tensor(thing_classes, device=class_map.device))
+
+    instance_ids = torch.zeros((batch_size, height, width), dtype=torch.long, device=class_map.device)
+    for i in range(batch_size):
+        # [thing pixels x 2]
+        centroids = (instance_vectors[i].float() + coordinates).permute(1, 2, 0)[things[i]]
+        centres = find_centres(centroids, (height, width), vote_stride, min_votes, nms_kernel, max_instances)
+        if len(centres) == 0:
+            continue
+
+        ids = torch.empty(len(centroids), dtype=torch.long, device=class_map.device)
+        for start in range(0, len(centroids), chunk_pixels):
+            distances = torch.cdist(centroids[start:start + chunk_pixels], centres)
+            nearest_distances, nearest = distances.min(dim=1)
+            nearest = nearest + 1
+            if max_distance is not None:
+                nearest[nearest_distances > max_distance] = 0
+            ids[start:start + chunk_pixels] = nearest
+        instance_ids[i][things[i]] = ids
+    return instance_ids
+
+
+if __name__ == '__main__':
+    # ### Recovery test: perfect vectors for three cars, and a person, are split into exactly those instances.
+    import numpy as np
+
+    from cityscapestask.cityscapes import compute_centroid_vectors
+
+    test_instances = np.zeros((128, 256), dtype=np.float32)
+    test_classes = np.zeros((128, 256), dtype=np.int64)
+    for instance_id, (top, left, bottom, right, label) in enumerate(
+            [(10, 10, 60, 80, 13), (20, 100, 90, 180, 13), (70, 20, 120, 60, 13), (30, 200, 110, 240, 11)]):
+        test_instances[top:bottom, left:right] = 26000 + instance_id
+        test_classes[top:bottom, left:right] = label
+    test_vectors, _ = compute_centroid_vectors(test_instances)
+
+    result = extract_instances(torch.from_numpy(test_classes)[None], torch.from_numpy(test_vectors)[None])[0].numpy()
+    assert (result == 0).sum() == (test_classes == 0).sum()
+    for instance_id in range(26000, 26004):
+        assert len(np.unique(result[test_instances == instance_id])) == 1, f'{instance_id} was split'
+    assert len(np.unique(result)) == 5
@@ -2,32 +2,37 @@
 from typing import Union
 
 import torch
+import torch.nn.functional as F
 from torch import Tensor
 from torch import nn
 
+from cityscapestask.upsampling import interpolate_region, row_tiles
+from loss_weighting import UncertaintyWeighting, fixed_weighting, stack_losses
+
+# Classes that we don't care about are set to 255.
+_IGNORE_INDEX = 255
+
 
 class MultiTaskLoss(nn.Module):
     """Computes and combines the losses for the three tasks.
 
     Has two modes:
     1) 'fixed': the losses multiplied by fixed weights and summed
-    2) 'learned': we learn the losses, not implemented...
+    2) 'learned': the losses weighted by their learned uncertainty, see loss_weighting.UncertaintyWeighting
     """
 
     def __init__(self, loss_type, loss_uncertainties, enabled_tasks=(True, True, True)):
         """Creates a new instance.
 
         :param loss_type Either 'fixed' or 'learned'
-        :param loss_uncertainties A 3 tuple of (semantic seg uncertainty, instance seg uncertainty,
-        depth uncertainty). If 'fixed' then these should be floats, if 'learned' then they should be
-        torch Parameters.
+        :param loss_uncertainties If 'fixed', a 3 tuple of float weights for (semantic seg, instance seg, depth). If
+        'learned', the UncertaintyWeighting module of the model.
         """
         super().__init__()
 
-        assert len(loss_uncertainties) == 3
         assert len(enabled_tasks) == 3
-        assert ((loss_type == 'learned' and isinstance(loss_uncertainties[0], nn.parameter.Parameter)) or (
-                loss_type == 'fixed' and isinstance(loss_uncertainties[0], float)))
+        assert ((loss_type == 'learned' and isinstance(loss_uncertainties, UncertaintyWeighting)) or (
+                loss_type == 'fixed' and len(loss_uncertainties) == 3 and isinstance(loss_uncertainties[0], float)))
 
         self.loss_type = loss_type
         self.loss_uncertainties = loss_uncertainties
@@ -35,8 +40,7 @@ class MultiTaskLoss(nn.Module):
 
         self.l1_loss = nn.L1Loss(reduction='sum')
 
-        # Classes that we don't care about are set to 255.
-        self.cross_entropy = nn.CrossEntropyLoss(ignore_index=255)
+        self.cross_entropy = nn.CrossEntropyLoss(ignore_index=_IGNORE_INDEX)
 
     def sem_seg_loss(self, sem_seg_input, sem_seg_target):
         return self.cross_entropy(sem_seg_input, sem_seg_target)
@@ -68,33 +72,16 @@ class MultiTaskLoss(nn.Module):
         return mult_loss
 
     def calculate_total_loss(self, *losses):
-        sem_loss, inst_loss, depth_loss = losses
-        sem_uncertainty, inst_uncertainty, depth_uncertainty = self.loss_uncertainties
-        sem_enabled, inst_enabled, depth_enabled = self.enabled_tasks
-
-        loss = 0
+        device = next(loss.device for loss in losses if loss is not None)
+        losses = stack_losses(losses, device)
 
         if self.loss_type == 'fixed':
-            if sem_enabled:
-                loss += sem_uncertainty * sem_loss
-            if inst_enabled:
-                loss += inst_uncertainty * inst_loss
-            if depth_enabled:
-                loss += depth_uncertainty * depth_loss
-
+            return fixed_weighting(losses, self.loss_uncertainties, self.enabled_tasks)
         elif self.loss_type == 'learned':
-            if sem_enabled:
-                loss += torch.exp(-sem_uncertainty) * sem_loss + 0.5 * sem_uncertainty
-            if inst_enabled:
-                loss += 0.5 * (torch.exp(-inst_uncertainty) * inst_loss + inst_uncertainty)
-            if depth_enabled:
-                loss += 0.5 * (torch.exp(-depth_uncertainty) * depth_loss + depth_uncertainty)
-
+            return self.loss_uncertainties(losses, self.enabled_tasks)
         else:
             raise ValueError
 
-        return loss
-
     def forward(self, predicted, *target) -> (Union[Tensor, None], (float, float, float)):
         sem_seg_pred, instance_pred, depth_pred = predicted
         sem_seg_target, instance_target, instance_mask, depth_target, depth_mask = target
@@ -111,3 +98,98 @@ class MultiTaskLoss(nn.Module):
         depth_loss_item = depth_loss.item() if depth_loss is not None else 0
 
         return total_loss, (sem_seg_loss_item, inst_seg_loss_item, depth_loss_item)
+
+
+class _TiledUpsampleLoss(torch.autograd.Function):
+    """Sums a loss over the bilinear upsampling of x, computing the upsampled output one tile of rows at a time.
+
+    Neither the upsampled output nor any of the loss temporaries are kept for the backward pass. Instead, the backward
+    pass recomputes the upsampling for each tile, so peak memory is bounded by the size of a tile.
+    """
+
+    @staticmethod
+    def forward(ctx, tile_loss, output_size, tile_rows, x, *targets):
+        ctx.tile_loss = tile_loss
+        ctx.output_size = output_size
+        ctx.tile_rows = tile_rows
+        ctx.save_for_backward(x, *targets)
+
+        total = x.new_zeros(())
+        for rows in row_tiles(output_size[0], tile_rows):
+            upsampled = interpolate_region(x, output_size, rows)
+            total += tile_loss(upsampled, *[target[..., rows[0]:rows[1], :] for target in targets])
+        return total
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, *targets = ctx.saved_tensors
+
+        grad = torch.zeros_like(x)
+        for rows in row_tiles(ctx.output_size[0], ctx.tile_rows):
+            with torch.enable_grad():
+                tile_x = x.detach().requires_grad_()
+                upsampled = interpolate_region(tile_x, ctx.output_size, rows)
+                loss = ctx.tile_loss(upsampled, *[target[..., rows[0]:rows[1], :] for target in targets])
+                tile_grad, = torch.autograd.grad(loss, tile_x)
+            grad += tile_grad
+
+        return (None, None, None, grad * grad_output) + (None,) * len(targets)
+
+
+def _cross_entropy_sum(sem_seg_input, sem_seg_target):
+    return F.cross_entropy(sem_seg_input, sem_seg_target, ignore_index=_IGNORE_INDEX, reduction='sum')
+
+
+def _masked_l1_sum(regression_input, masked_target, mask):
+    return (regression_input * mask - masked_target).abs().sum()
+
+
+class TiledMultiTaskLoss(MultiTaskLoss):
+    """MultiTaskLoss which accepts the decoder outputs before they are upsampled, i.e. at the encoder's output stride.
+
+    The outputs are upsampled to the size of the targets and evaluated tile by tile, so the full resolution outputs
+    never exist in memory. The loss values and gradients are the same as MultiTaskLoss on upsampled outputs. If the
+    outputs already have the size of the targets, e.g. during validation, this behaves exactly as MultiTaskLoss.
+    """
+
+    def __init__(self, loss_type, loss_uncertainties, enabled_tasks=(True, True, True), tile_rows=64):
+        """Creates a new instance.
+
+        :param tile_rows The number of rows of the full resolution output to compute at once.
+        """
+        super().__init__(loss_type, loss_uncertainties, enabled_tasks)
+        self.tile_rows = tile_rows
+
+    def sem_seg_loss(self, sem_seg_input, sem_seg_target):
+        if sem_seg_input.shape[-2:] == sem_seg_target.shape[-2:]:
+            return super().sem_seg_loss(sem_seg_input, sem_seg_target)
+
+        num_labelled = (sem_seg_target != _IGNORE_INDEX).sum()
+        loss = _TiledUpsampleLoss.apply(_cross_entropy_sum, tuple(sem_seg_target.shape[-2:]), self.tile_rows,
+                                        sem_seg_input, sem_seg_target)
+        return loss / num_labelled.float()
+
+    def inst_seg_loss(self, instance_input, instance_target, instance_mask):
+        if instance_input.shape[-2:] == instance_target.shape[-2:]:
+            return super().inst_seg_loss(instance_input, instance_target, instance_mask)
+
+        return self._masked_l1_loss(instance_input, instance_target, instance_mask)
+
+    def depth_loss(self, depth_input, depth_target, depth_mask):
+        if depth_input.shape[-2:] == depth_target.shape[-2:]:
+            return super().depth_loss(depth_input, depth_target, depth_mask)
+
+        # Keep the channel dimension on the target rather than removing it from the input, as we upsample the input.
+        return self._masked_l1_loss(depth_input, depth_target.unsqueeze(1), depth_mask.unsqueeze(1))
+
+    def _masked_l1_loss(self, regression_input, regression_target, mask):
+        mask = mask.float()
+        target = regression_target.float() * mask
+
+        num_nonzero = torch.nonzero(target).size(0)
+        if num_nonzero == 0:
+            return regression_input.new_zeros(())
+
+        loss = _TiledUpsampleLoss.apply(_masked_l1_sum, tuple(target.shape[-2:]), self.tile_rows, regression_input,
+                                        target, mask)
+        return loss / num_nonzero
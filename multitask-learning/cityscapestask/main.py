@@ -40,9 +40,29 @@ def config():
     # When True, we will run one validation pass and then exit. We will not train. This is useful to validate a previous
     # experiment using restore_from_sacred_run below.
     validate_only = False
-    model_save_epochs = 0  # How frequently to checkpoint the model to Sacred. Set to 0 to disable saving the model.
+    # When True, validation runs in a separate process on a snapshot of the model, while training continues. Results
+    # are logged against the epoch of the snapshot when they arrive.
+    async_validation = False
+    model_save_epochs = 0  # How frequently to checkpoint the model. Set to 0 to disable saving the model.
+    # If not None, checkpoints are instead saved to this local directory on a background thread, so training does not
+    # wait for them. See checkpointing.CheckpointStore.
+    checkpoint_dir = None
+    # How many of the latest checkpoints to keep in checkpoint_dir, as well as the best by validation loss.
+    checkpoint_keep_last = 3
+    # When True, checkpoints saved to checkpoint_dir are also added to Sacred, from the background thread.
+    checkpoint_upload_to_sacred = False
+    # Checkpoints to validate in a single pass over the validation set, after which we exit without training. Each is
+    # either a sacred run id, to use its latest save, or the path to a saved model file. Empty to train as normal.
+    validate_checkpoints = []
     # Id of the sacred run to continue training on, or -1 to disable restoring.
     restore_sacred_run = -1
+    # Directory to cache the models downloaded from Sacred in, so each is only downloaded once, or None to download them
+    # into memory every time.
+    artifact_cache_dir = None
+    # Path to a checkpoint file, or a checkpoint_dir to use its latest checkpoint, to continue training from. None to
+    # disable restoring from a local checkpoint. A weights file, see scripts/convert_checkpoint.py, restores only the
+    # model, with a new optimizer.
+    restore_checkpoint = None
     use_adam = True
     # The learning rate used by Adam. Not used by SGD.
     learning_rate = 1e-3
@@ -61,17 +81,55 @@ def config():
     # Whether to augment the training data with random flipping.
     flip = False
     pre_train_encoder = True  # When true, will download weights for resnet pre-trained on imagenet.
+    # Directory to load the pre-trained weights from, or None for the PyTorch cache. Weights are only downloaded if they
+    # are not already in the directory, so copy them there to run offline. Weights converted there by
+    # scripts/convert_pretrained_weights.py are used in preference, as they load faster.
+    pretrained_weights_dir = None
     # If total available memory is lower than this threshold, we crash rather than loading more data.
     # This avoids using all the memory on the server and getting it stuck.
     # Set to 0 to disable the check.
     min_available_memory_gb = 0
+    # Stages of the encoder to freeze, from 'stem', 'layer1', 'layer2', 'layer3', 'layer4' and 'aspp'. Frozen stages
+    # are not trained, and their batch norm statistics are not updated, which saves backward time and optimizer memory.
+    freeze_encoder_layers = []
+    # The iteration at which to unfreeze freeze_encoder_layers, or -1 to freeze them throughout training.
+    freeze_encoder_iterations = -1
+    # When True, the batch norm statistics of the whole encoder are frozen throughout, e.g. for small batches.
+    freeze_bn = False
     # Size of the dilations in the atrous convolutions in ASPP module of the encoder. Paper default is (12, 24, 36).
+    # These are for output_stride = 8, and are scaled to match other output strides.
     aspp_dilations = (12, 24, 36)
+    # Ratio of the input size to the size of the encoder output, 8 or 16. 16 is much faster, but coarser.
+    output_stride = 8
+    # Either 'standard', or 'separable' to use depthwise separable atrous convolutions in ASPP, as in DeeplabV3+.
+    aspp_type = 'standard'
     # When True, use minute Cityscapes. This is downsampled to 64x128, then cropped in half to 64x64.
     minute = False
+    # Backbone of the encoder, one of 'resnet101', 'resnet50', 'resnet34', 'resnet18' or 'mobilenet_v2'.
     resnet_type = 'resnet101'
     # when None, no dropout is applied, other options are 'after_layer_4' and 'after_aspp'
     dropout = 'none'
+    # When True, the training loss upsamples the low resolution outputs of the decoders tile by tile, rather than the
+    # model upsampling them to full resolution. This bounds the memory used by the loss, and gives the same loss values.
+    tiled_loss = False
+    # The number of rows of the full resolution output in each tile, when tiled_loss is True.
+    tiled_loss_rows = 64
+    # Directory to cache the encoder output for each training image in, or None to disable the cache. When set, the
+    # encoder is frozen and only the decoders and loss weights are trained, from the cached features. Requires crop and
+    # flip to be False. The cache is recomputed whenever the encoder weights or the training images change.
+    feature_cache_dir = None
+    # Checkpoint of a teacher to distil into the model being trained, either a sacred run id or the path to a saved model
+    # file, or None to disable distillation. The teacher is built with this config, updated with
+    # distillation_teacher_config. Not supported with tiled_loss.
+    distillation_teacher = None
+    distillation_teacher_config = {'resnet_type': 'resnet101', 'output_stride': 8, 'aspp_type': 'standard'}
+    # Temperature of the softmax of the semantic logits, for the soft label loss.
+    distillation_temperature = 1.0
+    # The initial log variances of the distillation losses, or their weights when loss_type = 'fixed'.
+    distillation_loss_uncertainties = (1.0, 1.0, 1.0)
+    # Directory to cache the outputs of the teacher for each training image in, or None to run the teacher every
+    # iteration. Requires crop and flip to be False.
+    distillation_cache_dir = None
 
 
 @ex.named_config
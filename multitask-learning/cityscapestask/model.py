@@ -1,49 +1,319 @@
 """Contains the the complete PyTorch model."""
+import copy
+import os
+import time
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 
-from cityscapestask.decoders import Decoders
-from cityscapestask.encoder import Encoder
+from cityscapestask import weights_file
+from cityscapestask.decoders import Decoders, LazyOutputs
+from cityscapestask.encoder import build_encoder
+from cityscapestask.fusion import fold_batch_norm
+from loss_weighting import UncertaintyWeighting, convert_legacy_log_vars
 
-_RESNET_MODELS = {
+# ImageNet pre-trained weights for each backbone in encoder.BACKBONES.
+_PRETRAINED_MODELS = {
     'resnet101': 'https://download.pytorch.org/models/resnet101-5d3b4d8f.pth',
-    'resnet50': 'https://download.pytorch.org/models/resnet50-19c8e357.pth'
+    'resnet50': 'https://download.pytorch.org/models/resnet50-19c8e357.pth',
+    'resnet34': 'https://download.pytorch.org/models/resnet34-333f7ec4.pth',
+    'resnet18': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
+    'mobilenet_v2': 'https://download.pytorch.org/models/mobilenet_v2-b0353104.pth',
+}
+
+# Keys of the ImageNet weights which the encoder doesn't use, as it has ASPP in place of the classifier.
+_UNUSED_PRETRAINED_PREFIXES = {
+    'resnet101': ('fc.',),
+    'resnet50': ('fc.',),
+    'resnet34': ('fc.',),
+    'resnet18': ('fc.',),
+    'mobilenet_v2': ('classifier.', 'features.18.'),
 }
 
+# Before UncertaintyWeighting, each task had its own log variance parameter with these names.
+LEGACY_LOG_VAR_NAMES = ('sem_log_var', 'inst_log_var', 'depth_log_var')
+
 class MultitaskLearner(nn.Module):
     def __init__(self, num_classes, enabled_tasks: (bool, bool, bool), loss_uncertainties, pre_train_encoder: bool,
-                 aspp_dilations: (int, int, int), resnet_type='resnet101', output_size=(128, 256), dropout=None):
+                 aspp_dilations: (int, int, int), resnet_type='resnet101', output_size=(128, 256), dropout=None,
+                 output_stride=8, pretrained_weights_dir=None, aspp_type='standard'):
+        """Creates a new instance.
+
+        :param resnet_type The backbone of the encoder, one of encoder.BACKBONES. Despite the name, it need not be a
+        ResNet.
+        :param pretrained_weights_dir Directory containing the ImageNet weights for the backbone, either converted by
+        convert_pretrained_weights, or as downloaded from _PRETRAINED_MODELS. They are only downloaded if neither is
+        there, so the model can be built offline. If None, the default PyTorch cache directory is used.
+        """
         super(MultitaskLearner, self).__init__()
 
-        assert resnet_type in _RESNET_MODELS, f'Unknown resnet type {resnet_type}'
+        assert resnet_type in _PRETRAINED_MODELS, f'Unknown resnet type {resnet_type}'
+
+        # Registered first so log_vars is the first parameter, in the same place as the legacy log variance parameters.
+        # Instance and depth are regression tasks, semantic segmentation is classification.
+        self.loss_weighting = UncertaintyWeighting(loss_uncertainties, regression_tasks=(False, True, True))
 
-        encoder = Encoder(aspp_dilations, resnet_type, dropout)
         if pre_train_encoder:
             # Use ImageNet pre-trained weights for the ResNet-like layers of the encoder
-            state_dict = model_zoo.load_url(_RESNET_MODELS[resnet_type])
-            # strict = False so we ignore incompatibilities between official reset and our resnet.
-            encoder.load_state_dict(state_dict, strict=False)
+            encoder = _build_pretrained_encoder(aspp_dilations, resnet_type, dropout, output_stride, aspp_type,
+                                                pretrained_weights_dir)
+        else:
+            encoder = build_encoder(aspp_dilations, resnet_type, dropout, output_stride, aspp_type)
         self.encoder = encoder
 
-        self.decoders = Decoders(num_classes, enabled_tasks, output_size)
+        # See freeze_encoder_bn_statistics.
+        self._freeze_encoder_bn = False
 
-        self.sem_log_var = nn.Parameter(torch.tensor(loss_uncertainties[0], dtype=torch.float))
-        self.inst_log_var = nn.Parameter(torch.tensor(loss_uncertainties[1], dtype=torch.float))
-        self.depth_log_var = nn.Parameter(torch.tensor(loss_uncertainties[2], dtype=torch.float))
+        # The decoders are as wide as each ASPP branch, which is narrower for the lighter backbones.
+        self.decoders = Decoders(num_classes, enabled_tasks, output_size, in_channels=encoder.out_channels,
+                                 channels=encoder.out_channels // 5)
 
     def forward(self, x):
         """Returns sem_seg_output, instance_seg_output, depth_output"""
         return self.decoders(self.encoder(x))
 
-    def get_loss_params(self) -> (nn.Parameter, nn.Parameter, nn.Parameter):
-        """Returns sem_log_var, inst_log_var, depth_log_var"""
-        return self.sem_log_var, self.inst_log_var, self.depth_log_var
+    def forward_tasks(self, x, tasks: [str]) -> tuple:
+        """Returns the outputs of only the given tasks, from decoders.TASKS, whether or not they are enabled.
+
+        Unlike forward, this never returns None, so it is suitable for export with a fixed set of heads.
+        """
+        features = self.encoder(x)
+        return tuple(self.decoders.forward_task(features, task) for task in tasks)
+
+    def forward_lazy(self, x, tasks: [str] = None) -> LazyOutputs:
+        """Returns the outputs of the given tasks, or the enabled tasks if None, to be upsampled only as needed. See
+        decoders.LazyOutputs."""
+        return self.decoders.forward_lazy(self.encoder(x), tasks)
+
+    def forward_from_features(self, features):
+        """Returns sem_seg_output, instance_seg_output, depth_output given the output of the encoder, e.g. from
+        feature_cache. Features computed in eval mode have no dropout, so dropout after ASPP is applied here. Dropout
+        after layer 4 is before ASPP, so can't be applied to the features, and is not supported."""
+        assert self.encoder.dropout_type != 'after_layer_4', 'Dropout after layer 4 is not supported from the features'
+        if self.encoder.dropout_type == 'after_aspp':
+            features = F.dropout2d(features, p=self.encoder.dropout.p, training=self.training)
+        return self.decoders(features)
+
+    def predict_mc_dropout(self, x, samples: int, samples_per_batch=None) -> tuple:
+        """Returns (mean, variance) over Monte Carlo dropout samples of each output, or None for disabled tasks.
+
+        The encoder is run once up to its dropout, then samples dropout masks are applied to its features and the rest
+        of the model is run on them in batches, so the cost is one backbone pass plus samples decoder passes. The mean
+        and variance of the semantic output are of the softmax probabilities rather than the logits. Apart from dropout,
+        the learner is in eval mode.
+
+        :param samples_per_batch The number of samples to run the decoders on at once, to limit memory. If None, all of
+        them.
+        """
+        assert self.encoder.dropout_type in ('after_layer_4', 'after_aspp'), 'The encoder has no dropout to sample'
+        keep_probability = 1 - self.encoder.dropout.p
+        samples_per_batch = samples_per_batch or samples
+
+        was_training = self.training
+        self.eval()
+        with torch.no_grad():
+            features = self.encoder.forward_to_dropout(x)
+            # (samples so far, mean, sum of squared differences from the mean) of each output, combined over batches
+            # of samples as in Chan et al., "Updating Formulae and a Pairwise Algorithm for Computing Sample Variances".
+            statistics = None
+            for start in range(0, samples, samples_per_batch):
+                batch_samples = min(samples_per_batch, samples - start)
+                # Like Dropout2d, each mask drops whole channels, independently for each image.
+                masks = torch.bernoulli(features.new_full((batch_samples, *features.shape[:2], 1, 1), keep_probability))
+                dropped = (features.unsqueeze(0) * masks / keep_probability).flatten(0, 1)
+                outputs = self.decoders(self.encoder.forward_from_dropout(dropped))
+
+                batch_statistics = []
+                for task_index, output in enumerate(outputs):
+                    if output is None:
+                        batch_statistics.append(None)
+                        continue
+                    if task_index == 0:
+                        output = F.softmax(output, dim=1)
+                    output = output.view(batch_samples, *x.shape[:1], *output.shape[1:])
+                    variance, mean = torch.var_mean(output, dim=0, unbiased=False)
+                    batch_statistics.append((batch_samples, mean, variance * batch_samples))
+                statistics = batch_statistics if statistics is None else [
+                    _combine_statistics(a, b) if a is not None else None for a, b in zip(statistics, batch_statistics)]
+        self.train(was_training)
+
+        results = []
+        for task_statistics in statistics:
+            if task_statistics is None:
+                results.append(None)
+            else:
+                count, mean, squared_differences = task_statistics
+                results.append((mean, squared_differences / count))
+        return tuple(results)
+
+    def freeze_encoder(self):
+        """Stops training the encoder, and keeps it in eval mode so that its batch norm statistics do not change."""
+        for parameter in self.encoder.parameters():
+            parameter.requires_grad = False
+        self.encoder.eval()
+
+    def freeze_encoder_bn_statistics(self):
+        """Keeps every batch norm layer of the encoder in eval mode, so their statistics do not change. Their affine
+        parameters are still trained."""
+        self._freeze_encoder_bn = True
+        self.train(self.training)
+
+    def train(self, mode=True):
+        """Sets the training mode, but keeps in eval mode the frozen parts of the encoder: all of it if its parameters
+        are all frozen, otherwise any batch norm layer which is frozen or whose statistics are frozen."""
+        super().train(mode)
+        if not mode:
+            return self
+
+        if not any(parameter.requires_grad for parameter in self.encoder.parameters()):
+            self.encoder.eval()
+            return self
+
+        for module in self.encoder.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm) and (
+                    self._freeze_encoder_bn or not any(parameter.requires_grad for parameter in module.parameters())):
+                module.eval()
+        return self
+
+    def get_loss_params(self) -> nn.Parameter:
+        """Returns the vector (sem_log_var, inst_log_var, depth_log_var)"""
+        return self.loss_weighting.log_vars
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_legacy_log_vars(state_dict, prefix, LEGACY_LOG_VAR_NAMES, 'loss_weighting')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def optimize_for_inference(self, example_inputs=None, atol=1e-4) -> 'MultitaskLearner':
+        """Returns a frozen copy of the learner for inference, with the same outputs as this learner in eval mode.
+
+        Batch norm is folded into the preceding convolutions, and dropout and the loss weighting are removed. The copy
+        has no trainable parameters, and should not be trained or saved as a checkpoint.
+
+        :param example_inputs If given, checks that the outputs of the copy match those of this learner in eval mode,
+        to within atol, relative to the largest output of each task.
+        """
+        was_training = self.training
+        self.eval()
+        optimized = copy.deepcopy(self)
+        self.train(was_training)
+
+        fold_batch_norm(optimized)
+        optimized.encoder.dropout_type = 'none'
+        optimized.encoder.dropout = nn.Identity()
+        del optimized.loss_weighting
+        optimized.requires_grad_(False)
+
+        if example_inputs is not None:
+            with torch.no_grad():
+                self.eval()
+                expected_outputs = self(example_inputs)
+                self.train(was_training)
+                outputs = optimized(example_inputs)
+            for expected, output in zip(expected_outputs, outputs):
+                if expected is not None:
+                    error = (expected - output).abs().max() / expected.abs().max().clamp(min=1)
+                    assert error <= atol, f'Optimized outputs differ from eval mode outputs by {error}'
+
+        return optimized
 
     def set_output_size(self, size):
+        """Sets the size to upsample the outputs to. If None, the outputs are returned at the output stride."""
         self.decoders.set_output_size(size)
 
 
+def _get_converted_weights_path(resnet_type: str, pretrained_weights_dir: str) -> str:
+    directory = pretrained_weights_dir or os.path.join(torch.hub.get_dir(), 'checkpoints')
+    return os.path.join(directory, f'{resnet_type}.weights')
+
+
+def _build_pretrained_encoder(aspp_dilations, resnet_type: str, dropout, output_stride: int, aspp_type: str,
+                              pretrained_weights_dir: str) -> nn.Module:
+    """Builds the encoder with the ImageNet weights, from the converted weights file if there is one, otherwise from
+    the official weights, which are downloaded if missing. Fails if any weights don't match the encoder."""
+    start = time.perf_counter()
+    path = _get_converted_weights_path(resnet_type, pretrained_weights_dir)
+    if os.path.exists(path):
+        # Built without memory, as most of its random weights would be replaced, which takes most of the time.
+        with torch.device('meta'):
+            encoder = build_encoder(aspp_dilations, resnet_type, dropout, output_stride, aspp_type)
+        state_dict, _ = weights_file.load_weights(path)
+        # The weights may be stored in fp16.
+        state_dict = {key: value.float() if value.is_floating_point() else value for key, value in state_dict.items()}
+        # Uses the mapped tensors, so they are only read from the file as they are used.
+        result = encoder.load_state_dict(state_dict, strict=False, assign=True)
+        _check_pretrained_keys(result, path)
+        _initialise_meta_modules(encoder)
+    else:
+        encoder = build_encoder(aspp_dilations, resnet_type, dropout, output_stride, aspp_type)
+        path = _PRETRAINED_MODELS[resnet_type]
+        state_dict = model_zoo.load_url(path, model_dir=pretrained_weights_dir)
+        _check_pretrained_keys(encoder.load_state_dict(_select_encoder_weights(state_dict, resnet_type), strict=False),
+                               path)
+    print(f'Built the encoder with the pre-trained {resnet_type} weights from {path} in '
+          f'{time.perf_counter() - start:.2f}s')
+    return encoder
+
+
+def _initialise_meta_modules(model: nn.Module):
+    """Randomly initialises the modules whose tensors were not loaded, as they would have been when built normally."""
+    for module in model.modules():
+        tensors = list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))
+        if any(tensor.is_meta for tensor in tensors):
+            # As module.to_empty, which is slower the first time, as torch.empty_like of a meta tensor imports more of
+            # PyTorch.
+            module._apply(lambda tensor: torch.empty(tensor.shape, dtype=tensor.dtype), recurse=False)
+            module.reset_parameters()
+
+
+def _check_pretrained_keys(result, path: str):
+    """Fails if the result of load_state_dict(strict=False) has any keys which shouldn't differ."""
+    assert not result.unexpected_keys, f'{path} has weights the encoder does not: {result.unexpected_keys}'
+    # Only ASPP, which is not in the backbone, is not pre-trained. The official weights are older than the batch norm
+    # num_batches_tracked, which is not used with a momentum.
+    missing = [key for key in result.missing_keys
+               if not key.startswith('aspp.') and not key.endswith('.num_batches_tracked')]
+    assert not missing, f'{path} is missing weights of the encoder: {missing}'
+
+
+def _select_encoder_weights(state_dict: dict, resnet_type: str) -> dict:
+    """Returns the official weights without those of the classifier, which the encoder doesn't have."""
+    unused_prefixes = _UNUSED_PRETRAINED_PREFIXES[resnet_type]
+    encoder_state_dict = {key: value for key, value in state_dict.items() if not key.startswith(unused_prefixes)}
+    assert len(encoder_state_dict) < len(state_dict), f'The {resnet_type} weights have no classifier {unused_prefixes}'
+    return encoder_state_dict
+
+
+def convert_pretrained_weights(resnet_type: str, pretrained_weights_dir: str, half=False) -> str:
+    """Converts the official ImageNet weights of the backbone, downloaded if missing, to a weights file of only those
+    which the encoder uses, which is then used by MultitaskLearner. Returns the path of the file.
+
+    :param half Whether to store the weights in fp16. They are converted back to fp32 when loaded.
+    """
+    state_dict = model_zoo.load_url(_PRETRAINED_MODELS[resnet_type], model_dir=pretrained_weights_dir)
+    state_dict = _select_encoder_weights(state_dict, resnet_type)
+    # Check the weights match the encoder now, rather than when they are loaded.
+    encoder = build_encoder((12, 24, 36), resnet_type, None)
+    _check_pretrained_keys(encoder.load_state_dict(state_dict, strict=False), _PRETRAINED_MODELS[resnet_type])
+
+    path = _get_converted_weights_path(resnet_type, pretrained_weights_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    weights_file.save_weights(path, state_dict, {'source': _PRETRAINED_MODELS[resnet_type]}, half=half)
+    return path
+
+
+def _combine_statistics(a, b):
+    """Returns (count, mean, sum of squared differences from the mean) of the union of two sets of samples."""
+    count_a, mean_a, squared_differences_a = a
+    count_b, mean_b, squared_differences_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    squared_differences = squared_differences_a + squared_differences_b + delta ** 2 * (count_a * count_b / count)
+    return count, mean, squared_differences
+
+
 if __name__ == '__main__':
     # ### Shape test
     model0 = MultitaskLearner(num_classes=20, loss_uncertainties=(1, 0, 0), pre_train_encoder=False)
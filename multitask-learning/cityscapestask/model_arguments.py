@@ -0,0 +1,26 @@
+"""The command line arguments of the model config, shared by the scripts which load a trained model."""
+import argparse
+
+from cityscapestask.model import MultitaskLearner
+from cityscapestask.weights_file import load_checkpoint_into
+
+
+def add_model_arguments(parser: argparse.ArgumentParser):
+    """Adds the arguments of the model config, which must match the checkpoint. See cityscapestask/main.py."""
+    parser.add_argument('--num_classes', type=int, default=20)
+    parser.add_argument('--resnet_type', type=str, default='resnet101')
+    parser.add_argument('--output_stride', type=int, default=8)
+    parser.add_argument('--aspp_type', type=str, default='standard')
+    parser.add_argument('--aspp_dilations', type=int, nargs=3, default=[12, 24, 36])
+
+
+def create_learner_from_args(args: argparse.Namespace) -> MultitaskLearner:
+    """Creates the learner of every task described by the arguments of add_model_arguments, and loads args.checkpoint
+    into it, unless it is None, when the weights are randomly initialised."""
+    learner = MultitaskLearner(num_classes=args.num_classes, enabled_tasks=(True, True, True),
+                               loss_uncertainties=(1.0, 1.0, 1.0), pre_train_encoder=False,
+                               aspp_dilations=args.aspp_dilations, resnet_type=args.resnet_type,
+                               output_stride=args.output_stride, aspp_type=args.aspp_type)
+    if args.checkpoint is not None:
+        load_checkpoint_into(learner, args.checkpoint)
+    return learner
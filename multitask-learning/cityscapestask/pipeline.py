@@ -0,0 +1,206 @@
+"""A pipeline of threads for batch inference: decoding, then the model, then writing the results.
+
+Decoding and writing each have a pool of threads, and the model runs in the calling thread, so that while the model
+runs on one batch, the next is decoded and the last is written. The stages are connected by bounded queues, so a slow
+stage blocks the stages before it rather than decoded or predicted items accumulating in memory. The time each stage is
+busy is recorded, to show which stage is the bottleneck: ideally the model, which then never waits for input.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Put on a queue after the last item.
+_DONE = object()
+
+
+class StageStatistics(object):
+    """The time the threads of a stage spent working, which is safe to record from several threads."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, items=1):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def utilisation(self, wall_seconds: float) -> float:
+        """Returns the fraction of the time its threads were busy."""
+        return self.busy_seconds / (wall_seconds * self.workers) if wall_seconds > 0 else 0.0
+
+
+class PipelineStatistics(object):
+    def __init__(self, stages: [StageStatistics], wall_seconds: float, input_wait_seconds: float,
+                 output_wait_seconds: float):
+        """Creates a new instance.
+
+        :param input_wait_seconds Time the model stage waited for decoded items, so the model was starved.
+        :param output_wait_seconds Time the model stage waited for space in the write queue, so writing was too slow.
+        """
+        self.stages = stages
+        self.wall_seconds = wall_seconds
+        self.input_wait_seconds = input_wait_seconds
+        self.output_wait_seconds = output_wait_seconds
+
+    def format(self) -> str:
+        items = self.stages[0].items
+        lines = [f'{items} items in {self.wall_seconds:.1f}s, {items / max(self.wall_seconds, 1e-9):.2f} items/s',
+                 f'{"stage":>8} {"threads":>8} {"busy (s)":>9} {"utilisation":>12}']
+        for stage in self.stages:
+            lines.append(f'{stage.name:>8} {stage.workers:>8} {stage.busy_seconds:>9.1f} '
+                         f'{stage.utilisation(self.wall_seconds):>12.0%}')
+        lines.append(f'The model waited {self.input_wait_seconds:.1f}s for input, and '
+                     f'{self.output_wait_seconds:.1f}s for the writers')
+        return '\n'.join(lines)
+
+
+def _timed(function, statistics: StageStatistics):
+    def _wrapper(*args):
+        start = time.perf_counter()
+        result = function(*args)
+        statistics.record(time.perf_counter() - start)
+        return result
+    return _wrapper
+
+
+def run_pipeline(items, decode, predict, write, batch_size: int, decode_workers=4, write_workers=2,
+                 queue_size=16) -> PipelineStatistics:
+    """Decodes, predicts and writes each item, in order of items for decode and predict, and returns the statistics.
+
+    :param items Iterable of the items to process, e.g. file paths. Read lazily.
+    :param decode Function of an item, which returns its decoded value, e.g. the image. Called from the decode threads.
+    :param predict Function of lists of up to batch_size items and their decoded values, which returns a list of the
+    result for each. Called from the calling thread.
+    :param write Function of an item and its result. Called from the write threads.
+    :param queue_size The most decoded items, and the most results, which can wait for the next stage.
+    """
+    decode_statistics = StageStatistics('decode', decode_workers)
+    model_statistics = StageStatistics('model', 1)
+    write_statistics = StageStatistics('write', write_workers)
+    decode = _timed(decode, decode_statistics)
+    write = _timed(write, write_statistics)
+
+    # Futures of the decoded values, in the order of items.
+    decoded = queue.Queue(maxsize=queue_size)
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    feed_errors = []
+    write_errors = []
+
+    decode_pool = ThreadPoolExecutor(decode_workers, thread_name_prefix='decode')
+
+    def _feed():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                decoded.put((item, decode_pool.submit(decode, item)))
+        except BaseException as e:
+            # Raised by the model stage, which is waiting for the next item.
+            feed_errors.append(e)
+        finally:
+            decoded.put(_DONE)
+
+    def _write():
+        while True:
+            result = results.get()
+            if result is _DONE:
+                return
+            # Continue after an error, so that the model stage is never blocked forever.
+            if not write_errors:
+                try:
+                    write(*result)
+                except Exception as e:
+                    write_errors.append(e)
+
+    feeder = threading.Thread(target=_feed, name='feeder', daemon=True)
+    writers = [threading.Thread(target=_write, name=f'write_{i}', daemon=True) for i in range(write_workers)]
+    start = time.perf_counter()
+    feeder.start()
+    for writer in writers:
+        writer.start()
+
+    input_wait_seconds = 0.0
+    output_wait_seconds = 0.0
+
+    def _predict_batch(batch):
+        nonlocal output_wait_seconds
+        predict_start = time.perf_counter()
+        batch_results = predict([item for item, _ in batch], [value for _, value in batch])
+        model_statistics.record(time.perf_counter() - predict_start, len(batch))
+        for (item, _), result in zip(batch, batch_results):
+            put_start = time.perf_counter()
+            results.put((item, result))
+            output_wait_seconds += time.perf_counter() - put_start
+
+    try:
+        batch = []
+        while True:
+            get_start = time.perf_counter()
+            next_item = decoded.get()
+            if next_item is _DONE:
+                if feed_errors:
+                    raise feed_errors[0]
+                break
+            item, future = next_item
+            batch.append((item, future.result()))
+            input_wait_seconds += time.perf_counter() - get_start
+            if len(batch) == batch_size:
+                _predict_batch(batch)
+                batch = []
+        if batch:
+            _predict_batch(batch)
+    finally:
+        stop.set()
+        # Unblock the feeder if it is waiting for space, so it sees stop.
+        while feeder.is_alive():
+            try:
+                decoded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        decode_pool.shutdown(cancel_futures=True)
+        for _ in writers:
+            results.put(_DONE)
+        for writer in writers:
+            writer.join()
+
+    if write_errors:
+        raise write_errors[0]
+    return PipelineStatistics([decode_statistics, model_statistics, write_statistics], time.perf_counter() - start,
+                              input_wait_seconds, output_wait_seconds)
+
+
+if __name__ == '__main__':
+    # ### Order and backpressure test
+    written = []
+    in_flight = []
+
+    def _test_decode(item):
+        in_flight.append(item)
+        time.sleep(0.001)
+        return item * 2
+
+    def _test_predict(batch_items, values):
+        assert len(batch_items) <= 3 and in_flight[-1] - batch_items[0] <= 16 + 4 + 3
+        return [value + 1 for value in values]
+
+    test_statistics = run_pipeline(range(100), _test_decode, _test_predict,
+                                   lambda item, result: written.append((item, result)), batch_size=3)
+    assert sorted(written) == [(i, i * 2 + 1) for i in range(100)]
+    assert [stage.items for stage in test_statistics.stages] == [100, 100, 100]
+
+    # ### An error reading the items is raised, rather than the model stage waiting forever
+    def _test_items():
+        yield from range(10)
+        raise ValueError('Test error')
+
+    try:
+        run_pipeline(_test_items(), _test_decode, _test_predict, lambda item, result: None, batch_size=3)
+        raise RuntimeError('The error reading the items was not raised')
+    except ValueError as e:
+        assert str(e) == 'Test error'
@@ -0,0 +1,39 @@
+"""Runs a MultitaskLearner on a batch of images for inference, returning only the heads which are asked for."""
+import numpy as np
+import torch
+
+from cityscapestask.decoders import TASKS
+from cityscapestask.instances import extract_instances
+
+# Everything which can be asked for, in addition to the tasks of the decoders. instance_ids are the instances extracted
+# from the semantic and instance heads, see instances.py.
+HEADS = TASKS + ('instance_ids',)
+
+
+def predict_heads(learner, images: torch.Tensor, heads: [str]) -> {str: np.ndarray}:
+    """Returns {head: outputs for the batch} at the size of the images, on the CPU:
+        semantic: uint8 [batch x H x W] class map
+        instance: float32 [batch x 2 x H x W] instance vectors
+        depth: float32 [batch x H x W]
+        instance_ids: int32 [batch x H x W]
+
+    :param learner A MultitaskLearner in eval mode, e.g. from MultitaskLearner.optimize_for_inference.
+    :param images [batch x 3 x H x W] normalized images, on the device of the learner.
+    """
+    assert all(head in HEADS for head in heads), f'Unknown heads {heads}, expected some of {HEADS}'
+    tasks = [task for task in TASKS if task in heads or ('instance_ids' in heads and task != 'depth')]
+    learner.set_output_size(images.shape[-2:])
+    with torch.inference_mode():
+        outputs = learner.forward_lazy(images, tasks)
+        # Only the heads which are asked for are upsampled, and the semantic logits only tile by tile.
+        predictions = {}
+        if 'semantic' in tasks:
+            predictions['semantic'] = outputs.class_map().cpu().numpy()
+        if 'instance' in tasks:
+            predictions['instance'] = outputs.upsample('instance').cpu().numpy()
+        if 'depth' in tasks:
+            predictions['depth'] = outputs.upsample('depth')[:, 0].cpu().numpy()
+        if 'instance_ids' in heads:
+            predictions['instance_ids'] = extract_instances(
+                torch.from_numpy(predictions['semantic']), torch.from_numpy(predictions['instance'])).int().numpy()
+    return {head: predictions[head] for head in heads}
@@ -0,0 +1,76 @@
+"""Static post-training int8 quantization of MultitaskLearner, for CPU inference.
+
+The learner is traced with torch.fx, observers are inserted after every layer of the encoder (including ASPP) and the
+decoders, and the observers are calibrated on a few samples before converting to int8. Decoder heads can be kept in
+float, e.g. for regression tasks which lose too much precision in int8. The outputs are upsampled in float, after
+dequantizing, as upsampling int8 outputs would lose precision.
+"""
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from cityscapestask.decoders import TASKS
+from cityscapestask.model import MultitaskLearner
+
+# The modules of the decoder for each task, see Decoders.forward_task.
+_TASK_MODULES = {
+    'semantic': ('decoders._base_semseg', 'decoders._semsegcls'),
+    'instance': ('decoders._base_insseg', 'decoders._inssegcls'),
+    'depth': ('decoders._base_depth', 'decoders._depthcls'),
+}
+
+
+class QuantizedLearner(nn.Module):
+    """An int8 MultitaskLearner, which can be used in its place for inference."""
+
+    def __init__(self, quantized: nn.Module, output_size=None):
+        super().__init__()
+        self.quantized = quantized
+        self._output_size = output_size
+
+    def set_output_size(self, size):
+        """Sets the size to upsample the outputs to. If None, the outputs are returned at the output stride."""
+        self._output_size = size
+
+    def forward(self, x):
+        """Returns sem_seg_output, instance_seg_output, depth_output"""
+        outputs = self.quantized(x)
+        if self._output_size is None:
+            return outputs
+        return tuple(F.interpolate(output, size=self._output_size, mode='bilinear', align_corners=True)
+                     if output is not None else None for output in outputs)
+
+
+def quantize_learner(learner: MultitaskLearner, calibration_inputs, float_tasks: [str] = (),
+                     backend='x86') -> QuantizedLearner:
+    """Returns an int8 copy of the learner, calibrated on the given inputs. The learner itself is unchanged.
+
+    :param calibration_inputs Iterable of batches of normalised images, on the CPU.
+    :param float_tasks Tasks from decoders.TASKS whose decoders are kept in float.
+    :param backend The quantized engine to quantize for, from torch.backends.quantized.supported_engines. It must be
+    the current torch.backends.quantized.engine, which is used to run the quantized model.
+    """
+    assert all(task in TASKS for task in float_tasks), f'Unknown tasks {float_tasks}, expected some of {TASKS}'
+    assert torch.backends.quantized.engine == backend, \
+        f'Set torch.backends.quantized.engine to {backend}, it is {torch.backends.quantized.engine}'
+
+    # Batch norm is folded and dropout removed, so only convolutions, activations and pooling remain to be quantized.
+    model = learner.optimize_for_inference().cpu().eval()
+    model.set_output_size(None)
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for task in float_tasks:
+        for module_name in _TASK_MODULES[task]:
+            qconfig_mapping.set_module_name(module_name, None)
+
+    calibration_inputs = iter(calibration_inputs)
+    first_inputs = next(calibration_inputs)
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(first_inputs,))
+    with torch.no_grad():
+        prepared(first_inputs)
+        for inputs in calibration_inputs:
+            prepared(inputs)
+
+    return QuantizedLearner(convert_fx(prepared))
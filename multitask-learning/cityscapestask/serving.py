@@ -0,0 +1,273 @@
+"""Serves predictions of a MultitaskLearner over HTTP, batching together requests which arrive close together.
+
+POST /predict with a PNG (or any format PIL can read) as the body, or with raw 8-bit RGB H x W x 3 pixels and the
+height and width given in the query, e.g. /predict?height=1024&width=2048. The heads to return are given in the query
+as e.g. heads=semantic,depth, which defaults to semantic,instance,depth. The response is an .npz file containing
+an array for each head, at the size of the image:
+    semantic: uint8 [H x W] class map
+    instance: float32 [2 x H x W] instance vectors
+    depth: float32 [H x W]
+    instance_ids: int32 [H x W] instances extracted from the semantic and instance heads. Only returned if asked for.
+See prediction.predict_heads.
+
+GET /metrics returns Prometheus text format histograms of the latency and batch sizes, and GET /health returns 200 once
+the model is loaded. See scripts/serve_model.py and scripts/load_test_server.py.
+"""
+import io
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from cityscapestask.cityscapes import normalize_image
+from cityscapestask.decoders import TASKS
+from cityscapestask.model import MultitaskLearner
+from cityscapestask.prediction import HEADS, predict_heads
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """A cumulative histogram in the style of Prometheus, which is safe to observe from several threads."""
+
+    def __init__(self, name: str, description: str, buckets: [float]):
+        self._name = name
+        self._description = description
+        self._buckets = tuple(buckets)
+        self._counts = [0] * len(self._buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bucket in enumerate(self._buckets):
+                if value <= bucket:
+                    self._counts[i] += 1
+            self._count += 1
+            self._sum += value
+
+    def format(self) -> str:
+        """Returns the histogram in Prometheus text format."""
+        with self._lock:
+            lines = [f'# HELP {self._name} {self._description}', f'# TYPE {self._name} histogram']
+            for bucket, count in zip(self._buckets, self._counts):
+                lines.append(f'{self._name}_bucket{{le="{bucket}"}} {count}')
+            lines.append(f'{self._name}_bucket{{le="+Inf"}} {self._count}')
+            lines.append(f'{self._name}_sum {self._sum}')
+            lines.append(f'{self._name}_count {self._count}')
+        return '\n'.join(lines)
+
+
+class Counter(object):
+    """Counts of events with each label, in the style of Prometheus, which is safe to increment from several threads."""
+
+    def __init__(self, name: str, description: str, label: str):
+        self._name = name
+        self._description = description
+        self._label = label
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def increment(self, label_value):
+        with self._lock:
+            self._counts[label_value] = self._counts.get(label_value, 0) + 1
+
+    def format(self) -> str:
+        """Returns the counts in Prometheus text format."""
+        with self._lock:
+            lines = [f'# HELP {self._name} {self._description}', f'# TYPE {self._name} counter']
+            for label_value, count in sorted(self._counts.items()):
+                lines.append(f'{self._name}{{{self._label}="{label_value}"}} {count}')
+        return '\n'.join(lines)
+
+
+class ServingMetrics(object):
+    """The histograms and counters exposed at /metrics."""
+
+    def __init__(self, max_batch_size: int):
+        self.request_seconds = Histogram('request_seconds', 'Time from receiving a request to sending its response.',
+                                         LATENCY_BUCKETS)
+        self.queue_seconds = Histogram('queue_seconds', 'Time requests wait to be batched.', LATENCY_BUCKETS)
+        self.batch_seconds = Histogram('batch_seconds', 'Time to run the model on a batch, including upsampling.',
+                                       LATENCY_BUCKETS)
+        self.batch_size = Histogram('batch_size', 'Number of images in each batch.', range(1, max_batch_size + 1))
+        self.errors = Counter('errors_total', 'Requests which failed.', 'status')
+
+    def format(self) -> str:
+        return '\n'.join(histogram.format() for histogram in (
+            self.request_seconds, self.queue_seconds, self.batch_seconds, self.batch_size, self.errors)) + '\n'
+
+
+class _Request(object):
+    def __init__(self, image: torch.Tensor, tasks: [str]):
+        self.image = image
+        self.tasks = tasks
+        self.future = Future()
+        self.received = time.perf_counter()
+
+
+class DynamicBatcher(object):
+    """Runs the learner on batches of the images submitted from any thread, in a single worker thread.
+
+    A batch is started by the first waiting request, and runs once it has max_batch_size images or the first request has
+    waited max_latency seconds. Only images of the same size are batched together, and other images wait for a later
+    batch, in the order they arrived.
+    """
+
+    def __init__(self, learner: MultitaskLearner, device, max_batch_size: int, max_latency: float,
+                 metrics: ServingMetrics):
+        """Creates a new instance, and starts its worker thread.
+
+        :param learner In eval mode, on the device, e.g. from MultitaskLearner.optimize_for_inference.
+        :param max_latency The longest time in seconds that a request waits for other requests to batch with.
+        """
+        assert max_batch_size > 0, f'max_batch_size must be positive, was {max_batch_size}'
+        self._learner = learner
+        self._device = device
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+        self._metrics = metrics
+        self._requests = queue.Queue()
+        # Requests taken from the queue which could not join the last batch.
+        self._waiting = []
+        self._thread = threading.Thread(target=self._run, name='DynamicBatcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, image: np.ndarray, tasks: [str]) -> Future:
+        """Returns a future of {task: output} for the given heads of an 8-bit RGB H x W x 3 image."""
+        request = _Request(torch.from_numpy(normalize_image(image)), tasks)
+        self._requests.put(request)
+        return request.future
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._predict(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def _next_batch(self) -> [_Request]:
+        first = self._waiting.pop(0) if self._waiting else self._requests.get()
+        batch = [first]
+        # Waiting requests have already waited, so join the batch without blocking.
+        for request in list(self._waiting):
+            if len(batch) < self._max_batch_size and request.image.shape == first.image.shape:
+                self._waiting.remove(request)
+                batch.append(request)
+
+        deadline = first.received + self._max_latency
+        while len(batch) < self._max_batch_size:
+            try:
+                request = self._requests.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request.image.shape == first.image.shape:
+                batch.append(request)
+            else:
+                self._waiting.append(request)
+        return batch
+
+    def _predict(self, batch: [_Request]) -> [{str: np.ndarray}]:
+        start = time.perf_counter()
+        for request in batch:
+            self._metrics.queue_seconds.observe(start - request.received)
+
+        heads = [head for head in HEADS if any(head in request.tasks for request in batch)]
+        images = torch.stack([request.image for request in batch]).to(self._device)
+        predictions = predict_heads(self._learner, images, heads)
+
+        self._metrics.batch_seconds.observe(time.perf_counter() - start)
+        self._metrics.batch_size.observe(len(batch))
+        return [{head: predictions[head][i] for head in request.tasks} for i, request in enumerate(batch)]
+
+
+def _read_image(body: bytes, query: {str: [str]}) -> np.ndarray:
+    """Returns the image in the request as 8-bit RGB H x W x 3."""
+    if 'height' in query or 'width' in query:
+        height, width = int(query['height'][0]), int(query['width'][0])
+        assert len(body) == height * width * 3, f'Expected {height * width * 3} bytes of RGB, got {len(body)}'
+        return np.frombuffer(body, dtype=np.uint8).reshape(height, width, 3)
+    return np.asarray(Image.open(io.BytesIO(body)).convert('RGB'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Set by create_server.
+    batcher = None
+    metrics = None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._send(200, self.metrics.format().encode(), 'text/plain; version=0.0.4')
+        elif path == '/health':
+            self._send(200, b'ok\n', 'text/plain')
+        else:
+            self._send_error(404, f'Unknown path {path}')
+
+    def do_POST(self):
+        received = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._send_error(404, f'Unknown path {url.path}')
+            return
+
+        query = parse_qs(url.query)
+        try:
+            tasks = query['heads'][0].split(',') if 'heads' in query else list(TASKS)
+            assert all(task in HEADS for task in tasks), f'Unknown heads {tasks}, expected some of {HEADS}'
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            image = _read_image(body, query)
+        except Exception as e:
+            self._send_error(400, f'Bad request: {e}')
+            return
+
+        try:
+            result = self.batcher.submit(image, tasks).result()
+        except Exception:
+            self._send_error(500, traceback.format_exc())
+            return
+
+        response = io.BytesIO()
+        np.savez(response, **result)
+        self._send(200, response.getvalue(), 'application/octet-stream')
+        self.metrics.request_seconds.observe(time.perf_counter() - received)
+
+    def _send_error(self, status: int, message: str):
+        self.metrics.errors.increment(status)
+        self._send(status, (message + '\n').encode(), 'text/plain')
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request would dominate the time of small requests, so only errors are logged.
+        pass
+
+
+def create_server(learner: MultitaskLearner, device, host: str, port: int, max_batch_size: int,
+                  max_latency: float) -> ThreadingHTTPServer:
+    """Returns a server for the learner, which is in eval mode on the device. Call serve_forever to start it."""
+    metrics = ServingMetrics(max_batch_size)
+    handler = type('Handler', (_Handler,), {
+        'batcher': DynamicBatcher(learner, device, max_batch_size, max_latency, metrics),
+        'metrics': metrics,
+    })
+    return ThreadingHTTPServer((host, port), handler)
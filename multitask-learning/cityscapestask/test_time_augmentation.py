@@ -0,0 +1,83 @@
+"""Test time augmentation of MultitaskLearner, averaging its outputs over horizontal flips and several scales.
+
+The flipped and unflipped images of each scale are stacked into one batch, so the learner runs once per scale. The
+outputs are upsampled by the decoders straight to the output size, then each task is merged in its own way:
+    semantic: the softmax probabilities are averaged, and their log returned, so the output can be used as logits.
+    instance: the vectors are pixel offsets (row, column) to the centroid, so the column offset changes sign when the
+        output is flipped back, and both are divided by the scale to be in pixels of the original image.
+    depth: averaged.
+"""
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from cityscapestask.model import MultitaskLearner
+
+
+class TestTimeAugmentation(nn.Module):
+    """Wraps a learner in eval mode, and can be used in its place for inference."""
+
+    def __init__(self, learner: MultitaskLearner, scales: [float] = (1.0,), flip=True, batched=True):
+        """Creates a new instance.
+
+        :param scales The scales to resize the images by, before running the learner.
+        :param flip Whether to also run the learner on the horizontally flipped images, at each scale.
+        :param batched Whether to run the learner once on all the flips of each scale, rather than once per variant.
+        Only for comparison, as the outputs are the same.
+        """
+        super().__init__()
+        self.learner = learner
+        self._scales = tuple(scales)
+        self._flips = (False, True) if flip else (False,)
+        self._batched = batched
+        self._output_size = None
+
+    def set_output_size(self, size):
+        """Sets the size to upsample the outputs to. Unlike MultitaskLearner, if None the outputs are the size of the
+        input, as they can only be merged at a common size."""
+        self._output_size = size
+
+    def forward(self, x):
+        """Returns sem_seg_output, instance_seg_output, depth_output, averaged over the augmentations."""
+        output_size = tuple(self._output_size or x.shape[-2:])
+        self.learner.set_output_size(output_size)
+        sums = None
+        for scale in self._scales:
+            scaled = x
+            if scale != 1.0:
+                scaled_size = (round(x.shape[2] * scale), round(x.shape[3] * scale))
+                scaled = F.interpolate(x, size=scaled_size, mode='bilinear', align_corners=True)
+
+            variants = [scaled.flip(-1) if flipped else scaled for flipped in self._flips]
+            if self._batched:
+                batch_outputs = self.learner(torch.cat(variants))
+                variant_outputs = [[output.chunk(len(variants))[i] if output is not None else None
+                                    for output in batch_outputs] for i in range(len(variants))]
+            else:
+                variant_outputs = [self.learner(variant) for variant in variants]
+
+            for flipped, outputs in zip(self._flips, variant_outputs):
+                merged = self._unaugment(outputs, scale, flipped)
+                sums = merged if sums is None else [total + output if total is not None else None
+                                                    for total, output in zip(sums, merged)]
+
+        count = len(self._scales) * len(self._flips)
+        sem_seg, instance_seg, depth = [total / count if total is not None else None for total in sums]
+        if sem_seg is not None:
+            sem_seg = sem_seg.log()
+        return sem_seg, instance_seg, depth
+
+    @staticmethod
+    def _unaugment(outputs, scale: float, flipped: bool) -> list:
+        """Returns the outputs of one augmentation in the frame of the original image, to be averaged."""
+        sem_seg, instance_seg, depth = outputs
+        if sem_seg is not None:
+            sem_seg = F.softmax(sem_seg, dim=1)
+        if instance_seg is not None:
+            instance_seg = instance_seg / scale
+            if flipped:
+                instance_seg = instance_seg * instance_seg.new_tensor([1.0, -1.0]).view(1, 2, 1, 1)
+        merged = [sem_seg, instance_seg, depth]
+        if flipped:
+            merged = [output.flip(-1) if output is not None else None for output in merged]
+        return merged
@@ -0,0 +1,100 @@
+"""Inference on images too large to run the model on at once, by running it on overlapping tiles and blending them.
+
+The tiles are run through the model tile_batch_size at a time, so the memory used by the model is bounded by the tile
+size and tile_batch_size rather than the image size. The outputs of overlapping tiles are blended with weights which
+fall smoothly to zero towards the edges of the tiles inside the image, where the model has the least context, so there
+are no seams. The instance vectors are offsets from each pixel, so need no correction for the position of the tile.
+"""
+import math
+
+import torch
+from torch import Tensor
+
+
+def tile_starts(size: int, tile: int, overlap: int) -> [int]:
+    """Returns the starts of the tiles along an axis of the given size, overlapping by at least overlap.
+
+    The last tile ends at the end of the axis, so may overlap the previous tile by more.
+    """
+    assert 0 <= overlap < tile, f'overlap must be at least 0 and less than the tile size {tile}, was {overlap}'
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    count = math.ceil((size - tile) / stride) + 1
+    return [min(i * stride, size - tile) for i in range(count)]
+
+
+def _blend_weights(start: int, tile: int, size: int, overlap: int) -> Tensor:
+    """Returns the weight of each position of a tile along an axis, which rises as a raised cosine over the overlap at
+    each edge of the tile inside the image, and is 1 elsewhere. Overlapping raised cosines sum to 1."""
+    weights = torch.ones(tile)
+    if overlap == 0:
+        return weights
+    ramp = 0.5 - 0.5 * torch.cos(math.pi * (torch.arange(overlap, dtype=torch.float) + 0.5) / overlap)
+    if start > 0:
+        weights[:overlap] = ramp
+    if start + tile < size:
+        weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+    return weights
+
+
+def predict_tiled(learner, images: Tensor, tile_size=(512, 1024), overlap=(128, 128), tile_batch_size=4) -> tuple:
+    """Returns the outputs of the learner for the full images, as forward would with the output size set to the image
+    size, but running the learner on overlapping tiles.
+
+    If the tiles cover the images, the learner runs once on the whole images, and the outputs are the same as forward.
+
+    :param learner A MultitaskLearner in eval mode, or anything with the same forward and set_output_size.
+    :param images [batch x 3 x H x W] normalized images.
+    :param tile_size (height, width) of the tiles. Multiples of the output stride avoid losing the edges of each tile.
+    :param overlap (rows, columns) that neighbouring tiles overlap by, at least.
+    :param tile_batch_size The number of tiles to run the learner on at once.
+    :return sem_seg_output, instance_seg_output, depth_output, where outputs of disabled tasks are None.
+    """
+    batch_size, _, height, width = images.shape
+    tile_height, tile_width = min(tile_size[0], height), min(tile_size[1], width)
+    overlap_rows, overlap_cols = min(overlap[0], tile_height - 1), min(overlap[1], tile_width - 1)
+    windows = [(top, left) for top in tile_starts(height, tile_height, overlap_rows)
+               for left in tile_starts(width, tile_width, overlap_cols)]
+
+    learner.set_output_size((tile_height, tile_width))
+    outputs = None
+    weight_sum = images.new_zeros((1, 1, height, width))
+    with torch.no_grad():
+        for batch_start in range(0, len(windows), tile_batch_size):
+            batch_windows = windows[batch_start:batch_start + tile_batch_size]
+            tiles = torch.cat([images[:, :, top:top + tile_height, left:left + tile_width]
+                               for top, left in batch_windows])
+            tile_outputs = learner(tiles)
+            if outputs is None:
+                outputs = [images.new_zeros((batch_size, output.shape[1], height, width)) if output is not None else None
+                           for output in tile_outputs]
+
+            for i, (top, left) in enumerate(batch_windows):
+                weights = torch.outer(_blend_weights(top, tile_height, height, overlap_rows),
+                                      _blend_weights(left, tile_width, width, overlap_cols)).to(images)
+                weight_sum[:, :, top:top + tile_height, left:left + tile_width] += weights
+                for output, tile_output in zip(outputs, tile_outputs):
+                    if output is not None:
+                        tile_output = tile_output[i * batch_size:(i + 1) * batch_size]
+                        output[:, :, top:top + tile_height, left:left + tile_width].addcmul_(weights, tile_output)
+            del tile_outputs
+
+    # In place, as the full size outputs are most of the memory used.
+    return tuple(output.div_(weight_sum) if output is not None else None for output in outputs)
+
+
+if __name__ == '__main__':
+    # ### Blending test: with constant tile outputs, the blended output is the same constant.
+    class _ConstantLearner(torch.nn.Module):
+        def set_output_size(self, size):
+            self._size = size
+
+        def forward(self, x):
+            return torch.ones(x.shape[0], 20, *self._size), torch.ones(x.shape[0], 2, *self._size), None
+
+    result = predict_tiled(_ConstantLearner(), torch.zeros(2, 3, 100, 300), tile_size=(48, 64), overlap=(16, 24),
+                           tile_batch_size=3)
+    assert result[0].shape == (2, 20, 100, 300) and result[2] is None
+    assert torch.allclose(result[0], torch.ones(1)) and torch.allclose(result[1], torch.ones(1))
+    assert tile_starts(100, 48, 16) == [0, 32, 52]
@@ -1,35 +1,62 @@
 """Contains training and validation functions."""
+import time
+
 import numpy as np
 import torch
 from torch.optim import Optimizer
 from torchvision.transforms import transforms
 
-from cityscapestask import cityscapes, checkpointing
-from cityscapestask.losses import MultiTaskLoss
-from cityscapestask.model import MultitaskLearner
+import loss_weighting
+from cityscapestask import cityscapes, checkpointing, feature_cache
+from cityscapestask.async_validation import AsyncValidator
+from cityscapestask.distillation import DistillationLoss, compute_teacher_outputs
+from cityscapestask.freezing import FreezingSchedule, get_frozen_parameter_count
+from cityscapestask.losses import MultiTaskLoss, TiledMultiTaskLoss
+from cityscapestask.model import MultitaskLearner, LEGACY_LOG_VAR_NAMES
+from cityscapestask.validation import compute_validation_metrics, compute_validation_metrics_for_learners
 
 
 def main(_run):
+    if len(_run.config['validate_checkpoints']) > 0:
+        validate_checkpoints(_run)
+        return
+
     train_loader, validation_loader = _create_dataloaders(_run.config)
 
-    learner = MultitaskLearner(num_classes=_run.config['num_classes'], enabled_tasks=_run.config['enabled_tasks'],
-                               loss_uncertainties=_run.config['loss_uncertainties'],
-                               pre_train_encoder=_run.config['pre_train_encoder'],
-                               aspp_dilations=_run.config['aspp_dilations'], resnet_type=_run.config['resnet_type'],
-                               dropout=_run.config['dropout'])
+    learner = create_learner(_run.config)
 
-    device = "cuda:0" if _run.config['gpu'] and torch.cuda.is_available() else "cpu"
+    device = get_device(_run.config)
     learner.to(device)
 
+    # With the feature cache, only the decoders and the loss parameters are trained.
+    use_feature_cache = _run.config['feature_cache_dir'] is not None
+    if use_feature_cache:
+        # The cached features are the output of ASPP, so dropout can only be applied after it.
+        assert _run.config['dropout'] != 'after_layer_4', 'The feature cache does not support dropout after layer 4'
+        learner.freeze_encoder()
+    parameters = [parameter for parameter in learner.parameters() if parameter.requires_grad]
+
+    criterion = create_criterion(_run.config, learner)
+    distillation_loss = None
+    if _run.config['distillation_teacher'] is not None:
+        assert not _run.config['tiled_loss'], 'Distillation does not support the tiled loss'
+        # With the feature cache, the inputs are features rather than images, which the teacher can't be run on.
+        assert not use_feature_cache or _run.config['distillation_cache_dir'] is not None, \
+            'Distillation with the feature cache requires distillation_cache_dir'
+        distillation_loss = _create_distillation_loss(_run.config, criterion)
+        distillation_loss.to(device)
+        # The task loss weights are already in the learner's parameters.
+        parameters += list(distillation_loss.distillation_criterion.parameters())
+
     use_adam = _run.config['use_adam']
     reduce_lr_on_plateau = _run.config['reduce_lr_on_plateau']
     lr_plateau_scheduler = None
     lr_lambda_scheduler = None
     if use_adam:
-        optimizer = torch.optim.Adam(learner.parameters(), lr=_run.config['learning_rate'],
+        optimizer = torch.optim.Adam(parameters, lr=_run.config['learning_rate'],
                                      weight_decay=_run.config['weight_decay'])
     else:
-        optimizer = torch.optim.SGD(learner.parameters(), lr=_run.config['initial_learning_rate'], momentum=0.9,
+        optimizer = torch.optim.SGD(parameters, lr=_run.config['initial_learning_rate'], momentum=0.9,
                                     nesterov=True, weight_decay=_run.config['weight_decay'])
 
         if not reduce_lr_on_plateau:
@@ -41,22 +68,99 @@ def main(_run):
                                                                           threshold=1e-3)
 
     restore_run_id = _run.config['restore_sacred_run']
-    if restore_run_id != -1:
-        epoch, model_state_dict, optimizer_state_dict = checkpointing.load_state(_run, restore_run_id)
+    restore_checkpoint = _run.config['restore_checkpoint']
+    assert restore_run_id == -1 or restore_checkpoint is None, 'Can only restore from one of Sacred or a checkpoint'
+    if restore_run_id != -1 or restore_checkpoint is not None:
+        if restore_run_id != -1:
+            epoch, model_state_dict, optimizer_state_dict, distillation_state_dict = checkpointing.load_state(
+                _run, restore_run_id)
+            restored_from = 'sacred run {}'.format(restore_run_id)
+        else:
+            restored_from = checkpointing.get_checkpoint_path(restore_checkpoint)
+            epoch, model_state_dict, optimizer_state_dict, distillation_state_dict = \
+                checkpointing.load_state_from_file(restored_from)
+        if LEGACY_LOG_VAR_NAMES[0] in model_state_dict and optimizer_state_dict is not None:
+            # Saved before the log variances were combined into a single parameter, so the optimizer state must match.
+            optimizer_state_dict = loss_weighting.convert_legacy_optimizer_state(optimizer_state_dict,
+                                                                                 len(LEGACY_LOG_VAR_NAMES))
         learner.load_state_dict(model_state_dict)
-        optimizer.load_state_dict(optimizer_state_dict)
-        _run.run_logger.info('Restored from sacred run {} at epoch {}'.format(restore_run_id, epoch))
+        if distillation_loss is not None and distillation_state_dict is not None:
+            distillation_loss.distillation_criterion.load_state_dict(distillation_state_dict)
+        if optimizer_state_dict is None:
+            _run.run_logger.info('Not restoring the optimizer, as the checkpoint has only the model weights')
+        elif len(optimizer_state_dict['param_groups'][0]['params']) == len(parameters):
+            optimizer.load_state_dict(optimizer_state_dict)
+        else:
+            # E.g. restoring a fully trained model to train its decoders from the feature cache.
+            _run.run_logger.info('Not restoring the optimizer, as it was created for different parameters')
+        _run.run_logger.info('Restored from {} at epoch {}'.format(restored_from, epoch))
     else:
         epoch = 0
 
-    criterion = MultiTaskLoss(_run.config['loss_type'], _get_uncertainties(_run.config, learner),
-                              _run.config['enabled_tasks'])
+    if use_feature_cache:
+        # Created after restoring, as the cache is keyed by the encoder weights.
+        train_loader = feature_cache.get_cached_loader(_run.config, learner.encoder, device,
+                                                       log=_run.run_logger.info)
+
+    teacher = None
+    if distillation_loss is not None:
+        teacher, train_loader = _load_teacher(_run, device, train_loader)
+
+    # Created after the optimizer, so that the optimizer includes the parameters which are unfrozen later.
+    assert not (use_feature_cache and _run.config['freeze_encoder_layers']), \
+        'The whole encoder is frozen when using the feature cache'
+    freezing_schedule = FreezingSchedule(learner, _run.config['freeze_encoder_layers'],
+                                         _run.config['freeze_encoder_iterations'])
+    if _run.config['freeze_bn']:
+        learner.freeze_encoder_bn_statistics()
 
     if _run.config['validate_only']:
         # The user may want to load a previous experiment from Sacred, validate it, and exit.
         _validate(_run, device, validation_loader, learner, criterion, epoch)
         return
 
+    async_validator = None
+    if _run.config['async_validation'] and _run.config['validate_epochs'] != 0:
+        async_validator = AsyncValidator(_run.config)
+
+    checkpoint_store = None
+    if _run.config['checkpoint_dir'] is not None:
+        checkpoint_store = checkpointing.CheckpointStore(
+            _run.config['checkpoint_dir'], _run.config['checkpoint_keep_last'],
+            _run if _run.config['checkpoint_upload_to_sacred'] else None)
+
+    def _on_validation_results(block=False):
+        """Logs the results of async validation which have arrived, and passes them to the scheduler."""
+        for validated_epoch, metrics in async_validator.poll(block=block):
+            validation_loss = log_validation_metrics(_run, metrics, validated_epoch)
+            if reduce_lr_on_plateau:
+                lr_plateau_scheduler.step(validation_loss)
+            if checkpoint_store is not None:
+                checkpoint_store.record_validation(validated_epoch, validation_loss)
+
+    try:
+        _train(_run, device, train_loader, validation_loader, learner, criterion, optimizer, epoch,
+               use_feature_cache, lr_lambda_scheduler, lr_plateau_scheduler, async_validator, _on_validation_results,
+               freezing_schedule, distillation_loss, teacher, checkpoint_store)
+        if async_validator is not None:
+            _on_validation_results(block=True)
+    finally:
+        if async_validator is not None:
+            async_validator.close()
+        if checkpoint_store is not None:
+            checkpoint_store.close()
+
+
+def _train(_run, device, train_loader, validation_loader, learner, criterion, optimizer, epoch, use_feature_cache,
+           lr_lambda_scheduler, lr_plateau_scheduler, async_validator, on_validation_results,
+           freezing_schedule: FreezingSchedule, distillation_loss: DistillationLoss, teacher: MultitaskLearner,
+           checkpoint_store: checkpointing.CheckpointStore):
+    """Trains until max_iter.
+
+    :param distillation_loss If not None, used in place of criterion for training.
+    :param teacher The teacher for distillation_loss, or None if its outputs are cached and appended to each batch.
+    :param checkpoint_store If not None, used in place of saving checkpoints to Sacred.
+    """
     iterations = 0
     while iterations < _run.config['max_iter']:
 
@@ -69,12 +173,23 @@ def main(_run):
         training_semantic_loss = 0
         training_instance_loss = 0
         training_depth_loss = 0
+        training_distillation_losses = np.zeros(3)
 
         # Training loop
+        epoch_seconds = 0.0
         for i, data in enumerate(train_loader, 0):
+            iteration_start = time.perf_counter()
+            if freezing_schedule.update(iterations):
+                _run.run_logger.info('Iteration {}: {} parameters frozen'.format(
+                    iterations, get_frozen_parameter_count(learner)))
+
+            if distillation_loss is not None and teacher is None:
+                *data, teacher_outputs = data
+                teacher_outputs = teacher_outputs.to(device)
             inputs, semantic_labels, instance_centroid, instance_mask, depth, depth_mask = data
 
-            learner.set_output_size(inputs.shape[2:])
+            # With the tiled loss, the loss upsamples the outputs itself.
+            learner.set_output_size(None if _run.config['tiled_loss'] else semantic_labels.shape[-2:])
 
             # Keep count of number of batches
             num_training_batches += 1
@@ -86,12 +201,20 @@ def main(_run):
             depth = depth.to(device)
             depth_mask = depth_mask.to(device)
 
-            # Zero the parameter gradients
-            optimizer.zero_grad()
+            # Zero the parameter gradients. Setting them to None means frozen parameters are skipped by the optimizer.
+            optimizer.zero_grad(set_to_none=True)
 
             # Forward + backward + optimize
-            output = learner(inputs)
-            loss, task_loss = criterion(output, semantic_labels, instance_centroid, instance_mask, depth, depth_mask)
+            output = learner.forward_from_features(inputs) if use_feature_cache else learner(inputs)
+            if distillation_loss is not None:
+                if teacher is not None:
+                    teacher_outputs = compute_teacher_outputs(teacher, inputs)
+                loss, task_loss, distillation_task_loss = distillation_loss(
+                    output, teacher_outputs, semantic_labels, instance_centroid, instance_mask, depth, depth_mask)
+                training_distillation_losses += distillation_task_loss
+            else:
+                loss, task_loss = criterion(output, semantic_labels, instance_centroid, instance_mask, depth,
+                                            depth_mask)
             loss.backward()
             optimizer.step()
 
@@ -121,27 +244,157 @@ def main(_run):
 
             iterations += 1
 
+            # loss.item() above waits for the iteration to finish, so this is the time of the whole iteration.
+            iteration_seconds = time.perf_counter() - iteration_start
+            freezing_schedule.record_iteration(iteration_seconds)
+            epoch_seconds += iteration_seconds
+
+            if async_validator is not None:
+                on_validation_results()
+
         # Save statistics to Sacred
         _run.log_scalar('training_semantic_loss', training_semantic_loss / num_training_batches, epoch)
         _run.log_scalar('training_instance_loss', training_instance_loss / num_training_batches, epoch)
         _run.log_scalar('training_depth_loss', training_depth_loss / num_training_batches, epoch)
+        if distillation_loss is not None:
+            for name, total in zip(('semantic', 'instance', 'depth'), training_distillation_losses):
+                _run.log_scalar(f'training_distillation_{name}_loss', total / num_training_batches, epoch)
 
         _run.log_scalar('learning_rate', _get_learning_rate(optimizer))
+        _run.log_scalar('iteration_seconds', epoch_seconds / num_training_batches, epoch)
+        print(freezing_schedule.get_timing_summary())
 
         # print(f'Training losses: {training_semantic_loss / num_training_batches, training_instance_loss / num_training_batches, training_depth_loss / num_training_batches}')
 
         if _run.config['validate_epochs'] != 0 and ((epoch + 1) % _run.config['validate_epochs'] == 0 or epoch == 0):
-            loss = _validate(_run=_run, device=device, validation_loader=validation_loader, learner=learner,
-                             criterion=criterion, epoch=epoch)
-            if reduce_lr_on_plateau:
-                lr_plateau_scheduler.step(loss)
+            if async_validator is not None:
+                # Results are logged and passed to the scheduler by on_validation_results, when they arrive.
+                async_validator.submit(epoch, learner)
+            else:
+                loss = _validate(_run=_run, device=device, validation_loader=validation_loader, learner=learner,
+                                 criterion=criterion, epoch=epoch)
+                if lr_plateau_scheduler is not None:
+                    lr_plateau_scheduler.step(loss)
+                if checkpoint_store is not None:
+                    checkpoint_store.record_validation(epoch, loss)
 
         if _run.config['model_save_epochs'] != 0 and (epoch + 1) % _run.config['model_save_epochs'] == 0:
-            checkpointing.save_model(_run, learner, optimizer, epoch, iterations)
+            distillation_criterion = distillation_loss.distillation_criterion if distillation_loss is not None else None
+            if checkpoint_store is not None:
+                checkpoint_store.save(learner, optimizer, epoch, iterations, distillation_criterion)
+            else:
+                checkpointing.save_model(_run, learner, optimizer, epoch, iterations, distillation_criterion)
 
         epoch += 1
 
 
+def validate_checkpoints(_run):
+    """Validates each checkpoint in config['validate_checkpoints'], reading the validation set only once.
+
+    Each checkpoint is either the id of a Sacred run, whose latest save is used, or the path to a file saved by
+    checkpointing.save_model. The metrics of each are logged with the prefix '{checkpoint}/'. All the checkpoints must
+    have been trained with the model config of this run.
+    """
+    config = _run.config
+    device = get_device(config)
+    validation_loader = cityscapes.get_loader_from_dir(config['root_dir_validation'], config)
+
+    learners = []
+    epochs = []
+    for checkpoint in config['validate_checkpoints']:
+        epoch, model_state_dict = _load_checkpoint(_run, checkpoint)
+
+        learner = create_learner(config, pre_train_encoder=False)
+        learner.load_state_dict(model_state_dict)
+        learner.to(device)
+        learners.append(learner)
+        epochs.append(epoch)
+
+    criteria = [create_criterion(config, learner) for learner in learners]
+    all_metrics = compute_validation_metrics_for_learners(config, device, validation_loader, learners, criteria,
+                                                          epoch=0)
+
+    print('%30s %6s %10s %8s' % ('checkpoint', 'epoch', 'val_loss', 'val_iou'))
+    for checkpoint, epoch, metrics in zip(config['validate_checkpoints'], epochs, all_metrics):
+        log_validation_metrics(_run, metrics, epoch, prefix='{}/'.format(checkpoint))
+        print('%30s %6d %10.4f %8.4f' % (checkpoint, epoch, metrics['val_total_loss'], metrics['val_iou']))
+
+
+def _load_checkpoint(_run, checkpoint) -> (int, dict):
+    """Returns (epoch, model state dict) of the latest save of a Sacred run id, or of a checkpoint file path."""
+    if isinstance(checkpoint, int):
+        epoch, model_state_dict, _, _ = checkpointing.load_state(_run, checkpoint)
+    else:
+        epoch, model_state_dict, _, _ = checkpointing.load_state_from_file(checkpoint)
+    return epoch, model_state_dict
+
+
+def _create_distillation_loss(config, criterion: MultiTaskLoss) -> DistillationLoss:
+    if config['loss_type'] == 'learned':
+        # Semantic distillation uses soft labels, so is classification, and the others are regression.
+        distillation_uncertainties = loss_weighting.UncertaintyWeighting(config['distillation_loss_uncertainties'],
+                                                                         regression_tasks=(False, True, True))
+    else:
+        distillation_uncertainties = tuple(config['distillation_loss_uncertainties'])
+    distillation_criterion = MultiTaskLoss(config['loss_type'], distillation_uncertainties, config['enabled_tasks'])
+    return DistillationLoss(criterion, distillation_criterion, config['distillation_temperature'])
+
+
+def _load_teacher(_run, device, train_loader):
+    """Loads the frozen teacher for distillation.
+
+    If distillation_cache_dir is set, returns (None, a train loader which appends the cached teacher outputs to each
+    batch). Otherwise returns (teacher, the given train loader).
+    """
+    config = _run.config
+    # The teacher is built as in training, but with its own backbone, and always with every task.
+    teacher_config = dict(config, **config['distillation_teacher_config'])
+    teacher_config['enabled_tasks'] = (True, True, True)
+    teacher = create_learner(teacher_config, pre_train_encoder=False)
+    epoch, model_state_dict = _load_checkpoint(_run, config['distillation_teacher'])
+    teacher.load_state_dict(model_state_dict)
+    teacher.requires_grad_(False)
+    teacher.eval()
+    teacher.to(device)
+    _run.run_logger.info('Loaded distillation teacher {} from epoch {}'.format(config['distillation_teacher'],
+                                                                                  epoch))
+
+    if config['distillation_cache_dir'] is None:
+        return teacher, train_loader
+
+    assert not config['crop'] and not config['flip'], 'Teacher outputs can not be cached with augmentation'
+    dataset = cityscapes.CityscapesDataset(config['root_dir_train'], enable_cache=False,
+                                           min_available_memory_gb=config['min_available_memory_gb'],
+                                           minute=config['minute'])
+    store = feature_cache.get_feature_store(
+        config['distillation_cache_dir'], lambda images: compute_teacher_outputs(teacher, images),
+        'teacher/' + feature_cache.hash_state_dict(teacher.state_dict()), dataset, device, config['batch_size'],
+        log=_run.run_logger.info)
+    train_loader = torch.utils.data.DataLoader(feature_cache.AppendedFeatureDataset(train_loader.dataset, store),
+                                               batch_size=config['batch_size'],
+                                               num_workers=config['dataloader_workers'], shuffle=True)
+    return None, train_loader
+
+
+def create_learner(config, pre_train_encoder=None) -> MultitaskLearner:
+    """Creates the learner described by the config.
+
+    :param pre_train_encoder Overrides config['pre_train_encoder'] if not None, e.g. False when the weights will be
+    loaded from a checkpoint anyway.
+    """
+    if pre_train_encoder is None:
+        pre_train_encoder = config['pre_train_encoder']
+    return MultitaskLearner(num_classes=config['num_classes'], enabled_tasks=config['enabled_tasks'],
+                            loss_uncertainties=config['loss_uncertainties'], pre_train_encoder=pre_train_encoder,
+                            aspp_dilations=config['aspp_dilations'], resnet_type=config['resnet_type'],
+                            dropout=config['dropout'], output_stride=config['output_stride'],
+                            pretrained_weights_dir=config['pretrained_weights_dir'], aspp_type=config['aspp_type'])
+
+
+def get_device(config) -> str:
+    return "cuda:0" if config['gpu'] and torch.cuda.is_available() else "cpu"
+
+
 def _get_learning_rate(optimizer: Optimizer):
     assert len(optimizer.state_dict()['param_groups']) == 1
     return optimizer.state_dict()['param_groups'][0]['lr']
@@ -177,9 +430,17 @@ def _get_training_transforms(config):
         return cityscapes.NoopTransform()
 
 
+def create_criterion(config, learner: MultitaskLearner) -> MultiTaskLoss:
+    if config['tiled_loss']:
+        return TiledMultiTaskLoss(config['loss_type'], _get_uncertainties(config, learner), config['enabled_tasks'],
+                                  tile_rows=config['tiled_loss_rows'])
+    else:
+        return MultiTaskLoss(config['loss_type'], _get_uncertainties(config, learner), config['enabled_tasks'])
+
+
 def _get_uncertainties(config, learner: MultitaskLearner):
     if config['loss_type'] == 'learned':
-        return learner.get_loss_params()
+        return learner.loss_weighting
     elif config['loss_type'] == 'fixed':
         return config['loss_uncertainties']
     else:
@@ -187,105 +448,41 @@ def _get_uncertainties(config, learner: MultitaskLearner):
 
 
 def _validate(_run, device, validation_loader, learner, criterion, epoch) -> float:
-    val_total_loss = 0
-    val_semantic_loss = 0
-    val_instance_loss = 0
-    val_depth_loss = 0
-    val_iou = 0
+    metrics = compute_validation_metrics(_run.config, device, validation_loader, learner, criterion, epoch)
+    return log_validation_metrics(_run, metrics, epoch)
 
-    num_val_batches = 0
 
-    # Validation loop
-    with torch.no_grad():  # Exclude gradients
-        for i, data in enumerate(validation_loader, 0):
-            inputs, semantic_labels, instance_centroid, instance_mask, depth, depth_mask = data
+def log_validation_metrics(_run, metrics: {str: float}, epoch, prefix='') -> float:
+    """Saves the metrics from compute_validation_metrics to Sacred, and returns the total validation loss.
 
-            learner.set_output_size(inputs.shape[2:])
+    :param prefix Prepended to the name of each metric, to distinguish the metrics of several models in one run.
+    """
+    _run.log_scalar(prefix + 'val_semantic_loss', metrics['val_semantic_loss'], epoch)
+    _run.log_scalar(prefix + 'val_instance_loss', metrics['val_instance_loss'], epoch)
+    _run.log_scalar(prefix + 'val_depth_loss', metrics['val_depth_loss'], epoch)
+    _run.log_scalar(prefix + 'val_iou', metrics['val_iou'], epoch)
 
-            inputs = inputs.to(device)
-            semantic_labels = semantic_labels.to(device)
-            instance_centroid = instance_centroid.to(device)
-            instance_mask = instance_mask.to(device)
-            depth = depth.to(device)
-            depth_mask = depth_mask.to(device)
+    if 'log_vars' in metrics:
+        _log_loss_uncertainties_and_weights(_run, epoch, metrics['log_vars'], metrics['loss_weights'], prefix)
 
-            # Keep count of number of batches
-            num_val_batches += 1
+    return metrics['val_total_loss']
 
-            # Forward + backward + optimize
-            output_semantic, output_instance, output_depth = learner(inputs.float())
-            val_loss, val_task_loss = criterion((output_semantic, output_instance, output_depth),
-                                                semantic_labels.long(), instance_centroid, instance_mask, depth,
-                                                depth_mask)
-
-            # TODO: this batch size might break
-            batch_size = semantic_labels.shape[0]
-
-            # Calculate accuracy measures
-            # Segmentation IoU
-            # Only compute IoU if semantic segmentation is enabled.
-            batch_iou = 0
-            if _run.config['enabled_tasks'][0]:
-                for image_index in range(batch_size):
-                    batch_iou += _compute_image_iou(semantic_labels[image_index], output_semantic[image_index],
-                                                    _run.config['num_classes'])
-
-            # instance mean error
-            instance_error = val_task_loss[1]
-
-            # inverse depth mean error
-            depth_error = val_task_loss[2]
-
-            # print('Batch iou %', batch_iou * 100)
-            # print('Batch instance_error', instance_error)
-            # print('Batch depth_error', depth_error)
-
-            # Print every 2000 mini-batches
-            # if i % 2000 == 1999:
-            print('[%d, %5d] Validation loss: %.3f' % (epoch + 1, i + 1, val_loss.item()))
-
-            val_total_loss += val_loss.item()
-            val_semantic_loss += val_task_loss[0]
-            val_instance_loss += val_task_loss[1]
-            val_depth_loss += val_task_loss[2]
-            val_iou += batch_iou / batch_size
-
-    # save statistics to Sacred
-    _run.log_scalar('val_semantic_loss', val_semantic_loss / num_val_batches, epoch)
-    # _run.run_logger.debug('val_semantic_loss', val_semantic_loss / num_val_batches)
-    _run.log_scalar('val_instance_loss', val_instance_loss / num_val_batches, epoch)
-    # _run.run_logger.debug('val_instance_loss', val_instance_loss / num_val_batches, epoch)
-    _run.log_scalar('val_depth_loss', val_depth_loss / num_val_batches, epoch)
-    # _run.run_logger.debug('val_depth_loss', val_depth_loss / num_val_batches, epoch)
-
-    _run.log_scalar('val_iou', val_iou / num_val_batches, epoch)
-    # _run.run_logger.debug('val_iou', val_iou / num_val_batches, epoch)
-
-    if _run.config['loss_type'] == 'learned':
-        _log_loss_uncertainties_and_weights(_run, epoch, learner)
-
-    return val_total_loss / num_val_batches
-
-
-def _log_loss_uncertainties_and_weights(_run, epoch, learner):
-    sem_uncertainty = learner.get_loss_params()[0].item()
-    inst_uncertainty = learner.get_loss_params()[1].item()
-    depth_uncertainty = learner.get_loss_params()[2].item()
-
-    # Convert from uncertainty = log (sigma^2) into the actual weights of the losses
-    sem_weight = np.exp(-sem_uncertainty)
-    inst_weight = 0.5 * np.exp(-inst_uncertainty)
-    depth_weight = 0.5 * np.exp(-depth_uncertainty)
-
-    _run.log_scalar('S_semantic', sem_uncertainty, epoch)
-    _run.log_scalar('S_instance', inst_uncertainty, epoch)
-    _run.log_scalar('S_depth', depth_uncertainty, epoch)
+
+def _log_loss_uncertainties_and_weights(_run, epoch, log_vars: [float], weights: [float], prefix=''):
+    sem_uncertainty, inst_uncertainty, depth_uncertainty = log_vars
+
+    # The weights are computed from uncertainty = log (sigma^2)
+    sem_weight, inst_weight, depth_weight = weights
+
+    _run.log_scalar(prefix + 'S_semantic', sem_uncertainty, epoch)
+    _run.log_scalar(prefix + 'S_instance', inst_uncertainty, epoch)
+    _run.log_scalar(prefix + 'S_depth', depth_uncertainty, epoch)
 
     print('S: (%.5f, %.5f, %.5f)' % (sem_uncertainty, inst_uncertainty, depth_uncertainty))
 
-    _run.log_scalar('weight_semantic', sem_weight, epoch)
-    _run.log_scalar('weight_instance', inst_weight, epoch)
-    _run.log_scalar('weight_depth', depth_weight, epoch)
+    _run.log_scalar(prefix + 'weight_semantic', sem_weight, epoch)
+    _run.log_scalar(prefix + 'weight_instance', inst_weight, epoch)
+    _run.log_scalar(prefix + 'weight_depth', depth_weight, epoch)
 
     print('Weights: (%.5f, %.5f, %.5f)' % (sem_weight, inst_weight, depth_weight))
 
@@ -293,41 +490,8 @@ def _log_loss_uncertainties_and_weights(_run, epoch, learner):
     inst_var = np.exp(inst_uncertainty)
     depth_var = np.exp(depth_uncertainty)
 
-    _run.log_scalar('var_semantic', sem_var, epoch)
-    _run.log_scalar('var_instance', inst_var, epoch)
-    _run.log_scalar('var_depth', depth_var, epoch)
+    _run.log_scalar(prefix + 'var_semantic', sem_var, epoch)
+    _run.log_scalar(prefix + 'var_instance', inst_var, epoch)
+    _run.log_scalar(prefix + 'var_depth', depth_var, epoch)
 
     print()
-
-
-def _compute_image_iou(truth, output_softmax, num_classes: int):
-    # Convert the softmax to the id of the class.
-    output_classes = torch.argmax(output_softmax, dim=0)
-
-    class_count = 0
-    iou = 0.0
-    for c in range(num_classes):
-        # Create tensors with 1 for every pixel labelled with this class, and 0 otherwise. We then
-        # add these tensors. The result has 2 for the intersection, and 1 or 2 for the union.
-
-        truth_for_class = torch.where(truth == c, torch.ones_like(truth, dtype=torch.int),
-                                      torch.zeros_like(truth, dtype=torch.int))
-
-        output_for_class = torch.where(output_classes == c, torch.ones_like(output_classes, dtype=torch.int),
-                                       torch.zeros_like(output_classes, dtype=torch.int))
-
-        result = truth_for_class + output_for_class
-        # View in 1D as bincount only supports 1D.
-        # We expect values 0, 1, 2 for no object, one object and both objects respectively.
-        counts = torch.bincount(result.view(-1), minlength=3)
-
-        assert counts.size(0) == 3, 'Wrong number of bins: {}'.format(counts)
-
-        intersection = counts[2].item()
-        union = counts[1].item() + counts[2].item()
-
-        if union > 0:
-            class_count += 1
-            iou += intersection / union
-
-    return iou / class_count
@@ -0,0 +1,69 @@
+"""Bilinear upsampling of part of an output, so that full resolution outputs never need to exist in memory at once.
+
+The functions here compute the same values as
+F.interpolate(x, size=output_size, mode='bilinear', align_corners=True)[..., rows, cols]
+(up to floating point rounding) but only read the source pixels required by the region.
+"""
+import torch
+from torch import Tensor
+
+
+def _source_indices(in_size: int, out_size: int, start: int, end: int, x: Tensor) -> (Tensor, Tensor, Tensor):
+    """Returns (lower index, upper index, weight of upper) for output positions start to end along one axis.
+
+    Follows the align_corners=True convention of F.interpolate, which computes coordinates in at least fp32.
+    """
+    dtype = torch.double if x.dtype == torch.double else torch.float
+    scale = (in_size - 1) / (out_size - 1) if out_size > 1 else 0.0
+    coordinates = torch.arange(start, end, device=x.device, dtype=dtype) * scale
+    lower = coordinates.long().clamp(max=in_size - 1)
+    upper = (lower + 1).clamp(max=in_size - 1)
+    weight = (coordinates - lower.to(dtype)).to(x.dtype)
+    return lower, upper, weight
+
+
+def interpolate_region(x: Tensor, output_size: (int, int), rows: (int, int), cols: (int, int) = None) -> Tensor:
+    """Bilinearly upsamples x to output_size, but only computes the given region of the output.
+
+    :param x [batch x C x h x w]
+    :param output_size (H, W) of the full output
+    :param rows (start, end) of the rows of the output to compute
+    :param cols (start, end) of the columns of the output to compute, or None for all columns
+    :return [batch x C x (rows end - start) x (cols end - start)]
+    """
+    out_h, out_w = output_size
+    if cols is None:
+        cols = (0, out_w)
+
+    row_lower, row_upper, row_weight = _source_indices(x.shape[2], out_h, rows[0], rows[1], x)
+    col_lower, col_upper, col_weight = _source_indices(x.shape[3], out_w, cols[0], cols[1], x)
+    row_weight = row_weight.view(-1, 1)
+
+    # Interpolate the columns of only the source rows the region needs, which are far fewer than its output rows. The
+    # range is found without reading the indices, to avoid synchronising with the GPU, so has a margin for rounding.
+    row_scale = (x.shape[2] - 1) / (out_h - 1) if out_h > 1 else 0.0
+    first_row = max(int(rows[0] * row_scale) - 1, 0)
+    last_row = min(int((rows[1] - 1) * row_scale) + 3, x.shape[2])
+    source_rows = x[:, :, first_row:last_row]
+    source_rows = (1 - col_weight) * source_rows.index_select(3, col_lower) + col_weight * source_rows.index_select(
+        3, col_upper)
+
+    top = source_rows.index_select(2, row_lower - first_row)
+    bottom = source_rows.index_select(2, row_upper - first_row)
+    return (1 - row_weight) * top + row_weight * bottom
+
+
+def row_tiles(height: int, tile_rows: int) -> [(int, int)]:
+    """Splits the rows 0 to height into (start, end) tiles of at most tile_rows rows."""
+    assert tile_rows > 0, f'tile_rows must be positive, was {tile_rows}'
+    return [(start, min(start + tile_rows, height)) for start in range(0, height, tile_rows)]
+
+
+if __name__ == '__main__':
+    # ### Equivalence test
+    import torch.nn.functional as F
+
+    test = torch.randn(size=(2, 20, 16, 32))
+    expected = F.interpolate(test, size=(128, 256), mode='bilinear', align_corners=True)
+    result = torch.cat([interpolate_region(test, (128, 256), tile) for tile in row_tiles(128, 48)], dim=2)
+    assert torch.allclose(result, expected, atol=1e-5), 'max difference {}'.format((result - expected).abs().max())
@@ -0,0 +1,133 @@
+"""Computes validation metrics for one or more models, without depending on Sacred, so scripts can use them too."""
+import torch
+
+from cityscapestask.model import MultitaskLearner
+
+
+def compute_validation_metrics(config, device, validation_loader, learner: MultitaskLearner, criterion,
+                               epoch) -> {str: float}:
+    """Runs the learner in eval mode over the validation set, and returns the mean of each metric.
+
+    If the loss is learned, the metrics also include the log variances and weights of the losses.
+    """
+    return compute_validation_metrics_for_learners(config, device, validation_loader, [learner], [criterion],
+                                                   epoch)[0]
+
+
+def compute_validation_metrics_for_learners(config, device, validation_loader, learners: [MultitaskLearner],
+                                            criteria, epoch) -> [{str: float}]:
+    """Like compute_validation_metrics, but evaluates every learner on each batch, so the data is only loaded once.
+
+    :param criteria The criterion for each learner.
+    :return The metrics for each learner.
+    """
+    assert len(learners) == len(criteria)
+    accumulators = [_ValidationMetrics(config) for _ in learners]
+
+    was_training = [learner.training for learner in learners]
+    for learner in learners:
+        learner.eval()
+
+    # Validation loop
+    with torch.inference_mode():  # Exclude gradients
+        for i, data in enumerate(validation_loader, 0):
+            inputs, semantic_labels, instance_centroid, instance_mask, depth, depth_mask = data
+
+            inputs = inputs.to(device).float()
+            semantic_labels = semantic_labels.to(device).long()
+            instance_centroid = instance_centroid.to(device)
+            instance_mask = instance_mask.to(device)
+            depth = depth.to(device)
+            depth_mask = depth_mask.to(device)
+
+            for learner, criterion, accumulator in zip(learners, criteria, accumulators):
+                learner.set_output_size(inputs.shape[2:])
+                output = learner(inputs)
+                val_loss, val_task_loss = criterion(output, semantic_labels, instance_centroid, instance_mask, depth,
+                                                    depth_mask)
+                accumulator.add(val_loss.item(), val_task_loss, semantic_labels, output[0])
+
+                # Print every 2000 mini-batches
+                # if i % 2000 == 1999:
+                print('[%d, %5d] Validation loss: %.3f' % (epoch + 1, i + 1, val_loss.item()))
+
+    for learner, training in zip(learners, was_training):
+        learner.train(training)
+
+    return [accumulator.get_metrics(learner) for learner, accumulator in zip(learners, accumulators)]
+
+
+class _ValidationMetrics(object):
+    """Accumulates the validation metrics of one learner over the batches of the validation set."""
+
+    def __init__(self, config):
+        self._config = config
+        self._num_batches = 0
+        self._total_loss = 0
+        self._task_losses = [0, 0, 0]
+        self._iou = 0
+
+    def add(self, loss: float, task_losses: (float, float, float), semantic_labels, output_semantic):
+        # TODO: this batch size might break
+        batch_size = semantic_labels.shape[0]
+
+        # Calculate accuracy measures
+        # Segmentation IoU
+        # Only compute IoU if semantic segmentation is enabled.
+        batch_iou = 0
+        if self._config['enabled_tasks'][0]:
+            for image_index in range(batch_size):
+                batch_iou += _compute_image_iou(semantic_labels[image_index], output_semantic[image_index],
+                                                self._config['num_classes'])
+
+        self._num_batches += 1
+        self._total_loss += loss
+        self._task_losses = [total + task_loss for total, task_loss in zip(self._task_losses, task_losses)]
+        self._iou += batch_iou / batch_size
+
+    def get_metrics(self, learner: MultitaskLearner) -> {str: float}:
+        semantic_loss, instance_loss, depth_loss = self._task_losses
+        metrics = {'val_total_loss': self._total_loss / self._num_batches,
+                   'val_semantic_loss': semantic_loss / self._num_batches,
+                   'val_instance_loss': instance_loss / self._num_batches,
+                   'val_depth_loss': depth_loss / self._num_batches,
+                   'val_iou': self._iou / self._num_batches}
+
+        if self._config['loss_type'] == 'learned':
+            metrics['log_vars'] = learner.get_loss_params().tolist()
+            metrics['loss_weights'] = learner.loss_weighting.get_weights().tolist()
+
+        return metrics
+
+
+def _compute_image_iou(truth, output_softmax, num_classes: int):
+    # Convert the softmax to the id of the class.
+    output_classes = torch.argmax(output_softmax, dim=0)
+
+    class_count = 0
+    iou = 0.0
+    for c in range(num_classes):
+        # Create tensors with 1 for every pixel labelled with this class, and 0 otherwise. We then
+        # add these tensors. The result has 2 for the intersection, and 1 or 2 for the union.
+
+        truth_for_class = torch.where(truth == c, torch.ones_like(truth, dtype=torch.int),
+                                      torch.zeros_like(truth, dtype=torch.int))
+
+        output_for_class = torch.where(output_classes == c, torch.ones_like(output_classes, dtype=torch.int),
+                                       torch.zeros_like(output_classes, dtype=torch.int))
+
+        result = truth_for_class + output_for_class
+        # View in 1D as bincount only supports 1D.
+        # We expect values 0, 1, 2 for no object, one object and both objects respectively.
+        counts = torch.bincount(result.view(-1), minlength=3)
+
+        assert counts.size(0) == 3, 'Wrong number of bins: {}'.format(counts)
+
+        intersection = counts[2].item()
+        union = counts[1].item() + counts[2].item()
+
+        if union > 0:
+            class_count += 1
+            iou += intersection / union
+
+    return iou / class_count
@@ -0,0 +1,145 @@
+"""A file format for the weights of a model only, which is loaded with mmap rather than unpickled.
+
+The checkpoints saved by training are pickled dicts which include the optimizer state, so loading one for inference
+reads and deserialises the whole file, about 3 times the size of the weights with Adam. A weights file instead has:
+    8 bytes: _MAGIC
+    8 bytes: little-endian length of the header
+    header: JSON {'metadata': {...}, 'tensors': {name: {'dtype': str, 'shape': [int], 'offset': int}}}
+    the data of each tensor, contiguous and in C order, at its offset from the start of the data, aligned to _ALIGNMENT
+
+so each tensor is a view of the mapped file, and its pages are only read when it is used. Floating point weights can be
+stored in fp16 to halve the size, in which case they are converted back to the dtype of the model when loaded.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+from torch import nn
+
+_MAGIC = b'MTLWGHT1'
+_ALIGNMENT = 64
+
+_DTYPES = {torch.float32: 'float32', torch.float16: 'float16', torch.float64: 'float64', torch.int64: 'int64',
+           torch.int32: 'int32', torch.uint8: 'uint8', torch.int8: 'int8', torch.bool: 'bool'}
+
+
+def save_weights(path: str, state_dict: dict, metadata: dict = None, half=False):
+    """Saves the tensors of a state dict, written to a temporary file then renamed, so the file is always complete.
+
+    :param metadata JSON serialisable values, returned by load_weights, e.g. the epoch.
+    :param half Whether to store the floating point tensors in fp16.
+    """
+    tensors = {}
+    header = {'metadata': metadata or {}, 'tensors': {}}
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        if half and tensor.is_floating_point():
+            tensor = tensor.half()
+        assert tensor.dtype in _DTYPES, f'Cannot save {name} of type {tensor.dtype}'
+        tensors[name] = tensor.contiguous()
+        header['tensors'][name] = {'dtype': _DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset}
+        offset += -(-tensor.numel() * tensor.element_size() // _ALIGNMENT) * _ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Padded so that the data starts aligned.
+    header_bytes += b' ' * (-(len(_MAGIC) + 8 + len(header_bytes)) % _ALIGNMENT)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(_MAGIC)
+        file.write(struct.pack('<Q', len(header_bytes)))
+        file.write(header_bytes)
+        data_start = file.tell()
+        for name, tensor in tensors.items():
+            file.seek(data_start + header['tensors'][name]['offset'])
+            file.write(tensor.numpy().tobytes() if tensor.numel() > 0 else b'')
+        file.truncate(data_start + offset)
+    os.replace(path + '.tmp', path)
+
+
+def is_weights_file(path: str) -> bool:
+    """Returns whether the file was saved by save_weights, rather than e.g. checkpointing.save_model."""
+    with open(path, 'rb') as file:
+        return file.read(len(_MAGIC)) == _MAGIC
+
+
+def load_weights(path: str) -> (dict, dict):
+    """Returns (state dict, metadata) of a file saved by save_weights.
+
+    The tensors are copy-on-write views of the mapped file, so nothing is read until they are used, and changing them
+    does not change the file.
+    """
+    with open(path, 'rb') as file:
+        assert file.read(len(_MAGIC)) == _MAGIC, f'{path} is not a weights file'
+        header_length, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    data_start = len(_MAGIC) + 8 + header_length
+
+    state_dict = {}
+    # An empty file can't be mapped, which is the case if every tensor is empty.
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start) if os.path.getsize(path) > data_start else None
+    for name, entry in header['tensors'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        if count == 0:
+            array = np.empty(entry['shape'], dtype)
+        else:
+            array = data[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict, header['metadata']
+
+
+def load_model_weights(model: nn.Module, path: str) -> dict:
+    """Loads a file saved by save_weights into the model, and returns its metadata.
+
+    The tensors of the model are replaced by the mapped tensors rather than copied into, unless they were saved in a
+    different dtype, e.g. fp16, when they are converted to the dtype of the model. The keys must match exactly.
+    """
+    state_dict, metadata = load_weights(path)
+    current = model.state_dict()
+    state_dict = {name: tensor.to(current[name].dtype) if name in current else tensor
+                  for name, tensor in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    return metadata
+
+
+def load_checkpoint_into(model: nn.Module, path: str) -> dict:
+    """Loads the weights of the model from either a weights file, or a checkpoint saved by training, and returns the
+    metadata: the epoch and iterations at which it was saved."""
+    if is_weights_file(path):
+        return load_model_weights(model, path)
+    state = torch.load(path, map_location='cpu')
+    # We don't know how to handle anything except version 1.
+    assert state['version'] == 1
+    model.load_state_dict(state['model_state_dict'])
+    return {'epoch': state['epoch'], 'iterations': state['iterations']}
+
+
+if __name__ == '__main__':
+    # ### Round trip test, of every dtype and an empty tensor, at full and half precision.
+    import tempfile
+
+    test_state = {'weight': torch.randn(3, 5), 'bias': torch.randn(5).double(), 'count': torch.tensor(7),
+                  'mask': torch.rand(4) > 0.5, 'empty': torch.zeros(0, 2), 'codes': torch.randint(0, 255, (9,)).byte()}
+    with tempfile.TemporaryDirectory() as directory:
+        test_path = os.path.join(directory, 'test.weights')
+        save_weights(test_path, test_state, {'epoch': 3})
+        assert is_weights_file(test_path)
+        loaded, loaded_metadata = load_weights(test_path)
+        assert loaded_metadata == {'epoch': 3}
+        for test_name, test_tensor in test_state.items():
+            assert loaded[test_name].dtype == test_tensor.dtype and torch.equal(loaded[test_name], test_tensor)
+
+        save_weights(test_path, test_state, half=True)
+        loaded, _ = load_weights(test_path)
+        assert loaded['weight'].dtype == torch.float16 and loaded['count'].dtype == torch.int64
+        assert torch.allclose(loaded['weight'].float(), test_state['weight'], atol=1e-2)
+
+        test_model = nn.BatchNorm2d(4)
+        test_model.running_mean.normal_()
+        save_weights(test_path, test_model.state_dict(), half=True)
+        test_loaded_model = nn.BatchNorm2d(4)
+        load_model_weights(test_loaded_model, test_path)
+        assert test_loaded_model.running_mean.dtype == torch.float32
+        assert torch.allclose(test_loaded_model.running_mean, test_model.running_mean, atol=1e-2)
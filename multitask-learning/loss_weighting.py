@@ -0,0 +1,100 @@
+"""Combines the losses of several tasks into a single loss, shared by the Cityscapes and MNIST experiments.
+
+See the paper, or reports/aml_report_oscar_key.pdf, for the derivation of the uncertainty weighted loss.
+"""
+from typing import Dict
+
+import torch
+from torch import Tensor, nn
+
+
+class UncertaintyWeighting(nn.Module):
+    """Weights each task loss by its learned homoscedastic uncertainty, for any number of tasks.
+
+    For each task we learn s = log(sigma^2). Classification losses are weighted as exp(-s) * L + 0.5 * s, and regression
+    losses as 0.5 * exp(-s) * L + 0.5 * s. The values of s for all tasks are stored as a single parameter vector, so the
+    weighted total is computed in one expression, whatever the number of tasks.
+    """
+
+    def __init__(self, initial_log_vars: [float], regression_tasks: [bool]):
+        """Creates a new instance.
+
+        :param initial_log_vars The initial s=log(sigma^2) for each task.
+        :param regression_tasks For each task, True if it is a regression task, or False if it is a classification task.
+        """
+        super().__init__()
+        assert len(initial_log_vars) == len(regression_tasks), \
+            f'initial_log_vars={initial_log_vars}, regression_tasks={regression_tasks}'
+
+        self.log_vars = nn.Parameter(torch.tensor([float(s) for s in initial_log_vars]))
+        loss_scales = torch.tensor([0.5 if regression else 1.0 for regression in regression_tasks])
+        self.register_buffer('_loss_scales', loss_scales, persistent=False)
+
+    def forward(self, losses: Tensor, enabled_tasks: [bool]) -> Tensor:
+        """Returns the weighted total of the given task losses.
+
+        :param losses A vector with the unweighted loss of each task. The losses of disabled tasks are ignored.
+        :param enabled_tasks For each task, whether it contributes to the total.
+        """
+        weighted = self._loss_scales * torch.exp(-self.log_vars) * losses + 0.5 * self.log_vars
+        return (weighted * losses.new_tensor(enabled_tasks)).sum()
+
+    def get_weights(self) -> Tensor:
+        """Returns the weight currently applied to each unweighted loss."""
+        return self._loss_scales * torch.exp(-self.log_vars)
+
+
+def fixed_weighting(losses: Tensor, weights: [float], enabled_tasks: [bool]) -> Tensor:
+    """Returns the total of the given task losses, each multiplied by a fixed weight."""
+    return (losses * losses.new_tensor(weights) * losses.new_tensor(enabled_tasks)).sum()
+
+
+def stack_losses(losses: [Tensor], device) -> Tensor:
+    """Stacks the given scalar task losses into a vector, replacing the losses of disabled tasks (None) with zero."""
+    return torch.stack([loss.reshape(()) if loss is not None else torch.zeros((), device=device) for loss in losses])
+
+
+def convert_legacy_log_vars(state_dict: Dict[str, Tensor], prefix: str, legacy_names: [str], module_name: str):
+    """Converts state dicts from before UncertaintyWeighting existed, when each task had its own scalar parameter.
+
+    Removes the legacy parameters from the state dict, and replaces them with the equivalent log_vars vector.
+
+    :param prefix The prefix of the model in the state dict, as passed to _load_from_state_dict.
+    :param legacy_names The names of the old parameters, in task order.
+    :param module_name The name of the UncertaintyWeighting module in the model.
+    """
+    legacy_keys = [prefix + name for name in legacy_names]
+    if not all(key in state_dict for key in legacy_keys):
+        return
+
+    legacy_values = [state_dict.pop(key).reshape(()) for key in legacy_keys]
+    state_dict[prefix + module_name + '.log_vars'] = torch.stack(legacy_values)
+
+
+def convert_legacy_optimizer_state(optimizer_state_dict: Dict, num_tasks: int) -> Dict:
+    """Converts optimizer state from before UncertaintyWeighting existed, to match the model's current parameters.
+
+    The legacy per-task scalar parameters were the first parameters of the model, and log_vars is now the first
+    parameter, so the state of the first num_tasks parameters is merged into the state of a single vector.
+    """
+    assert len(optimizer_state_dict['param_groups']) == 1
+    group = optimizer_state_dict['param_groups'][0]
+    legacy_ids = group['params'][:num_tasks]
+    other_ids = group['params'][num_tasks:]
+
+    state = optimizer_state_dict['state']
+    converted_state = {}
+    # Renumber the parameters, as the optimizer expects ids 0 to number of parameters - 1.
+    for new_id, old_id in enumerate(other_ids, start=1):
+        if old_id in state:
+            converted_state[new_id] = state[old_id]
+
+    if all(legacy_id in state for legacy_id in legacy_ids):
+        legacy_states = [state[legacy_id] for legacy_id in legacy_ids]
+        converted_state[0] = {
+            key: (torch.stack([s[key].reshape(()) for s in legacy_states])
+                  if key != 'step' and isinstance(value, Tensor) else value)
+            for key, value in legacy_states[0].items()}
+
+    converted_group = dict(group, params=list(range(len(other_ids) + 1)))
+    return {'state': converted_state, 'param_groups': [converted_group]}
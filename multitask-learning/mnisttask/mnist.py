@@ -97,7 +97,7 @@ def _get_fixed_loss_func(enabled_tasks: [bool], weights: [float], mnist_type: st
 
 @ex.capture
 def _get_learned_loss_func(enabled_tasks: [bool], model: MultitaskMnistModel, mnist_type: str):
-    return mnist_loss.get_learned_loss(enabled_tasks, model.get_loss_weights(), mnist_type)
+    return mnist_loss.get_learned_loss(enabled_tasks, model.get_loss_weighting(), mnist_type)
 
 
 @ex.capture
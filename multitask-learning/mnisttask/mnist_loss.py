@@ -3,7 +3,9 @@ from abc import abstractmethod, ABC
 
 import torch
 import torch.nn.functional as F
-from torch import Tensor, nn
+from torch import Tensor
+
+from loss_weighting import UncertaintyWeighting, fixed_weighting, stack_losses
 
 
 def _labels_to_1(labels, mnist_type: str):
@@ -57,97 +59,61 @@ class MnistLossFunc(ABC):
         """
         pass
 
-    @abstractmethod
-    def weight_loss(self, loss: Tensor) -> Tensor:
-        """Weights the given loss appropriately. e.g. by a fixed weight or a learned uncertainty weight"""
-        pass
-
-
-class FixedCELoss(MnistLossFunc):
-    def __init__(self, weight: float, class_map_func):
-        assert isinstance(weight, float)
-        self._weight = weight
-        self._class_map_func = class_map_func
-
-    def get_raw_loss(self, output: Tensor, labels: Tensor, _) -> Tensor:
-        return F.cross_entropy(output, self._class_map_func(labels))
-
-    def weight_loss(self, loss: Tensor) -> Tensor:
-        return self._weight * loss
-
 
-class LearnedCELoss(MnistLossFunc):
-    def __init__(self, s: nn.Parameter, class_map_func):
-        assert isinstance(s, nn.Parameter)
-        self._s = s
+class CELoss(MnistLossFunc):
+    def __init__(self, class_map_func):
         self._class_map_func = class_map_func
 
     def get_raw_loss(self, output: Tensor, labels: Tensor, _) -> Tensor:
         return F.cross_entropy(output, self._class_map_func(labels))
 
-    def weight_loss(self, loss: Tensor) -> Tensor:
-        return torch.exp(-self._s) * loss + 0.5 * self._s
-
-
-class FixedL1Loss(MnistLossFunc):
-    def __init__(self, weight: float):
-        assert isinstance(weight, float)
-        self._weight = weight
 
+class L1Loss(MnistLossFunc):
     def get_raw_loss(self, output: Tensor, _, original: Tensor) -> Tensor:
         return F.l1_loss(output, original)
 
-    def weight_loss(self, loss: Tensor) -> Tensor:
-        return self._weight * loss
-
-
-class LearnedL1Loss(MnistLossFunc):
-    def __init__(self, s: nn.Parameter):
-        assert isinstance(s, nn.Parameter)
-        self._s = s
-
-    def get_raw_loss(self, output: Tensor, _, original: Tensor) -> Tensor:
-        return F.l1_loss(output, original)
-
-    def weight_loss(self, loss: Tensor) -> Tensor:
-        return 0.5 * torch.exp(-self._s) * loss + 0.5 * self._s
-
 
 class MultitaskMnistLoss(ABC):
-    def __init__(self, enabled_tasks: [bool], loss_funcs: [MnistLossFunc]):
+    def __init__(self, enabled_tasks: [bool], loss_funcs: [MnistLossFunc], weight_losses):
+        """Creates a new instance.
+
+        :param weight_losses Function of (vector of raw losses, enabled_tasks) which returns the weighted total loss.
+        """
         super().__init__()
         assert len(enabled_tasks) == len(loss_funcs), f'enabled_tasks={enabled_tasks}, loss_funcs={loss_funcs}'
         self._enabled_tasks = enabled_tasks
         self._loss_funcs = loss_funcs
+        self._weight_losses = weight_losses
 
     def __call__(self, outputs: [Tensor], labels: Tensor, original: Tensor):
         """Returns (overall loss, [task losses])"""
         assert len(outputs) == len(self._enabled_tasks) == len(self._loss_funcs)
 
-        raw_losses = [
-            loss_func.get_raw_loss(output, labels, original) if enabled else torch.tensor([0.0], device=output.device)
-            for enabled, loss_func, output in zip(self._enabled_tasks, self._loss_funcs, outputs)]
+        raw_losses = stack_losses(
+            [loss_func.get_raw_loss(output, labels, original) if enabled else None
+             for enabled, loss_func, output in zip(self._enabled_tasks, self._loss_funcs, outputs)],
+            device=original.device)
+        total_loss = self._weight_losses(raw_losses, self._enabled_tasks)
+
+        return total_loss, tuple(raw_losses)
 
-        weighted_losses = [loss_func.weight_loss(raw_loss) for loss_func, raw_loss in zip(self._loss_funcs, raw_losses)]
-        total_loss = weighted_losses[0] + weighted_losses[1] + weighted_losses[2]
 
-        return total_loss, (raw_losses[0], raw_losses[1], raw_losses[2])
+def _get_loss_funcs(mnist_type: str) -> [MnistLossFunc]:
+    return [CELoss(lambda labels: _labels_to_1(labels, mnist_type)), CELoss(lambda x: x), L1Loss()]
 
 
 def get_fixed_loss(enabled_tasks: [bool], weights: [float], mnist_type: str):
     """Returns the fixed weight loss function."""
-    task_1_loss_func = FixedCELoss(weights[0], lambda labels: _labels_to_1(labels, mnist_type))
-    task_2_loss_func = FixedCELoss(weights[1], lambda x: x)
-    task_3_loss_func = FixedL1Loss(weights[2])
-    return MultitaskMnistLoss(enabled_tasks, [task_1_loss_func, task_2_loss_func, task_3_loss_func])
+    assert all(isinstance(weight, float) for weight in weights)
+    return MultitaskMnistLoss(enabled_tasks, _get_loss_funcs(mnist_type),
+                              lambda losses, enabled: fixed_weighting(losses, weights, enabled))
 
 
-def get_learned_loss(enabled_tasks: [bool], ses: [nn.Parameter], mnist_type: str):
+def get_learned_loss(enabled_tasks: [bool], weighting: UncertaintyWeighting, mnist_type: str):
     """Returns the learned uncertainties loss function.
 
-    :param ses s=log(sigma^2) for each task, as in the paper
+    :param weighting The UncertaintyWeighting module of the model, which learns s=log(sigma^2) for each task, as in
+    the paper
     """
-    task_1_loss_func = LearnedCELoss(ses[0], lambda labels: _labels_to_1(labels, mnist_type))
-    task_2_loss_func = LearnedCELoss(ses[1], lambda x: x)
-    task_3_loss_func = LearnedL1Loss(ses[2])
-    return MultitaskMnistLoss(enabled_tasks, [task_1_loss_func, task_2_loss_func, task_3_loss_func])
+    assert isinstance(weighting, UncertaintyWeighting)
+    return MultitaskMnistLoss(enabled_tasks, _get_loss_funcs(mnist_type), weighting)
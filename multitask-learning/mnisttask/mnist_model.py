@@ -4,9 +4,16 @@ import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from loss_weighting import UncertaintyWeighting, convert_legacy_log_vars
+
 
 def assert_shape(x: Tensor, shape: (int, int)):
-    """Raises an exception if the Tensor doesn't have the given final two dimensions."""
+    """Raises an exception if the Tensor doesn't have the given final two dimensions.
+
+    Does nothing while tracing, so the check is not recorded in exported graphs.
+    """
+    if torch.jit.is_tracing():
+        return
     assert tuple(x.shape[-2:]) == tuple(shape), f'Expected shape ending {shape}, got {x.shape}'
 
 
@@ -216,21 +223,27 @@ _models = [(Encoder, Classifier, Reconstructor),  #
            (Encoder3, Classifier2, Reconstructor2)]
 
 
+# The name of each task, in the order of the outputs.
+TASKS = ('classifier1', 'classifier2', 'reconstructor')
+
+
 class MultitaskMnistModel(nn.Module):
     def __init__(self, initial_ses: [float], model_version: int):
         super().__init__()
 
+        assert len(initial_ses) == 3
+        # Registered first so log_vars is the first parameter, in the same place as the legacy _weight parameters.
+        # Only the reconstruction task is a regression task.
+        self._loss_weighting = UncertaintyWeighting(initial_ses, regression_tasks=(False, False, True))
+
+        assert 0 <= model_version < len(_models) and _models[model_version] is not None, \
+            f'Model version {model_version} is not implemented, see _models'
         encoder_con, classifier_con, reconstructor_con = _models[model_version]
         self._encoder = encoder_con()
         self._classifier1 = classifier_con(num_classes=3, in_features=self._encoder.get_out_features())
         self._classifier2 = classifier_con(num_classes=10, in_features=self._encoder.get_out_features())
         self._reconstructor = reconstructor_con(in_features=self._encoder.get_out_features())
 
-        assert len(initial_ses) == 3
-        self._weight1 = nn.Parameter(torch.tensor([initial_ses[0]]))
-        self._weight2 = nn.Parameter(torch.tensor([initial_ses[1]]))
-        self._weight3 = nn.Parameter(torch.tensor([initial_ses[2]]))
-
     def forward(self, x):
         assert_shape(x, (28, 28))
 
@@ -240,6 +253,23 @@ class MultitaskMnistModel(nn.Module):
         x3 = self._reconstructor(x)
         return x1, x2, x3
 
-    def get_loss_weights(self) -> (nn.Parameter, nn.Parameter, nn.Parameter):
-        """Returns the loss weight parameters (s in the paper)."""
-        return self._weight1, self._weight2, self._weight3
+    def forward_tasks(self, x, tasks: [str]) -> tuple:
+        """Returns the outputs of only the given tasks, from TASKS."""
+        assert_shape(x, (28, 28))
+
+        x = self._encoder(x)
+        heads = {'classifier1': self._classifier1, 'classifier2': self._classifier2,
+                 'reconstructor': self._reconstructor}
+        return tuple(heads[task](x) for task in tasks)
+
+    def get_loss_weights(self) -> nn.Parameter:
+        """Returns the vector of loss weight parameters (s in the paper)."""
+        return self._loss_weighting.log_vars
+
+    def get_loss_weighting(self) -> UncertaintyWeighting:
+        return self._loss_weighting
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Before UncertaintyWeighting, each task had its own parameter.
+        convert_legacy_log_vars(state_dict, prefix, ('_weight1', '_weight2', '_weight3'), '_loss_weighting')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -0,0 +1,160 @@
+"""Measures the forward and backward time of the Cityscapes model for different backbones and model configurations.
+
+Run with PYTHONPATH="multitask-learning". Accuracy is not measured here: train each configuration with the Sacred
+config, e.g. "with tiny_cityscapes output_stride=16", and compare val_iou and the validation losses.
+"""
+import argparse
+import time
+from collections import defaultdict
+
+import torch
+
+from cityscapestask.model import MultitaskLearner
+from cityscapestask.test_time_augmentation import TestTimeAugmentation
+
+
+def _synchronize(inputs: torch.Tensor):
+    if inputs.is_cuda:
+        torch.cuda.synchronize()
+
+
+def _time_model(model: MultitaskLearner, inputs: torch.Tensor, iterations: int, backward: bool) -> float:
+    """Returns the mean seconds per iteration, after one warm up iteration."""
+    model.set_output_size(inputs.shape[2:])
+
+    def _iteration():
+        if backward:
+            model.zero_grad()
+            outputs = model(inputs)
+            sum(output.sum() for output in outputs if output is not None).backward()
+        else:
+            with torch.no_grad():
+                model(inputs)
+
+    _iteration()
+    _synchronize(inputs)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _iteration()
+    _synchronize(inputs)
+    return (time.perf_counter() - start) / iterations
+
+
+def _time_modules(model: MultitaskLearner, inputs: torch.Tensor, iterations: int) -> {str: float}:
+    """Returns the mean forward seconds per iteration of each part of the encoder, and of the decoders."""
+    model.set_output_size(inputs.shape[2:])
+    modules = [('encoder.' + name, module) for name, module in model.encoder.named_children()
+               if any(True for _ in module.parameters())]
+    modules.append(('decoders', model.decoders))
+
+    start_times = {}
+    total_times = defaultdict(float)
+
+    def _pre_hook(name):
+        def _hook(*_):
+            _synchronize(inputs)
+            start_times[name] = time.perf_counter()
+        return _hook
+
+    def _post_hook(name):
+        def _hook(*_):
+            _synchronize(inputs)
+            total_times[name] += time.perf_counter() - start_times[name]
+        return _hook
+
+    handles = []
+    for name, module in modules:
+        handles.append(module.register_forward_pre_hook(_pre_hook(name)))
+        handles.append(module.register_forward_hook(_post_hook(name)))
+
+    with torch.no_grad():
+        model(inputs)
+        total_times.clear()
+        for _ in range(iterations):
+            model(inputs)
+
+    for handle in handles:
+        handle.remove()
+
+    return {name: total_times[name] / iterations for name, _ in modules}
+
+
+def main(args):
+    device = 'cuda:0' if args.gpu and torch.cuda.is_available() else 'cpu'
+    inputs = torch.randn(args.batch_size, 3, args.height, args.width, device=device)
+
+    print(f'{"resnet_type":>12} {"output_stride":>14} {"aspp_type":>10} {"parameters (M)":>15} {"forward (ms)":>13} '
+          f'{"forward+backward (ms)":>22}' + (f' {"optimized forward (ms)":>23}' if args.optimize_for_inference else ''))
+    module_times = {}
+    tta_times = {}
+    for resnet_type in args.resnet_types:
+        for output_stride in args.output_strides:
+            for aspp_type in args.aspp_types:
+                model = MultitaskLearner(num_classes=20, enabled_tasks=(True, True, True),
+                                         loss_uncertainties=(1, 1, 1), pre_train_encoder=False,
+                                         aspp_dilations=(12, 24, 36), resnet_type=resnet_type,
+                                         output_stride=output_stride, aspp_type=aspp_type)
+                model.to(device)
+
+                num_parameters = sum(parameter.numel() for parameter in model.parameters()) / 1e6
+                forward_time = _time_model(model, inputs, args.iterations, backward=False)
+                backward_time = _time_model(model, inputs, args.iterations, backward=True)
+                row = (f'{resnet_type:>12} {output_stride:>14} {aspp_type:>10} {num_parameters:>15.1f} '
+                       f'{forward_time * 1000:>13.1f} {backward_time * 1000:>22.1f}')
+                if args.optimize_for_inference:
+                    # Compare with the forward time in eval mode, which is what the optimized model reproduces.
+                    model.eval()
+                    eval_time = _time_model(model, inputs, args.iterations, backward=False)
+                    optimized = model.optimize_for_inference(inputs)
+                    optimized_time = _time_model(optimized, inputs, args.iterations, backward=False)
+                    row += f' {optimized_time * 1000:>12.1f} (eval {eval_time * 1000:.1f})'
+                    model.train()
+                print(row)
+
+                if args.tta_scales:
+                    model.eval()
+                    tta_times[(resnet_type, output_stride, aspp_type)] = [
+                        _time_model(TestTimeAugmentation(model, args.tta_scales, batched=batched), inputs,
+                                    args.iterations, backward=False) for batched in (True, False)]
+                    model.train()
+
+                if args.module_timing:
+                    module_times[(resnet_type, output_stride, aspp_type)] = _time_modules(model, inputs,
+                                                                                          args.iterations)
+
+    for (resnet_type, output_stride, aspp_type), times in module_times.items():
+        print()
+        print(f'Forward time per module (ms): {resnet_type} output_stride={output_stride} aspp_type={aspp_type}')
+        for name, seconds in times.items():
+            print(f'{name:>20} {seconds * 1000:>8.1f}')
+
+    if tta_times:
+        print()
+        print(f'Test time augmentation forward with flips and scales {args.tta_scales}')
+        print(f'{"resnet_type":>12} {"output_stride":>14} {"aspp_type":>10} {"batched (ms)":>13} {"sequential (ms)":>16}')
+    for (resnet_type, output_stride, aspp_type), (batched_time, sequential_time) in tta_times.items():
+        print(f'{resnet_type:>12} {output_stride:>14} {aspp_type:>10} {batched_time * 1000:>13.1f} '
+              f'{sequential_time * 1000:>16.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resnet_types', type=str, nargs='+', default=['resnet101'],
+                        help='Backbones to benchmark, from encoder.BACKBONES')
+    parser.add_argument('--output_strides', type=int, nargs='+', default=[8, 16])
+    parser.add_argument('--aspp_types', type=str, nargs='+', default=['standard'])
+    parser.add_argument('--module_timing', action='store_true', help='Also print the forward time of each module')
+    parser.add_argument('--optimize_for_inference', action='store_true',
+                        help='Also print the forward time after MultitaskLearner.optimize_for_inference')
+    parser.add_argument('--tta_scales', type=float, nargs='+', default=None,
+                        help='Also print the forward time of test time augmentation with flips and these scales, '
+                             'batched by scale and run sequentially.')
+    parser.add_argument('--batch_size', type=int, default=2)
+    # Default is the size of Tiny Cityscapes.
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=256)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--gpu', action='store_true')
+
+    main(parser.parse_args())
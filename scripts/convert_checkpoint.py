@@ -0,0 +1,51 @@
+"""Converts a checkpoint saved by training to a weights file, see cityscapestask/weights_file.py.
+
+Run with PYTHONPATH="multitask-learning". The weights file has only the model weights, without the optimizer state, and
+is loaded with mmap, so it is the faster format to serve, validate or export a model from. It can also be restored for
+training, with a new optimizer. With --half the floating point weights are stored in fp16, halving the size of the file,
+and converted back to fp32 when loaded.
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from cityscapestask.weights_file import load_weights, save_weights
+
+
+def main(args):
+    state = torch.load(args.checkpoint, map_location='cpu')
+    # We don't know how to handle anything except version 1.
+    assert state['version'] == 1
+    save_weights(args.output, state['model_state_dict'], {'epoch': state['epoch'], 'iterations': state['iterations']},
+                 half=args.half)
+    print(f'Saved the weights at epoch {state["epoch"]} to {args.output}, {os.path.getsize(args.output) / 2 ** 20:.1f} '
+          f'MiB, from {os.path.getsize(args.checkpoint) / 2 ** 20:.1f} MiB')
+
+    if args.time_loading:
+        # Each is loaded twice, so both are timed from the page cache.
+        for name, load in [('checkpoint', lambda: torch.load(args.checkpoint, map_location='cpu')['model_state_dict']),
+                           ('weights file', lambda: _touch(load_weights(args.output)[0]))]:
+            load()
+            start = time.perf_counter()
+            load()
+            print(f'Loading the {name} took {time.perf_counter() - start:.3f}s')
+
+
+def _touch(state_dict: dict) -> dict:
+    """Reads every tensor, so mapped tensors are timed including reading their pages."""
+    for tensor in state_dict.values():
+        tensor.sum()
+    return state_dict
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True, help='Checkpoint file saved by training.')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--half', action='store_true', help='Store the floating point weights in fp16.')
+    parser.add_argument('--time_loading', action='store_true',
+                        help='Print how long the model weights take to load from the checkpoint and the weights file.')
+
+    main(parser.parse_args())
@@ -0,0 +1,27 @@
+"""Converts the ImageNet weights of the encoder backbones, so that MultitaskLearner loads them offline and with mmap.
+
+Run with PYTHONPATH="multitask-learning". The official weights are downloaded into --pretrained_weights_dir if they are
+not already there, then only the weights the encoder uses are saved to {backbone}.weights in the same directory, see
+cityscapestask/weights_file.py. Set the pretrained_weights_dir config to the same directory to use them. This only needs
+to be run once, after which the directory can be copied to machines without network access.
+"""
+import argparse
+
+from cityscapestask.encoder import BACKBONES
+from cityscapestask.model import convert_pretrained_weights
+
+
+def main(args):
+    for backbone in args.backbones:
+        path = convert_pretrained_weights(backbone, args.pretrained_weights_dir, half=args.half)
+        print(f'Saved the {backbone} weights to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained_weights_dir', type=str, default=None,
+                        help='If not given, the default PyTorch cache directory, as used by MultitaskLearner.')
+    parser.add_argument('--backbones', type=str, nargs='+', default=['resnet101'], choices=BACKBONES)
+    parser.add_argument('--half', action='store_true', help='Store the weights in fp16, halving the size of the files.')
+
+    main(parser.parse_args())
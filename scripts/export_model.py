@@ -0,0 +1,132 @@
+"""Exports a checkpoint of the Cityscapes or MNIST model to TorchScript and ONNX, for inference without this package.
+
+Run with PYTHONPATH="multitask-learning". The checkpoint is a file saved by the training scripts, e.g. downloaded from the
+Sacred artifacts. The heads to export are fixed, and the exported model returns only their outputs, in the order given.
+The batch size is always dynamic, and the spatial size of the Cityscapes model is dynamic with --dynamic_size.
+
+The exported models take normalised images, see CityscapesDataset._get_image, and return the outputs upsampled to the
+input size. Parity with the eager model is checked at a different batch size (and spatial size, if dynamic) to the one
+used for export. The ONNX model is checked with onnxruntime, if it is installed.
+"""
+import argparse
+import os
+
+import torch
+from torch import nn
+
+from cityscapestask import decoders
+from cityscapestask.model_arguments import add_model_arguments, create_learner_from_args
+from cityscapestask.weights_file import load_checkpoint_into
+from mnisttask import mnist_model
+from mnisttask.mnist_model import MultitaskMnistModel
+
+# With a dynamic size, parity is checked with inputs this much larger than the example. A multiple of the output stride.
+_TEST_SIZE_INCREASE = 32
+
+
+class _ExportedHeads(nn.Module):
+    """Returns the outputs of the given heads only, upsampled to the size of the input."""
+
+    def __init__(self, model: nn.Module, tasks: [str], upsample_to_input: bool):
+        super().__init__()
+        self.model = model
+        self._tasks = tasks
+        self._upsample_to_input = upsample_to_input
+
+    def forward(self, x):
+        if self._upsample_to_input:
+            # Traced from the shape of the input, so the exported models follow the input size.
+            self.model.set_output_size(x.shape[-2:])
+        return self.model.forward_tasks(x, self._tasks)
+
+
+def _build_model(args) -> (nn.Module, [int]):
+    """Returns the model in eval mode, and the shape of an example input excluding the batch dimension."""
+    if args.model == 'cityscapes':
+        learner = create_learner_from_args(args)
+        example_shape = [3, args.height, args.width]
+        return learner.optimize_for_inference(torch.randn([2] + example_shape)), example_shape
+    else:
+        model = MultitaskMnistModel((1.0, 1.0, 1.0), args.model_version)
+        if args.checkpoint is not None:
+            load_checkpoint_into(model, args.checkpoint)
+        return model.eval(), [1, 28, 28]
+
+
+def _check_parity(name: str, expected: [torch.Tensor], outputs: [torch.Tensor], atol: float):
+    for task_index, (expected_output, output) in enumerate(zip(expected, outputs)):
+        output = torch.as_tensor(output)
+        assert output.shape == expected_output.shape, f'{name} output {task_index} had shape {output.shape}'
+        error = (expected_output - output).abs().max().item()
+        assert error <= atol, f'{name} output {task_index} differs from the eager model by {error}'
+        print(f'{name} output {task_index}: shape {tuple(output.shape)}, max difference {error:.2e}')
+
+
+def main(args):
+    model, example_shape = _build_model(args)
+    all_tasks = decoders.TASKS if args.model == 'cityscapes' else mnist_model.TASKS
+    tasks = args.heads if args.heads else list(all_tasks)
+    assert all(task in all_tasks for task in tasks), f'Unknown heads {tasks}, expected some of {all_tasks}'
+
+    dynamic_size = args.model == 'cityscapes' and args.dynamic_size
+    exported = _ExportedHeads(model, tasks, upsample_to_input=args.model == 'cityscapes').eval()
+
+    example_inputs = torch.randn([2] + example_shape)
+    # Check at a different size to the example, to make sure the dynamic dimensions really are dynamic.
+    test_shape = list(example_shape)
+    if dynamic_size:
+        test_shape[1:] = [size + _TEST_SIZE_INCREASE for size in test_shape[1:]]
+    test_inputs = torch.randn([3] + test_shape)
+    with torch.no_grad():
+        expected = exported(test_inputs)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = args.name or args.model
+    torchscript_path = os.path.join(args.output_dir, name + '.pt')
+    onnx_path = os.path.join(args.output_dir, name + '.onnx')
+
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(exported, example_inputs))
+    traced.save(torchscript_path)
+    print(f'Saved TorchScript to {torchscript_path}')
+    with torch.no_grad():
+        _check_parity('TorchScript', expected, torch.jit.load(torchscript_path)(test_inputs), args.atol)
+
+    output_names = list(tasks)
+    dynamic_axes = {name: ({0: 'batch', 2: 'height', 3: 'width'} if dynamic_size else {0: 'batch'})
+                    for name in ['image'] + output_names}
+    torch.onnx.export(exported, (example_inputs,), onnx_path, input_names=['image'], output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=args.opset, dynamo=False)
+    print(f'Saved ONNX to {onnx_path}')
+
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime is not installed, so the ONNX model was not checked')
+        return
+    session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    _check_parity('ONNX', expected, session.run(output_names, {'image': test_inputs.numpy()}), args.atol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, choices=['cityscapes', 'mnist'], default='cityscapes')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Checkpoint file to export. If not given, randomly initialised weights are exported.')
+    parser.add_argument('--heads', type=str, nargs='+', default=None,
+                        help=f'Heads to export, in order. Defaults to all of {decoders.TASKS} for Cityscapes, '
+                             f'and {mnist_model.TASKS} for MNIST.')
+    parser.add_argument('--output_dir', type=str, default='exported')
+    parser.add_argument('--name', type=str, default=None, help='File name of the exports. Defaults to the model type.')
+    parser.add_argument('--dynamic_size', action='store_true',
+                        help='Cityscapes only: allow any input height and width, rather than only those given.')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--atol', type=float, default=1e-3, help='Maximum difference from the eager outputs.')
+    add_model_arguments(parser)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=256)
+    parser.add_argument('--model_version', type=int, default=0,
+                        choices=[version for version, model in enumerate(mnist_model._models) if model is not None],
+                        help='MNIST only: see mnist_model._models.')
+
+    main(parser.parse_args())
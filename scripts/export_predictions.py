@@ -0,0 +1,99 @@
+"""Predicts every image of a Cityscapes split with a checkpoint, and saves the predictions for offline evaluation.
+
+Run with PYTHONPATH="multitask-learning". For each {city}_{seq}_{frame}_leftImg8bit.png under --split_dir, writes to
+the same relative path in --output_dir:
+    {city}_{seq}_{frame}_pred_labelIds.png (or _pred_trainIds.png): uint8 semantic classes, as read by cityscapesScripts
+    {city}_{seq}_{frame}_pred_disparity.png: uint16 depth in the Cityscapes disparity encoding
+    {city}_{seq}_{frame}_pred_instanceVectors.npy: fp16 [2 x H x W] instance vectors
+
+The model, decoding and encoding are pipelined, see cityscapestask/pipeline.py, with enough encoding threads that the
+model does not wait for them. Each file is written to a temporary file and renamed, so an image whose files all exist
+is complete, and is skipped if the export is run again, e.g. after being interrupted.
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from cityscapestask.cityscapes import TRAIN_ID_TO_LABEL_ID, encode_disparity, find_image_files, normalize_image
+from cityscapestask.model_arguments import add_model_arguments, create_learner_from_args
+from cityscapestask.pipeline import run_pipeline
+from cityscapestask.prediction import predict_heads
+
+
+def _get_output_paths(image_path: str, args) -> (str, str, str):
+    """Returns the paths of the (semantic, depth, instance) outputs of the image."""
+    prefix = os.path.join(args.output_dir, os.path.relpath(image_path, args.split_dir))[:-len('_leftImg8bit.png')]
+    return (f'{prefix}_pred_{args.label_space}s.png', f'{prefix}_pred_disparity.png',
+            f'{prefix}_pred_instanceVectors.npy')
+
+
+def _write_atomically(path: str, save):
+    """Calls save with a temporary path, then renames the file to path."""
+    temporary_path = path + '.tmp'
+    save(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _save_npy(path: str, array: np.ndarray):
+    # Through a file, as np.save adds .npy to paths without it.
+    with open(path, 'wb') as file:
+        np.save(file, array)
+
+
+def main(args):
+    learner = create_learner_from_args(args)
+    device = torch.device(args.device)
+    learner = learner.optimize_for_inference().to(device)
+
+    images = find_image_files(args.split_dir)
+    remaining = [path for path in images
+                 if not all(os.path.exists(output) for output in _get_output_paths(path, args))]
+    print(f'Found {len(images)} images in {args.split_dir}, of which {len(images) - len(remaining)} were already '
+          f'exported')
+
+    def _decode(path):
+        return torch.from_numpy(normalize_image(np.asarray(Image.open(path).convert('RGB'))))
+
+    def _predict(paths, batch_images):
+        predictions = predict_heads(learner, torch.stack(batch_images).to(device), ['semantic', 'instance', 'depth'])
+        return [{head: output[i] for head, output in predictions.items()} for i in range(len(paths))]
+
+    def _write(path, prediction):
+        semantic_path, depth_path, instance_path = _get_output_paths(path, args)
+        os.makedirs(os.path.dirname(semantic_path), exist_ok=True)
+        semantic = prediction['semantic']
+        if args.label_space == 'labelId':
+            semantic = TRAIN_ID_TO_LABEL_ID[semantic]
+        # The semantic output is written last, as its existence marks the image as exported.
+        _write_atomically(instance_path,
+                          lambda temporary: _save_npy(temporary, prediction['instance'].astype(np.float16)))
+        _write_atomically(depth_path,
+                          lambda temporary: Image.fromarray(encode_disparity(prediction['depth'])).save(
+                              temporary, format='PNG'))
+        _write_atomically(semantic_path, lambda temporary: Image.fromarray(semantic).save(temporary, format='PNG'))
+
+    statistics = run_pipeline(remaining, _decode, _predict, _write, args.batch_size, args.decode_workers,
+                              args.write_workers, args.queue_size)
+    print(statistics.format())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file saved by training, or a weights file, see convert_checkpoint.py.')
+    parser.add_argument('--split_dir', type=str, required=True, help='e.g. leftImg8bit/val or leftImg8bit/test')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--label_space', type=str, choices=['labelId', 'trainId'], default='labelId',
+                        help='labelId for cityscapesScripts evaluation, or trainId for the classes of the model.')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--decode_workers', type=int, default=4)
+    parser.add_argument('--write_workers', type=int, default=4)
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='The most decoded images, and the most predictions, which can wait for the next stage.')
+    add_model_arguments(parser)
+
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""Sends concurrent requests to a server started by scripts/serve_model.py, and reports the throughput and latency.
+
+Each of --concurrency clients sends --requests requests one after another, with --image or a random image of the given
+size, so the server can batch up to --concurrency requests at once. The batch sizes the server used are read from its
+/metrics.
+"""
+import argparse
+import io
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from PIL import Image
+
+
+def _post(url: str, body: bytes) -> bytes:
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': 'image/png'})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def _read_batch_size_metrics(server: str) -> (int, float):
+    """Returns (the number of batches, their total size) from the server's metrics."""
+    with urllib.request.urlopen(server + '/metrics') as response:
+        metrics = dict(line.rsplit(' ', 1) for line in response.read().decode().splitlines()
+                       if not line.startswith('#'))
+    return int(metrics['batch_size_count']), float(metrics['batch_size_sum'])
+
+
+def main(args):
+    if args.image is not None:
+        with open(args.image, 'rb') as file:
+            body = file.read()
+    else:
+        image = np.random.randint(0, 256, size=(args.height, args.width, 3), dtype=np.uint8)
+        png = io.BytesIO()
+        Image.fromarray(image).save(png, format='PNG')
+        body = png.getvalue()
+    url = args.server + '/predict' + ('?heads=' + ','.join(args.heads) if args.heads else '')
+
+    # Warm up, and check the response can be read.
+    response = np.load(io.BytesIO(_post(url, body)))
+    print('Response:', {name: (array.shape, str(array.dtype)) for name, array in response.items()})
+    batches_before, images_before = _read_batch_size_metrics(args.server)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def _client():
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            _post(url, body)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    clients = [threading.Thread(target=_client) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.perf_counter() - start
+
+    batches, images = _read_batch_size_metrics(args.server)
+    latencies = np.array(latencies) * 1000
+    print(f'{len(latencies)} requests from {args.concurrency} clients in {seconds:.2f}s: '
+          f'{len(latencies) / seconds:.2f} requests/s')
+    print(f'Latency (ms): p50 {np.percentile(latencies, 50):.1f}, p90 {np.percentile(latencies, 90):.1f}, '
+          f'p99 {np.percentile(latencies, 99):.1f}')
+    print(f'Mean batch size: {(images - images_before) / max(batches - batches_before, 1):.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', type=str, default='http://127.0.0.1:8080')
+    parser.add_argument('--image', type=str, default=None, help='Image to send. If not given, a random image is sent.')
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--heads', type=str, nargs='+', default=None, help='Heads to request. Defaults to all.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=5, help='Number of requests sent by each client.')
+
+    main(parser.parse_args())
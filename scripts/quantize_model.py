@@ -0,0 +1,99 @@
+"""Quantizes a Cityscapes checkpoint to int8, and reports the metrics and CPU latency of each task against fp32.
+
+Run with PYTHONPATH="multitask-learning". The model is calibrated on the first --calibration_samples images of
+--calibration_dir, then the fp32 model, the fully int8 model, and the int8 model with --float_heads kept in float are
+all evaluated in a single pass over --validation_dir. Optionally saves one of the int8 models as TorchScript.
+"""
+import argparse
+import itertools
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from cityscapestask.cityscapes import CityscapesDataset
+from cityscapestask.losses import MultiTaskLoss
+from cityscapestask.model_arguments import add_model_arguments, create_learner_from_args
+from cityscapestask.quantization import quantize_learner
+from cityscapestask.validation import compute_validation_metrics_for_learners
+
+
+def _time_forward(model, inputs: torch.Tensor, iterations: int) -> float:
+    """Returns the median seconds per forward, after one warm up iteration."""
+    times = []
+    with torch.no_grad():
+        model(inputs)
+        for _ in range(iterations):
+            start = time.perf_counter()
+            model(inputs)
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main(args):
+    learner = create_learner_from_args(args)
+    learner.eval()
+
+    calibration_dataset = CityscapesDataset(args.calibration_dir, enable_cache=False, minute=args.minute)
+    calibration_loader = DataLoader(calibration_dataset, batch_size=args.batch_size, shuffle=False)
+    num_calibration_batches = -(-args.calibration_samples // args.batch_size)
+
+    def _calibration_inputs():
+        return (data[0] for data in itertools.islice(calibration_loader, num_calibration_batches))
+
+    # Global, so set here rather than by quantize_learner. It is used both to quantize and to run the int8 models.
+    torch.backends.quantized.engine = args.backend
+    models = {'fp32': learner, 'int8': quantize_learner(learner, _calibration_inputs(), backend=args.backend)}
+    if args.float_heads:
+        models['int8, float ' + '+'.join(args.float_heads)] = quantize_learner(
+            learner, _calibration_inputs(), float_tasks=args.float_heads, backend=args.backend)
+
+    validation_dataset = CityscapesDataset(args.validation_dir, enable_cache=False, minute=args.minute)
+    validation_loader = DataLoader(validation_dataset, batch_size=args.batch_size, shuffle=False)
+    enabled_tasks = (True, True, True)
+    config = {'enabled_tasks': enabled_tasks, 'num_classes': args.num_classes, 'loss_type': 'fixed'}
+    criteria = [MultiTaskLoss('fixed', (1.0, 1.0, 1.0), enabled_tasks) for _ in models]
+    all_metrics = compute_validation_metrics_for_learners(config, 'cpu', validation_loader, list(models.values()),
+                                                          criteria, epoch=0)
+
+    inputs = validation_loader.dataset[0][0]
+    inputs = torch.as_tensor(inputs).unsqueeze(0)
+    print()
+    print(f'{"model":>30} {"mIoU":>8} {"semantic loss":>14} {"instance error":>15} {"depth error":>12} '
+          f'{"latency (ms)":>13}')
+    for (name, model), metrics in zip(models.items(), all_metrics):
+        model.set_output_size(inputs.shape[2:])
+        latency = _time_forward(model, inputs, args.iterations)
+        print(f'{name:>30} {metrics["val_iou"]:>8.4f} {metrics["val_semantic_loss"]:>14.4f} '
+              f'{metrics["val_instance_loss"]:>15.4f} {metrics["val_depth_loss"]:>12.4f} {latency * 1000:>13.1f}')
+
+    if args.output is not None:
+        name = 'int8, float ' + '+'.join(args.float_heads) if args.float_heads and args.save_float_heads else 'int8'
+        model = models[name]
+        model.set_output_size(None)
+        with torch.no_grad():
+            torch.jit.trace(model, inputs).save(args.output)
+        print(f'Saved {name} to {args.output}, which returns the outputs at the output stride')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file saved by training, or a weights file, see convert_checkpoint.py.')
+    parser.add_argument('--calibration_dir', type=str, required=True,
+                        help='Cityscapes directory to calibrate on, normally a subset of the training set.')
+    parser.add_argument('--calibration_samples', type=int, default=100)
+    parser.add_argument('--validation_dir', type=str, required=True)
+    parser.add_argument('--float_heads', type=str, nargs='*', default=['instance', 'depth'],
+                        help='Heads to also evaluate with their decoders kept in float.')
+    parser.add_argument('--backend', type=str, default='x86',
+                        help='Quantized engine, e.g. x86 for servers or qnnpack for ARM.')
+    parser.add_argument('--output', type=str, default=None, help='Path to save the int8 model as TorchScript.')
+    parser.add_argument('--save_float_heads', action='store_true',
+                        help='Save the model with --float_heads in float, rather than the fully int8 model.')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=10, help='Number of forwards to time.')
+    parser.add_argument('--minute', action='store_true', help='Use minute Cityscapes, see CityscapesDataset.')
+    add_model_arguments(parser)
+
+    main(parser.parse_args())
@@ -0,0 +1,44 @@
+"""Serves a Cityscapes checkpoint over HTTP on this machine, see cityscapestask/serving.py for the API.
+
+Run with PYTHONPATH="multitask-learning". The model is loaded once, optimized for inference, and requests which arrive
+within --max_latency seconds of each other are run as one batch. Load test it with scripts/load_test_server.py.
+"""
+import argparse
+
+import torch
+
+from cityscapestask.model_arguments import add_model_arguments, create_learner_from_args
+from cityscapestask.serving import create_server
+
+
+def main(args):
+    learner = create_learner_from_args(args)
+    if args.checkpoint is None:
+        print('No --checkpoint given, so serving randomly initialised weights')
+
+    device = torch.device(args.device)
+    learner = learner.optimize_for_inference().to(device)
+
+    server = create_server(learner, device, args.host, args.port, args.max_batch_size, args.max_latency)
+    print(f'Serving on http://{args.host}:{args.port}/predict, metrics at /metrics')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Checkpoint file saved by training, or a weights file, see convert_checkpoint.py.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_latency', type=float, default=0.02,
+                        help='Seconds that a request waits for others to batch with, at most.')
+    add_model_arguments(parser)
+
+    main(parser.parse_args())
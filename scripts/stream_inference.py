@@ -0,0 +1,70 @@
+"""Runs a Cityscapes checkpoint over every frame of a directory of sequences, e.g. leftImg8bit_sequence, in order.
+
+Run with PYTHONPATH="multitask-learning". Frames are named {city}_{sequence}_{frame}_leftImg8bit.png, and processed in
+order of city, sequence and frame. PNG decoding, the model and writing are pipelined, see cityscapestask/pipeline.py,
+and the utilisation of each stage is printed at the end. For each frame, a compressed .npz of the heads, see
+prediction.predict_heads, is written to the same relative path in --output_dir, with the regression heads in fp16.
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from cityscapestask.cityscapes import find_image_files, normalize_image
+from cityscapestask.model_arguments import add_model_arguments, create_learner_from_args
+from cityscapestask.pipeline import run_pipeline
+from cityscapestask.prediction import HEADS, predict_heads
+
+
+def main(args):
+    learner = create_learner_from_args(args)
+    if args.checkpoint is None:
+        print('No --checkpoint given, so using randomly initialised weights')
+    device = torch.device(args.device)
+    learner = learner.optimize_for_inference().to(device)
+
+    frames = find_image_files(args.input_dir)
+    if args.limit is not None:
+        frames = frames[:args.limit]
+    print(f'Found {len(frames)} frames in {args.input_dir}')
+
+    def _decode(path):
+        return torch.from_numpy(normalize_image(np.asarray(Image.open(path).convert('RGB'))))
+
+    def _predict(paths, images):
+        predictions = predict_heads(learner, torch.stack(images).to(device), args.heads)
+        return [{head: predictions[head][i] for head in args.heads} for i in range(len(paths))]
+
+    def _write(path, prediction):
+        output_path = os.path.join(args.output_dir, os.path.relpath(path, args.input_dir))
+        output_path = output_path[:-len('_leftImg8bit.png')] + '_prediction.npz'
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        prediction = {head: output.astype(np.float16) if output.dtype == np.float32 else output
+                      for head, output in prediction.items()}
+        np.savez_compressed(output_path, **prediction)
+
+    statistics = run_pipeline(frames, _decode, _predict, _write, args.batch_size, args.decode_workers,
+                              args.write_workers, args.queue_size)
+    print(statistics.format())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Checkpoint file saved by training, or a weights file, see convert_checkpoint.py.')
+    parser.add_argument('--heads', type=str, nargs='+', default=['semantic', 'instance', 'depth'],
+                        help=f'Heads to write, from {HEADS}')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--decode_workers', type=int, default=4)
+    parser.add_argument('--write_workers', type=int, default=2)
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='The most decoded frames, and the most predictions, which can wait for the next stage.')
+    parser.add_argument('--limit', type=int, default=None, help='Only process the first frames.')
+    add_model_arguments(parser)
+
+    main(parser.parse_args())